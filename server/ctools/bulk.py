@@ -0,0 +1,82 @@
+import csv
+import itertools
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+import ctools_backend.settings
+
+batch_size = getattr(ctools_backend.settings, "result_batch_size", 20000)
+
+
+def _format(value):
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        if value != value:
+            return ""
+        return repr(value)
+    return str(value)
+
+
+def point_ewkt(lng, lat, srid=None):
+    wkt = "POINT(%r %r)" % (float(lng), float(lat))
+    if srid is not None and srid > 0:
+        return "SRID=%d;%s" % (srid, wkt)
+    return wkt
+
+
+def geometry_srid(column):
+    return getattr(column.type, "srid", None)
+
+
+class BulkWriter(object):
+
+    def __init__(self, connection, table, columns, batch_size=batch_size, progress=None):
+        self.connection = connection
+        self.table = table
+        self.columns = list(columns)
+        self.batch_size = batch_size
+        self.progress = progress
+        self.rows_written = 0
+
+    def _copy_cursor(self):
+        cursor = self.connection.connection.cursor()
+        if hasattr(cursor, "copy_expert"):
+            return cursor
+        cursor.close()
+        return None
+
+    def _copy_batch(self, cursor, batch):
+        buf = StringIO()
+        writer = csv.writer(buf, lineterminator="\n")
+        for row in batch:
+            writer.writerow([_format(v) for v in row])
+        buf.seek(0)
+        statement = "COPY %s (%s) FROM STDIN WITH CSV" % (self.table.name, ", ".join(self.columns))
+        cursor.copy_expert(statement, buf)
+
+    def _insert_batch(self, batch):
+        self.connection.execute(self.table.insert(), [dict(zip(self.columns, row)) for row in batch])
+
+    def write(self, rows, total=None):
+        rows = iter(rows)
+        cursor = self._copy_cursor()
+        try:
+            while True:
+                batch = list(itertools.islice(rows, self.batch_size))
+                if not batch:
+                    break
+                if cursor is not None:
+                    self._copy_batch(cursor, batch)
+                else:
+                    self._insert_batch(batch)
+                self.rows_written += len(batch)
+                if self.progress is not None:
+                    self.progress(self.rows_written, total)
+        finally:
+            if cursor is not None:
+                cursor.close()
+        return self.rows_written
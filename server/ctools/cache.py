@@ -0,0 +1,162 @@
+import os
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+
+    def __init__(self, max_size, size_of=lambda value: 1):
+        self.max_size = max_size
+        self.size_of = size_of
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                (value, size) = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries[key] = (value, size)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = self.size_of(value)
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[1]
+            if size > self.max_size:
+                return value
+            self._entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                (_, (_, evicted_size)) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+        return value
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            (value, size) = self._entries.pop(key)
+            self.size -= size
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def keys(self):
+        with self._lock:
+            return list(self._entries.keys())
+
+    @property
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "size": self.size,
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+
+def evict_directory(directory, max_size, suffix=""):
+    entries = []
+    for filename in os.listdir(directory):
+        if not filename.endswith(suffix) or filename.endswith(".tmp"):
+            continue
+        try:
+            st = os.stat(os.path.join(directory, filename))
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, filename))
+    entries.sort()
+    size = sum(entry[1] for entry in entries)
+    evicted = 0
+    while entries and size > max_size:
+        (_, entry_size, filename) = entries.pop(0)
+        try:
+            os.remove(os.path.join(directory, filename))
+        except OSError:
+            continue
+        size -= entry_size
+        evicted += 1
+    return evicted
+
+
+class DiskCache(object):
+
+    def __init__(self, directory, max_size, suffix=""):
+        self.directory = directory
+        self.max_size = max_size
+        self.suffix = suffix
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except (IOError, OSError):
+            self.misses += 1
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        self.hits += 1
+        return data
+
+    def put(self, key, data):
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                pass
+        path = self.path(key)
+        temp_path = "%s.%d.%d.tmp" % (path, os.getpid(), threading.current_thread().ident)
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.rename(temp_path, path)
+        self.evict()
+        return data
+
+    def evict(self):
+        with self._lock:
+            self.evictions += evict_directory(self.directory, self.max_size, self.suffix)
+
+    def remove(self, prefix):
+        if not os.path.isdir(self.directory):
+            return
+        for filename in os.listdir(self.directory):
+            if filename.startswith(prefix):
+                try:
+                    os.remove(os.path.join(self.directory, filename))
+                except OSError:
+                    pass
+
+    @property
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
@@ -0,0 +1,134 @@
+import os
+import pickle
+import threading
+
+import sqlalchemy as sa
+
+import ctools_backend.settings
+from ctools import models
+from ctools.cache import LRUCache, evict_directory
+
+max_size = getattr(ctools_backend.settings, "source_catalog_max_bytes", 512 * 1024 * 1024)
+directory = getattr(ctools_backend.settings, "source_catalog_directory", None)
+disk_max_size = getattr(ctools_backend.settings, "source_catalog_disk_max_bytes", 4 * 1024 * 1024 * 1024)
+source_srid = getattr(ctools_backend.settings, "source_srid", 4326)
+
+
+def county_key(stfips, ctfips):
+    return "county", int(stfips), int(ctfips)
+
+
+def site_key(sf_id):
+    return "site", int(sf_id)
+
+
+def tile_key(min_lng, min_lat, max_lng, max_lat):
+    return "tile", float(min_lng), float(min_lat), float(max_lng), float(max_lat)
+
+
+def region_criteria(source_class, region):
+    kind = region[0]
+    if kind == "county":
+        (_, stfips, ctfips) = region
+        if hasattr(source_class, "stfips") and hasattr(source_class, "ctfips"):
+            return [source_class.stfips == stfips, source_class.ctfips == ctfips]
+        county_geom = sa.select([models.County.geom]).where(
+            sa.and_(models.County.stfips == stfips, models.County.ctfips == ctfips)).limit(1).as_scalar()
+        return [sa.func.ST_Intersects(source_class.geom, county_geom)]
+    if kind == "site":
+        return [source_class.sf_id == region[1]]
+    if kind == "tile":
+        envelope = sa.func.ST_MakeEnvelope(region[1], region[2], region[3], region[4], source_srid)
+        return [sa.func.ST_Intersects(source_class.geom, envelope)]
+    raise ValueError("Unknown region type: %s" % kind)
+
+
+class SourceCatalog(object):
+
+    def __init__(self, max_size=max_size, directory=directory, disk_max_size=disk_max_size):
+        self.memory = LRUCache(max_size, lambda batch: batch.nbytes)
+        self.directory = directory
+        self.disk_max_size = disk_max_size
+        self.disk_hits = 0
+        self.disk_evictions = 0
+        self.loads = 0
+        self._lock = threading.Lock()
+
+    def _path(self, source_class, region):
+        name = "_".join(str(part) for part in (source_class.__tablename__,) + tuple(region))
+        return os.path.join(self.directory, name + ".pickle")
+
+    def _read_disk(self, source_class, region):
+        if not self.directory:
+            return None
+        path = self._path(source_class, region)
+        try:
+            with open(path, "rb") as f:
+                batch = pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return batch
+
+    def _write_disk(self, source_class, region, batch):
+        if not self.directory:
+            return
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                pass
+        path = self._path(source_class, region)
+        temp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(temp_path, "wb") as f:
+            pickle.dump(batch, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_path, path)
+        self.disk_evictions += evict_directory(self.directory, self.disk_max_size, ".pickle")
+
+    def sources(self, session, source_class, region):
+        key = (source_class.__tablename__,) + tuple(region)
+        batch = self.memory.get(key)
+        if batch is not None:
+            return batch
+        batch = self._read_disk(source_class, region)
+        if batch is not None:
+            self.disk_hits += 1
+        else:
+            batch = source_class.bulk_load(session, *region_criteria(source_class, region))
+            batch.project()
+            self.loads += 1
+            with self._lock:
+                self._write_disk(source_class, region, batch)
+        return self.memory.put(key, batch)
+
+    def invalidate(self, source_class=None, region=None):
+        prefix = ()
+        if source_class is not None:
+            prefix = (source_class.__tablename__,) + (tuple(region) if region is not None else ())
+        for key in self.memory.keys():
+            if key[:len(prefix)] == prefix:
+                self.memory.pop(key)
+        if self.directory and os.path.isdir(self.directory):
+            name_prefix = "_".join(str(part) for part in prefix)
+            for filename in os.listdir(self.directory):
+                if not filename.endswith(".pickle"):
+                    continue
+                if not prefix or filename == name_prefix + ".pickle" or filename.startswith(name_prefix + "_"):
+                    try:
+                        os.remove(os.path.join(self.directory, filename))
+                    except OSError:
+                        pass
+
+    @property
+    def stats(self):
+        stats = self.memory.stats
+        stats["disk_hits"] = self.disk_hits
+        stats["disk_evictions"] = self.disk_evictions
+        stats["loads"] = self.loads
+        return stats
+
+
+catalog = SourceCatalog()
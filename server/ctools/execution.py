@@ -0,0 +1,126 @@
+import os
+import shutil
+import subprocess
+import time
+
+import ctools_backend.settings
+from ctools import ingest
+
+model_command = getattr(ctools_backend.settings, "model_command", None)
+model_parallelism = getattr(ctools_backend.settings, "model_parallelism", 5)
+poll_interval = getattr(ctools_backend.settings, "model_poll_interval", 0.1)
+
+# The model rewrites these as it runs, so every process gets its own copy rather than a link.
+rewritten_inputs = ["receptors.csv", "CTOOLS_Inputs.txt"]
+
+
+def command(run, output_directory, model_source_type=""):
+    if not model_command:
+        raise RuntimeError("model_command is not configured")
+    return [arg.format(output_directory=output_directory, mode=run.mode_name, source_type=model_source_type)
+            for arg in model_command]
+
+
+def _kill(processes):
+    for (process, _, _) in processes:
+        if process.poll() is None:
+            process.kill()
+    for (process, _, _) in processes:
+        process.wait()
+
+
+def _work_directory(output_directory, model_source_type):
+    # Processes for different source types run side by side, so each one works in a private directory
+    # holding the run's inputs instead of rewriting the shared ones under the others.
+    work_directory = os.path.join(output_directory, "work_%s" % model_source_type)
+    shutil.rmtree(work_directory, ignore_errors=True)
+    os.mkdir(work_directory)
+    for name in os.listdir(output_directory):
+        path = os.path.join(output_directory, name)
+        if not os.path.isfile(path) or name.startswith("results_"):
+            continue
+        target = os.path.join(work_directory, name)
+        if name in rewritten_inputs:
+            shutil.copy(path, target)
+            continue
+        try:
+            os.link(path, target)
+        except OSError:
+            shutil.copy(path, target)
+    return work_directory
+
+
+def _publish_inputs(output_directory, work_directory):
+    for name in rewritten_inputs:
+        if os.path.isfile(os.path.join(work_directory, name)):
+            shutil.copy(os.path.join(work_directory, name), os.path.join(output_directory, name))
+
+
+def run_model(run, parallelism=model_parallelism, poll_interval=poll_interval):
+    scenario_outputs = run.scenario_outputs
+    source_types = [t for (t, _, _) in run.source_types]
+    pending = []
+    reused_outputs = {}
+    for (index, (scenario, output_directory)) in enumerate(scenario_outputs):
+        reused = run.reused_source_types(scenario)
+        for (source_type, model_source_type, path) in run.source_outputs(scenario):
+            if source_type in reused:
+                reused_outputs.setdefault(index, []).append((output_directory, source_type, model_source_type, path))
+            else:
+                pending.append((index, output_directory, source_type, model_source_type, path))
+    pending.reverse()
+
+    concentrations = [None] * len(scenario_outputs)
+
+    def start_ingest(index):
+        # Outputs are keyed by the receptors file as the model rewrote it, so a scenario's receptors are read
+        # once its first process has published that file, or up front when none of its source types are modeled.
+        scenario = scenario_outputs[index][0]
+        receptors = run._load_receptors_file(scenario)
+        concentrations[index] = ingest.ConcentrationSet(receptors, source_types)
+        reused = reused_outputs.pop(index, [])
+        if reused and not run.carried_receptors_match(scenario, receptors):
+            # Carried values are keyed by the base run's receptors, so they are modeled again instead.
+            for (output_directory, source_type, model_source_type, path) in reused:
+                pending.insert(0, (index, output_directory, source_type, model_source_type, path))
+            return
+        for (_, source_type, _, path) in reused:
+            concentrations[index].add_file(source_type, path, run.model_field)
+
+    for index in range(len(scenario_outputs)):
+        if not any(entry[0] == index for entry in pending):
+            start_ingest(index)
+
+    work_directories = []
+    running = []
+    try:
+        while pending or running:
+            while pending and len(running) < max(parallelism, 1):
+                (index, output_directory, source_type, model_source_type, path) = pending.pop()
+                work_directory = _work_directory(output_directory, model_source_type)
+                work_directories.append(work_directory)
+                args = command(run, work_directory, model_source_type)
+                process = subprocess.Popen(args, cwd=work_directory)
+                running.append((process, args, (index, output_directory, work_directory, source_type, path)))
+            finished = [entry for entry in running if entry[0].poll() is not None]
+            if running and not finished:
+                time.sleep(poll_interval)
+                continue
+            for entry in finished:
+                running.remove(entry)
+                (process, args, (index, output_directory, work_directory, source_type, path)) = entry
+                if process.returncode:
+                    raise subprocess.CalledProcessError(process.returncode, args)
+                if concentrations[index] is None:
+                    # The other processes only touch their own copies, so the shared inputs can be replaced now.
+                    _publish_inputs(output_directory, work_directory)
+                    start_ingest(index)
+                work_path = os.path.join(work_directory, os.path.basename(path))
+                if os.path.isfile(work_path):
+                    os.rename(work_path, path)
+                    concentrations[index].add_file(source_type, path, run.model_field)
+    finally:
+        _kill(running)
+        for work_directory in work_directories:
+            shutil.rmtree(work_directory, ignore_errors=True)
+    return [(c.receptors, c.as_dict()) for c in concentrations]
@@ -0,0 +1,89 @@
+import numpy
+from pyproj import Transformer
+
+import ctools_backend.settings
+from ctools_common import geo
+
+geographic_crs = getattr(ctools_backend.settings, "geographic_crs", "EPSG:4326")
+# The Lambert conformal conic grid the model runs on, as ctools_common.geo defines it.
+lcc_crs = getattr(ctools_backend.settings, "lcc_crs", None) or getattr(geo, "lcc_crs", None)
+projection_tolerance = getattr(ctools_backend.settings, "projection_tolerance", 0.01)
+
+# Points spread over the contiguous US that the array projections are checked against geo on.
+check_lng = numpy.array([-124.2, -117.2, -104.9, -97.0, -87.6, -80.2, -71.1, -68.8])
+check_lat = numpy.array([47.6, 32.7, 39.7, 40.0, 41.9, 25.8, 42.4, 46.9])
+
+_transformers = {}
+
+
+def _check(forward, inverse):
+    # A grid that differs from geo's would misplace every receptor without any error, so refuse it outright.
+    expected = numpy.array([geo.mercator_to_lcc(a, b) for (a, b) in zip(check_lng, check_lat)], dtype=numpy.float64)
+    projected = numpy.column_stack(forward.transform(check_lng, check_lat))
+    (lng, lat) = inverse.transform(expected[:, 0], expected[:, 1])
+    returned = numpy.array([geo.mercator_to_lcc(a, b) for (a, b) in zip(lng, lat)], dtype=numpy.float64)
+    error = max(numpy.abs(projected - expected).max(), numpy.abs(returned - expected).max())
+    if not error <= projection_tolerance:
+        raise ValueError("lcc_crs %r is %.3g m off the ctools_common.geo projection" % (lcc_crs, error))
+
+
+def _transformer(source, target):
+    if not _transformers:
+        if lcc_crs is None:
+            raise ValueError("ctools_common.geo does not name its grid; set lcc_crs to it")
+        forward = Transformer.from_crs(geographic_crs, lcc_crs, always_xy=True)
+        inverse = Transformer.from_crs(lcc_crs, geographic_crs, always_xy=True)
+        _check(forward, inverse)
+        _transformers[(geographic_crs, lcc_crs)] = forward
+        _transformers[(lcc_crs, geographic_crs)] = inverse
+    return _transformers[(source, target)]
+
+
+def _project(source, target, a, b):
+    a = numpy.asarray(a, dtype=numpy.float64)
+    b = numpy.asarray(b, dtype=numpy.float64)
+    if not a.size:
+        return numpy.empty_like(a), numpy.empty_like(b)
+    (c, d) = _transformer(source, target).transform(a, b)
+    return numpy.asarray(c, dtype=numpy.float64), numpy.asarray(d, dtype=numpy.float64)
+
+
+def mercator_to_lcc(lng, lat):
+    return _project(geographic_crs, lcc_crs, lng, lat)
+
+
+def lcc_to_mercator(x, y):
+    return _project(lcc_crs, geographic_crs, x, y)
+
+
+def distance_on_unit_sphere(lat1, lng1, lat2, lng2):
+    phi1 = numpy.radians(90.0 - numpy.asarray(lat1, dtype=numpy.float64))
+    phi2 = numpy.radians(90.0 - numpy.asarray(lat2, dtype=numpy.float64))
+    theta1 = numpy.radians(numpy.asarray(lng1, dtype=numpy.float64))
+    theta2 = numpy.radians(numpy.asarray(lng2, dtype=numpy.float64))
+    cos = numpy.sin(phi1) * numpy.sin(phi2) * numpy.cos(theta1 - theta2) + numpy.cos(phi1) * numpy.cos(phi2)
+    return numpy.arccos(numpy.clip(cos, -1, 1))
+
+
+def unit_vectors(lng, lat):
+    # Chord length between unit vectors grows monotonically with great-circle distance.
+    lng = numpy.radians(numpy.asarray(lng, dtype=numpy.float64))
+    lat = numpy.radians(numpy.asarray(lat, dtype=numpy.float64))
+    cos_lat = numpy.cos(lat)
+    return numpy.stack([cos_lat * numpy.cos(lng), cos_lat * numpy.sin(lng), numpy.sin(lat)], axis=-1)
+
+
+def bounds(lng, lat):
+    lng = numpy.asarray(lng, dtype=numpy.float64)
+    lat = numpy.asarray(lat, dtype=numpy.float64)
+    if not lng.size:
+        return None
+    return [float(lng.min()), float(lat.min()), float(lng.max()), float(lat.max())]
+
+
+def merge_bounds(*all_bounds):
+    all_bounds = [b for b in all_bounds if b is not None]
+    if not all_bounds:
+        return None
+    return [min(b[0] for b in all_bounds), min(b[1] for b in all_bounds),
+            max(b[2] for b in all_bounds), max(b[3] for b in all_bounds)]
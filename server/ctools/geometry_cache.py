@@ -0,0 +1,201 @@
+import numpy
+
+import ctools_backend.settings
+
+zooms = sorted(getattr(ctools_backend.settings, "geometry_cache_zooms", [4, 7, 10, 13, 16]))
+tile_size = 256
+
+
+def tolerance(zoom):
+    # Half a pixel of longitude at the given zoom.
+    return 180.0 / (tile_size * 2 ** zoom)
+
+
+def quantum(zoom):
+    return tolerance(zoom) / 4
+
+
+def level_for_zoom(zoom, levels=zooms):
+    # The coarsest level whose error is still under half a pixel at the requested zoom.
+    for level in levels:
+        if level >= zoom:
+            return level
+    return levels[-1]
+
+
+def encode_varints(values):
+    values = numpy.asarray(values, dtype=numpy.int64)
+    zigzag = ((values << 1) ^ (values >> 63)).astype(numpy.uint64)
+    groups = (zigzag[:, None] >> (7 * numpy.arange(10, dtype=numpy.uint64))) & numpy.uint64(0x7f)
+    lengths = numpy.maximum(1, 10 - numpy.argmax(groups[:, ::-1] != 0, axis=1))
+    lengths[~(groups != 0).any(axis=1)] = 1
+    position = numpy.arange(10)
+    groups[position < (lengths - 1)[:, None]] |= numpy.uint64(0x80)
+    return groups[position < lengths[:, None]].astype(numpy.uint8).tobytes()
+
+
+def decode_varints(data):
+    data = numpy.frombuffer(data, dtype=numpy.uint8)
+    if not len(data):
+        return numpy.empty(0, dtype=numpy.int64)
+    ends = numpy.flatnonzero(data < 0x80)
+    starts = numpy.r_[0, ends[:-1] + 1]
+    position = numpy.arange(len(data)) - numpy.repeat(starts, ends - starts + 1)
+    parts = (data & 0x7f).astype(numpy.uint64) << (7 * position).astype(numpy.uint64)
+    zigzag = numpy.add.reduceat(parts, starts)
+    return ((zigzag >> numpy.uint64(1)).astype(numpy.int64) ^ -(zigzag & numpy.uint64(1)).astype(numpy.int64))
+
+
+def encode(polygons):
+    # polygon count, then per polygon its ring count, then per ring its point count followed by
+    # the ring's open (unclosed) points as deltas from the previous point written.
+    values = [numpy.array([len(polygons)])]
+    previous = numpy.zeros(2, dtype=numpy.int64)
+    for rings in polygons:
+        values.append(numpy.array([len(rings)]))
+        for ring in rings:
+            deltas = numpy.diff(numpy.vstack([previous, ring]), axis=0)
+            values.append(numpy.array([len(ring)]))
+            values.append(deltas.ravel())
+            previous = ring[-1]
+    return encode_varints(numpy.concatenate(values))
+
+
+def decode(data, zoom):
+    values = decode_varints(data)
+    scale = quantum(zoom)
+    polygons = []
+    previous = numpy.zeros(2, dtype=numpy.int64)
+    offset = 1
+    for _ in range(int(values[0]) if len(values) else 0):
+        rings = []
+        ring_count = int(values[offset])
+        offset += 1
+        for _ in range(ring_count):
+            count = int(values[offset])
+            deltas = values[offset + 1:offset + 1 + 2 * count].reshape(count, 2)
+            offset += 1 + 2 * count
+            points = previous + numpy.cumsum(deltas, axis=0)
+            previous = points[-1]
+            rings.append((numpy.vstack([points, points[:1]]) * scale).tolist())
+        polygons.append(rings)
+    return polygons
+
+
+def _douglas_peucker(points, tolerance):
+    keep = numpy.zeros(len(points), dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        (first, last) = stack.pop()
+        if last - first < 2:
+            continue
+        (start, end) = (points[first], points[last])
+        segment = end - start
+        inner = points[first + 1:last] - start
+        length = numpy.dot(segment, segment)
+        if length:
+            along = numpy.clip(numpy.dot(inner, segment) / length, 0, 1)
+            inner = inner - along[:, None] * segment
+        distances = numpy.hypot(inner[:, 0], inner[:, 1])
+        farthest = int(numpy.argmax(distances))
+        if distances[farthest] > tolerance:
+            index = first + 1 + farthest
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return keep
+
+
+def _open_rings(coordinates, ring_offsets, scale):
+    # Quantized rings without their closing point or repeated consecutive points.
+    quantized = numpy.round(coordinates / scale).astype(numpy.int64)
+    rings = []
+    for (start, end) in zip(ring_offsets[:-1], ring_offsets[1:]):
+        ring = quantized[start:end]
+        if len(ring):
+            ring = ring[numpy.r_[True, (ring[1:] != ring[:-1]).any(axis=1)]]
+            if len(ring) > 1 and (ring[0] == ring[-1]).all():
+                ring = ring[:-1]
+        rings.append(ring)
+    return rings
+
+
+def _junctions(rings):
+    # A vertex is a junction when its neighbours differ between the rings passing through it, i.e. where
+    # a boundary shared by two block groups starts or ends. Rings are only split at junctions, so both sides
+    # of a shared boundary are simplified from the same anchors and stay coincident.
+    lengths = numpy.array([len(ring) for ring in rings])
+    if not lengths.sum():
+        return [numpy.zeros(0, dtype=bool) for _ in rings], [numpy.zeros(0, dtype=numpy.int64) for _ in rings]
+    points = numpy.concatenate([ring for ring in rings if len(ring)])
+    (_, ids) = numpy.unique(points, axis=0, return_inverse=True)
+    ids = ids.ravel()
+    offsets = numpy.r_[0, numpy.cumsum(lengths)]
+    previous = numpy.empty_like(ids)
+    following = numpy.empty_like(ids)
+    for (start, end) in zip(offsets[:-1], offsets[1:]):
+        previous[start:end] = numpy.roll(ids[start:end], 1)
+        following[start:end] = numpy.roll(ids[start:end], -1)
+    neighbours = numpy.column_stack([ids, numpy.minimum(previous, following), numpy.maximum(previous, following)])
+    distinct = numpy.unique(neighbours, axis=0)
+    junction_ids = numpy.flatnonzero(numpy.bincount(distinct[:, 0], minlength=ids.max() + 1) > 1)
+    junctions = numpy.isin(ids, junction_ids)
+    return ([junctions[start:end] for (start, end) in zip(offsets[:-1], offsets[1:])],
+            [ids[start:end] for (start, end) in zip(offsets[:-1], offsets[1:])])
+
+
+def _simplify_ring(ring, junctions, ids, tolerance):
+    if len(ring) < 3:
+        return None
+    anchors = numpy.flatnonzero(junctions)
+    if not len(anchors):
+        # A ring sharing no junctions is anchored at its lowest vertex and the vertex farthest from it,
+        # which every ring tracing the same loop agrees on.
+        first = int(numpy.argmin(ids))
+        offsets = ring - ring[first]
+        anchors = numpy.array([first, int(numpy.argmax((offsets * offsets).sum(axis=1)))])
+        anchors.sort()
+    ring = numpy.roll(ring, -anchors[0], axis=0)
+    ids = numpy.roll(ids, -anchors[0])
+    anchors = numpy.r_[anchors - anchors[0], len(ring)]
+    closed = numpy.vstack([ring, ring[:1]]).astype(numpy.float64)
+    closed_ids = numpy.r_[ids, ids[:1]].tolist()
+    keep = numpy.zeros(len(closed), dtype=bool)
+    for (start, end) in zip(anchors[:-1], anchors[1:]):
+        # The neighbouring ring walks a shared arc the other way round; simplifying every arc in one
+        # canonical direction keeps the two results identical.
+        arc_ids = closed_ids[start:end + 1]
+        if arc_ids[::-1] < arc_ids:
+            keep[start:end + 1] |= _douglas_peucker(closed[start:end + 1][::-1], tolerance)[::-1]
+        else:
+            keep[start:end + 1] |= _douglas_peucker(closed[start:end + 1], tolerance)
+    simplified = ring[keep[:-1]]
+    if len(simplified) < 3:
+        # Collapsed to a line: the ring is narrower than the tolerance and would not show anyway.
+        return None
+    return simplified
+
+
+def simplify(coordinates, geometry_offsets, polygon_offsets, ring_offsets, zoom):
+    scale = quantum(zoom)
+    rings = _open_rings(coordinates, ring_offsets, scale)
+    (junctions, ids) = _junctions(rings)
+    simplified = [_simplify_ring(ring, junction, ring_ids, tolerance(zoom) / scale)
+                  for (ring, junction, ring_ids) in zip(rings, junctions, ids)]
+    geometries = []
+    for (first_polygon, last_polygon) in zip(geometry_offsets[:-1], geometry_offsets[1:]):
+        polygons = []
+        for polygon in range(first_polygon, last_polygon):
+            exterior = polygon_offsets[polygon]
+            if simplified[exterior] is None:
+                # A subpixel exterior takes its holes with it.
+                continue
+            polygons.append([simplified[ring] for ring in range(exterior, polygon_offsets[polygon + 1])
+                             if simplified[ring] is not None])
+        geometries.append(polygons)
+    return geometries
+
+
+def vertex_count(polygons):
+    return sum(len(ring) for rings in polygons for ring in rings)
@@ -0,0 +1,121 @@
+import hashlib
+import io
+import os
+
+import numpy
+import scipy.sparse
+from scipy.spatial import Delaunay
+
+import ctools_backend.settings
+from ctools.cache import DiskCache, LRUCache
+
+directory = getattr(ctools_backend.settings, "gridding_cache_directory",
+                    os.path.join(ctools_backend.settings.scenario_run_directory, "gridding"))
+max_size = getattr(ctools_backend.settings, "gridding_cache_max_bytes", 256 * 1024 * 1024)
+memory_max_size = getattr(ctools_backend.settings, "gridding_memory_cache_max_bytes", 128 * 1024 * 1024)
+
+
+class Gridder(object):
+
+    def __init__(self, shape, pixels, vertices, weights, point_count):
+        self.shape = tuple(shape)
+        self.pixels = pixels
+        self.vertices = vertices
+        self.weights = weights
+        self.point_count = point_count
+        # One row per pixel inside the triangulation, holding the barycentric weights of its triangle's corners.
+        self.matrix = scipy.sparse.csr_matrix(
+            (weights.ravel(), vertices.ravel(), numpy.arange(0, 3 * len(pixels) + 1, 3)),
+            shape=(len(pixels), point_count))
+
+    @classmethod
+    def build(cls, lng, lat, bounds, width, height):
+        lng = numpy.asarray(lng, dtype=numpy.float64)
+        lat = numpy.asarray(lat, dtype=numpy.float64)
+        (min_lng, min_lat, max_lng, max_lat) = bounds
+        # Pixel centres, north-up, in a plane scaled so triangles are not stretched at high latitudes.
+        scale = numpy.cos(numpy.radians((min_lat + max_lat) / 2.0))
+        pixel_lng = min_lng + (numpy.arange(width) + 0.5) * (max_lng - min_lng) / width
+        pixel_lat = max_lat - (numpy.arange(height) + 0.5) * (max_lat - min_lat) / height
+        (pixel_lng, pixel_lat) = numpy.meshgrid(pixel_lng, pixel_lat)
+        pixels = numpy.empty(0, dtype=numpy.int64)
+        vertices = numpy.empty((0, 3), dtype=numpy.int32)
+        weights = numpy.empty((0, 3), dtype=numpy.float64)
+        if len(lng) >= 3:
+            try:
+                triangulation = Delaunay(numpy.column_stack([lng * scale, lat]))
+            except RuntimeError:
+                # Fewer than three distinct points, or all of them on one line.
+                triangulation = None
+            if triangulation is not None:
+                points = numpy.column_stack([pixel_lng.ravel() * scale, pixel_lat.ravel()])
+                simplices = triangulation.find_simplex(points)
+                pixels = numpy.flatnonzero(simplices >= 0)
+                simplices = simplices[pixels]
+                transform = triangulation.transform[simplices]
+                partial = numpy.einsum("ijk,ik->ij", transform[:, :2], points[pixels] - transform[:, 2])
+                weights = numpy.column_stack([partial, 1 - partial.sum(axis=1)])
+                vertices = triangulation.simplices[simplices].astype(numpy.int32)
+        return cls((height, width), pixels, vertices, weights, len(lng))
+
+    def grid(self, values):
+        values = numpy.asarray(values, dtype=numpy.float64)
+        if len(values) != self.point_count:
+            raise ValueError("Expected %d values, got %d" % (self.point_count, len(values)))
+        columns = values.reshape(self.point_count, -1)
+        result = numpy.full((self.shape[0] * self.shape[1], columns.shape[1]), numpy.nan)
+        result[self.pixels] = self.matrix.dot(columns)
+        return result.reshape(self.shape + values.shape[1:])
+
+    @property
+    def nbytes(self):
+        return (self.pixels.nbytes + self.vertices.nbytes + self.weights.nbytes +
+                self.matrix.data.nbytes + self.matrix.indices.nbytes + self.matrix.indptr.nbytes)
+
+    def dumps(self):
+        output = io.BytesIO()
+        numpy.savez(output, shape=numpy.array(self.shape), pixels=self.pixels, vertices=self.vertices,
+                    weights=self.weights, point_count=numpy.array(self.point_count))
+        return output.getvalue()
+
+    @classmethod
+    def loads(cls, data):
+        arrays = numpy.load(io.BytesIO(data))
+        return cls(arrays["shape"], arrays["pixels"], arrays["vertices"], arrays["weights"],
+                   int(arrays["point_count"]))
+
+
+def layout_key(lng, lat, bounds, width, height):
+    digest = hashlib.sha1()
+    digest.update(numpy.ascontiguousarray(lng, dtype=numpy.float64).tobytes())
+    digest.update(numpy.ascontiguousarray(lat, dtype=numpy.float64).tobytes())
+    digest.update(repr((tuple(float(b) for b in bounds), int(width), int(height))).encode("ascii"))
+    return digest.hexdigest()
+
+
+class GridderCache(object):
+
+    def __init__(self, directory=directory, max_size=max_size, memory_max_size=memory_max_size):
+        self.disk = DiskCache(directory, max_size, ".npz")
+        self.memory = LRUCache(memory_max_size, lambda gridder: gridder.nbytes)
+
+    def get(self, lng, lat, bounds, width, height):
+        # Keyed by the receptor layout itself, so every column of a run and every run sharing a layout reuse it.
+        key = layout_key(lng, lat, bounds, width, height)
+        gridder = self.memory.get(key)
+        if gridder is None:
+            data = self.disk.get(key)
+            if data is not None:
+                gridder = Gridder.loads(data)
+            else:
+                gridder = Gridder.build(lng, lat, bounds, width, height)
+                self.disk.put(key, gridder.dumps())
+            self.memory.put(key, gridder)
+        return gridder
+
+    @property
+    def stats(self):
+        return {"memory": self.memory.stats, "disk": self.disk.stats}
+
+
+cache = GridderCache()
@@ -0,0 +1,70 @@
+import numpy
+
+chunk_size = 4 * 1024 * 1024
+
+
+def _parse_lines(lines, column):
+    data = numpy.loadtxt(lines, delimiter=",", usecols=(0, column), ndmin=2)
+    return data[:, 0].astype(numpy.int64), data[:, 1]
+
+
+def read_concentration_column(path, column, chunk_size=chunk_size):
+    id_chunks = []
+    value_chunks = []
+    with open(path) as output_file:
+        output_file.readline()
+        remainder = ""
+        while True:
+            chunk = output_file.read(chunk_size)
+            if not chunk:
+                break
+            chunk = remainder + chunk
+            end = chunk.rfind("\n") + 1
+            if not end:
+                remainder = chunk
+                continue
+            remainder = chunk[end:]
+            lines = [line for line in chunk[:end].splitlines() if line.strip()]
+            if lines:
+                (ids, values) = _parse_lines(lines, column)
+                id_chunks.append(ids)
+                value_chunks.append(values)
+        if remainder.strip():
+            (ids, values) = _parse_lines([remainder], column)
+            id_chunks.append(ids)
+            value_chunks.append(values)
+    if not id_chunks:
+        return numpy.empty(0, dtype=numpy.int64), numpy.empty(0, dtype=numpy.float64)
+    return numpy.concatenate(id_chunks), numpy.concatenate(value_chunks)
+
+
+class ConcentrationSet(object):
+
+    def __init__(self, receptors, source_types):
+        self.receptors = receptors
+        self.values = {}
+        for source_type in source_types:
+            self.values[source_type] = numpy.empty(len(receptors))
+            self.values[source_type].fill(numpy.nan)
+        self.total = numpy.zeros(len(receptors))
+        self.present = numpy.zeros(len(receptors), dtype=bool)
+
+    def add(self, source_type, receptor_ids, values):
+        indices = self.receptors.indices_of(receptor_ids)
+        column = self.values[source_type]
+        previous = column[indices]
+        previous[numpy.isnan(previous)] = 0
+        self.total[indices] += values - previous
+        column[indices] = values
+        self.present[indices] = True
+
+    def add_file(self, source_type, path, column):
+        (receptor_ids, values) = read_concentration_column(path, column)
+        self.add(source_type, receptor_ids, values)
+
+    def as_dict(self):
+        concentrations = dict(self.values)
+        total = self.total.copy()
+        total[~self.present] = numpy.nan
+        concentrations["total"] = total
+        return concentrations
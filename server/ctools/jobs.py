@@ -0,0 +1,160 @@
+import datetime
+import logging
+import multiprocessing
+import time
+import traceback
+
+import ctools_backend.settings
+from ctools import execution, models, tiles
+
+concurrency = getattr(ctools_backend.settings, "worker_concurrency", None) or multiprocessing.cpu_count()
+max_attempts = getattr(ctools_backend.settings, "worker_max_attempts", 3)
+poll_interval = getattr(ctools_backend.settings, "worker_poll_interval", 1.0)
+
+finished_statuses = ("completed", "failed")
+
+logger = logging.getLogger(__name__)
+
+
+def submit(session, run):
+    session.add(run)
+    run.status = "queued"
+    run.last_update = datetime.datetime.now()
+    session.flush()
+    job = models.RunJob(run)
+    session.add(job)
+    session.commit()
+    return job
+
+
+def _step(session, job, status):
+    job.transition(status)
+    session.commit()
+
+
+def execute(job_id):
+    session = models.Session()
+    try:
+        job = session.query(models.RunJob).get(job_id)
+        run = job.load_run(session)
+        try:
+            _step(session, job, "preparing")
+            run.prepare_run()
+            if run.status == "completed":
+                _step(session, job, "completed")
+                return
+            _step(session, job, "modeling")
+            results = execution.run_model(run)
+            _step(session, job, "finalizing")
+            run.finalize_run(results=results)
+            _step(session, job, "packaging")
+            # The result store only goes live once the data points commit, so tiles are rendered after that. They
+            # are only a warm cache, so failing to render them must not fail a run whose results are committed.
+            try:
+                tiles.cache.prerender(run)
+            except Exception:
+                # Nothing is pending since the packaging step committed, so this only clears a failed query.
+                session.rollback()
+                logger.exception("Prerendering tiles for %s %s failed", run.__tablename__, run.scenario_run_id)
+            run.create_package()
+            _step(session, job, "completed")
+        except Exception:
+            session.rollback()
+            job = session.query(models.RunJob).get(job_id)
+            run = job.load_run(session)
+            run.failed()
+            run.discard_outputs()
+            job.transition("failed", traceback.format_exc())
+            session.commit()
+    finally:
+        models.Session.remove()
+
+
+class WorkerPool(object):
+
+    def __init__(self, concurrency=concurrency, max_attempts=max_attempts, poll_interval=poll_interval):
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.workers = {}
+
+    def _requeue(self, session, job, reason):
+        run = job.load_run(session)
+        # The next attempt prepares a fresh output directory, so the dead worker's one would be orphaned.
+        run.discard_outputs()
+        if job.attempts >= self.max_attempts:
+            run.failed()
+            job.transition("failed", reason)
+        else:
+            run.status = "queued"
+            run.last_update = datetime.datetime.now()
+            job.transition("queued", reason)
+
+    def recover(self):
+        session = models.Session()
+        try:
+            orphaned = session.query(models.RunJob).filter(
+                ~models.RunJob.status.in_(finished_statuses + ("queued",))).all()
+            for job in orphaned:
+                if job.job_id not in self.workers:
+                    self._requeue(session, job, "worker lost before the job finished")
+            session.commit()
+        finally:
+            models.Session.remove()
+
+    def _reap(self, session):
+        for (job_id, worker) in list(self.workers.items()):
+            if worker.is_alive():
+                continue
+            worker.join()
+            del self.workers[job_id]
+            job = session.query(models.RunJob).get(job_id)
+            session.refresh(job)
+            if job.status not in finished_statuses:
+                self._requeue(session, job, "worker exited with code %s" % worker.exitcode)
+        session.commit()
+
+    def _claim(self, session, count):
+        jobs = session.query(models.RunJob).filter(models.RunJob.status == "queued")\
+            .order_by(models.RunJob.job_id).with_for_update(skip_locked=True).limit(count).all()
+        for job in jobs:
+            job.attempts = (job.attempts or 0) + 1
+            job.transition("starting")
+        session.commit()
+        return [job.job_id for job in jobs]
+
+    def _start(self, job_ids):
+        # Forked workers must not inherit pooled connections from the dispatcher.
+        models.Session.remove()
+        models.engine.dispose()
+        started = {}
+        for job_id in job_ids:
+            worker = multiprocessing.Process(target=execute, args=(job_id,))
+            worker.start()
+            self.workers[job_id] = worker
+            started[job_id] = worker.pid
+        session = models.Session()
+        try:
+            for (job_id, pid) in started.items():
+                session.query(models.RunJob).get(job_id).worker_pid = pid
+            session.commit()
+        finally:
+            models.Session.remove()
+
+    def run_once(self):
+        session = models.Session()
+        try:
+            self._reap(session)
+            free = self.concurrency - len(self.workers)
+            job_ids = self._claim(session, free) if free > 0 else []
+        finally:
+            models.Session.remove()
+        if job_ids:
+            self._start(job_ids)
+        return len(job_ids)
+
+    def run_forever(self):
+        self.recover()
+        while True:
+            self.run_once()
+            time.sleep(self.poll_interval)
@@ -0,0 +1,100 @@
+import numpy
+
+import ctools_backend.settings
+
+tolerance = getattr(ctools_backend.settings, "receptor_match_tolerance", 0.01)
+
+
+def match_points(x1, y1, x2, y2, tolerance=tolerance):
+    x1 = numpy.asarray(x1, dtype=numpy.float64)
+    y1 = numpy.asarray(y1, dtype=numpy.float64)
+    x2 = numpy.asarray(x2, dtype=numpy.float64)
+    y2 = numpy.asarray(y2, dtype=numpy.float64)
+    no_matches = (numpy.empty(0, dtype=numpy.int64), numpy.empty(0, dtype=numpy.int64))
+    if not len(x1) or not len(x2):
+        return no_matches
+
+    # Hash both point sets onto a grid of tolerance-sized cells; anything within tolerance of a
+    # point lies in its own cell or one of the eight around it.
+    cx1 = numpy.floor(x1 / tolerance).astype(numpy.int64)
+    cy1 = numpy.floor(y1 / tolerance).astype(numpy.int64)
+    cx2 = numpy.floor(x2 / tolerance).astype(numpy.int64)
+    cy2 = numpy.floor(y2 / tolerance).astype(numpy.int64)
+    min_cx = min(cx1.min(), cx2.min()) - 1
+    min_cy = min(cy1.min(), cy2.min()) - 1
+    span = max(cy1.max(), cy2.max()) - min_cy + 2
+
+    keys_2 = (cx2 - min_cx) * span + (cy2 - min_cy)
+    order_2 = numpy.argsort(keys_2, kind="mergesort")
+    sorted_keys_2 = keys_2[order_2]
+    (unique_keys, first, counts) = numpy.unique(sorted_keys_2, return_index=True, return_counts=True)
+
+    candidates_1 = []
+    candidates_2 = []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            keys_1 = (cx1 + dx - min_cx) * span + (cy1 + dy - min_cy)
+            positions = numpy.minimum(numpy.searchsorted(unique_keys, keys_1), len(unique_keys) - 1)
+            found = numpy.flatnonzero(unique_keys[positions] == keys_1)
+            for rank in range(counts[positions[found]].max() if len(found) else 0):
+                in_cell = found[counts[positions[found]] > rank]
+                candidates_1.append(in_cell)
+                candidates_2.append(order_2[first[positions[in_cell]] + rank])
+    if not candidates_1:
+        return no_matches
+    candidates_1 = numpy.concatenate(candidates_1)
+    candidates_2 = numpy.concatenate(candidates_2)
+    distances = numpy.hypot(x1[candidates_1] - x2[candidates_2], y1[candidates_1] - y2[candidates_2])
+    close = distances <= tolerance
+    (candidates_1, candidates_2, distances) = (candidates_1[close], candidates_2[close], distances[close])
+
+    # Resolve many-to-many candidates greedily, closest pairs first, so each point matches at most once. A pair
+    # that is the closest remaining one for both of its points is taken by the sequential greedy walk no matter
+    # what precedes it, so every such pair is accepted at once; pairs touching an accepted point are dropped and
+    # the rest go round again, which lets a point that lost its best candidate fall back to the next one.
+    order = numpy.argsort(distances, kind="mergesort")
+    (candidates_1, candidates_2) = (candidates_1[order], candidates_2[order])
+    matched_1 = []
+    matched_2 = []
+    used_1 = numpy.zeros(len(x1), dtype=bool)
+    used_2 = numpy.zeros(len(x2), dtype=bool)
+    first_1 = numpy.empty(len(x1), dtype=numpy.int64)
+    first_2 = numpy.empty(len(x2), dtype=numpy.int64)
+    while len(candidates_1):
+        # Each point holds the position of its closest remaining pair.
+        positions = numpy.arange(len(candidates_1))
+        first_1[candidates_1] = len(positions)
+        first_2[candidates_2] = len(positions)
+        numpy.minimum.at(first_1, candidates_1, positions)
+        numpy.minimum.at(first_2, candidates_2, positions)
+        best = (first_1[candidates_1] == positions) & (first_2[candidates_2] == positions)
+        matched_1.append(candidates_1[best])
+        matched_2.append(candidates_2[best])
+        used_1[candidates_1[best]] = True
+        used_2[candidates_2[best]] = True
+        remaining = ~(used_1[candidates_1] | used_2[candidates_2])
+        (candidates_1, candidates_2) = (candidates_1[remaining], candidates_2[remaining])
+    if not matched_1:
+        return no_matches
+    (matched_1, matched_2) = (numpy.concatenate(matched_1), numpy.concatenate(matched_2))
+    order = numpy.argsort(matched_1, kind="mergesort")
+    return matched_1[order], matched_2[order]
+
+
+def align(n1, n2, matched_1, matched_2):
+    unmatched_1 = numpy.setdiff1d(numpy.arange(n1), matched_1)
+    unmatched_2 = numpy.setdiff1d(numpy.arange(n2), matched_2)
+    missing_1 = -numpy.ones(len(unmatched_2), dtype=numpy.int64)
+    missing_2 = -numpy.ones(len(unmatched_1), dtype=numpy.int64)
+    rows_1 = numpy.concatenate([matched_1, unmatched_1, missing_1]).astype(numpy.int64)
+    rows_2 = numpy.concatenate([matched_2, missing_2, unmatched_2]).astype(numpy.int64)
+    return rows_1, rows_2
+
+
+def take(values, rows, fill=numpy.nan):
+    values = numpy.asarray(values)
+    result = numpy.empty(len(rows), dtype=numpy.result_type(values, fill))
+    result.fill(fill)
+    present = rows >= 0
+    result[present] = values[rows[present]]
+    return result
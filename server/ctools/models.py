@@ -1,16 +1,16 @@
-import tablib
-
 from ctools_common.geo import point_wkt_to_array
 
 __author__ = 'nathan'
 
 import uuid
+import csv
+import logging
 import os
-import tempfile
+import hashlib
+import json
 import shutil
-import subprocess
+import sys
 from collections import namedtuple
-import glob
 import time
 import numpy
 import datetime
@@ -23,11 +23,17 @@ from sqlalchemy.dialects.postgresql import JSON
 from geoalchemy2 import Geometry
 
 from ctools_common import geo
+from ctools import (bulk, geo_arrays, geometry_cache, gridding, ingest, matching, notifications, packaging,
+                    point_query, result_store, segmentation, source_codec, source_edits, source_table, tiles, wkb,
+                    zonal)
 import ctools_backend.settings
 
+logger = logging.getLogger(__name__)
+
 engine = sa.create_engine(ctools_backend.settings.connection_string)
 Base = declarative_base(metadata=sa.MetaData(bind=engine))
 Session = orm.scoped_session(orm.sessionmaker(bind=engine))
+status_channel = notifications.StatusChannel(engine)
 
 
 def null_data(d):
@@ -37,6 +43,14 @@ def null_data(d):
         return d
 
 
+def nan_to_none(d):
+    d = float(d)
+    if d != d:
+        return None
+    else:
+        return d
+
+
 class County(Base):
     __tablename__ = "us_counties"
     gid = sa.Column(sa.Integer, primary_key=True)
@@ -78,6 +92,137 @@ class Receptor(object):
                 instance in instance_tuples]
 
 
+class ReceptorSet(object):
+    fields = Receptor.fields
+
+    def __init__(self, ids, lat=None, lng=None, x=None, y=None):
+        self.id = numpy.asarray(ids, dtype=numpy.int64)
+        if lat is not None and lng is not None:
+            self.lat = numpy.asarray(lat, dtype=numpy.float64)
+            self.lng = numpy.asarray(lng, dtype=numpy.float64)
+            (self.x, self.y) = geo_arrays.mercator_to_lcc(self.lng, self.lat)
+        elif x is not None and y is not None:
+            self.x = numpy.asarray(x, dtype=numpy.float64)
+            self.y = numpy.asarray(y, dtype=numpy.float64)
+            (self.lng, self.lat) = geo_arrays.lcc_to_mercator(self.x, self.y)
+        else:
+            raise ValueError("Must specify either x and y or lat and lng")
+        self._index = None
+        self._order = None
+
+    def __len__(self):
+        return len(self.id)
+
+    def __contains__(self, receptor_id):
+        return int(receptor_id) in self.index
+
+    def __getitem__(self, receptor_id):
+        i = self.index_of(receptor_id)
+        return Receptor.namedtuple_class(int(self.id[i]), float(self.x[i]), float(self.y[i]),
+                                         float(self.lat[i]), float(self.lng[i]))
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = {receptor_id: i for (i, receptor_id) in enumerate(self.id.tolist())}
+        return self._index
+
+    def index_of(self, receptor_id):
+        return self.index[int(receptor_id)]
+
+    def indices_of(self, receptor_ids):
+        receptor_ids = numpy.asarray(receptor_ids, dtype=numpy.int64)
+        if self._order is None:
+            self._order = numpy.argsort(self.id, kind="mergesort")
+        sorted_ids = self.id[self._order]
+        positions = numpy.minimum(numpy.searchsorted(sorted_ids, receptor_ids), max(len(sorted_ids) - 1, 0))
+        if not len(sorted_ids):
+            missing = numpy.ones(receptor_ids.shape, dtype=bool)
+        else:
+            missing = sorted_ids[positions] != receptor_ids
+        if numpy.any(missing):
+            raise KeyError(int(receptor_ids[missing][0]))
+        return self._order[positions]
+
+    @classmethod
+    def from_csv(cls, path):
+        with open(path) as receptor_list:
+            data = numpy.loadtxt(receptor_list, delimiter=",", skiprows=1, usecols=(0, 1, 2), ndmin=2)
+        return cls(data[:, 0], x=data[:, 1], y=data[:, 2])
+
+
+class SourceBatch(object):
+
+    def __init__(self, source_class, columns, coordinates, geometry_offsets, part_offsets):
+        self.source_class = source_class
+        self.columns = columns
+        self.coordinates = coordinates
+        self.geometry_offsets = geometry_offsets
+        self.part_offsets = part_offsets
+        self.x = None
+        self.y = None
+
+    def __len__(self):
+        return len(self.geometry_offsets) - 1
+
+    @property
+    def nbytes(self):
+        arrays = [self.coordinates, self.geometry_offsets, self.part_offsets, self.x, self.y]
+        return sum(a.nbytes for a in arrays if a is not None) + 64 * len(self) * len(self.columns)
+
+    def project(self):
+        if self.x is None:
+            (self.x, self.y) = geo_arrays.mercator_to_lcc(self.coordinates[:, 0], self.coordinates[:, 1])
+        return self.x, self.y
+
+    @property
+    def vertex_offsets(self):
+        return self.part_offsets[self.geometry_offsets]
+
+    def geometry(self, i):
+        vertex_offsets = self.vertex_offsets
+        return self.coordinates[vertex_offsets[i]:vertex_offsets[i + 1]]
+
+    def as_namedtuples(self):
+        source_class = self.source_class
+        null_fields = set(getattr(source_class, "emission_fields", []))
+        defaults = getattr(source_class, "bulk_defaults", {})
+        coordinates = self.coordinates.tolist()
+        vertex_offsets = self.vertex_offsets.tolist()
+        single_point = getattr(source_class, "single_point", False)
+        results = []
+        for i in range(len(self)):
+            values = []
+            for field in source_class.fields:
+                if field == "geom":
+                    points = coordinates[vertex_offsets[i]:vertex_offsets[i + 1]]
+                    if single_point:
+                        points = points[0] if points else None
+                    values.append(points)
+                elif field in self.columns:
+                    value = self.columns[field][i]
+                    values.append(null_data(value) if field in null_fields else value)
+                else:
+                    values.append(defaults.get(field))
+            results.append(source_class.namedtuple_class(*values))
+        return results
+
+
+def bulk_load_sources(source_class, session, criteria=()):
+    column_attributes = sa.inspect(source_class).column_attrs.keys()
+    column_fields = [f for f in source_class.fields if f != "geom" and f in column_attributes]
+    query = session.query(*([getattr(source_class, f) for f in column_fields] +
+                            [sa.func.ST_AsBinary(source_class.geom)])).filter(*criteria)
+    rows = query.all()
+    if rows:
+        columns = list(zip(*rows))
+    else:
+        columns = [()] * (len(column_fields) + 1)
+    (coordinates, geometry_offsets, part_offsets) = wkb.decode(columns[-1])
+    return SourceBatch(source_class, dict(zip(column_fields, columns[:-1])), coordinates, geometry_offsets,
+                       part_offsets)
+
+
 class Road(Base):
     __tablename__ = "roads"
     fields = ["gid", "id", "sign1", "from_x", "from_y", "to_x", "to_y", "sf_id",
@@ -85,6 +230,10 @@ class Road(Base):
               "gas_truck_multiplier", "diesel_car_multiplier",
               "diesel_truck_multiplier"]
     namedtuple_class = namedtuple("Road", fields)
+    bulk_defaults = {"gas_car_multiplier": 1, "gas_truck_multiplier": 1, "diesel_car_multiplier": 1,
+                     "diesel_truck_multiplier": 1}
+    multiplier_fields = ["gas_car_multiplier", "gas_truck_multiplier", "diesel_car_multiplier",
+                         "diesel_truck_multiplier"]
     gid = sa.Column(sa.Integer, primary_key=True)
     id = sa.Column(sa.Numeric(asdecimal=False))
     sign1 = sa.Column(sa.String(100))
@@ -111,6 +260,10 @@ class Road(Base):
     def construct_namedtuple(cls, *args):
         return cls.namedtuple_class(*[null_data(a) for a in args])
 
+    @classmethod
+    def bulk_load(cls, session, *criteria):
+        return bulk_load_sources(cls, session, criteria)
+
     def as_namedtuple(self):
         return self.namedtuple_class(
             self.gid, self.id, self.sign1, self.from_x, self.from_y, self.to_x, self.to_y,
@@ -128,6 +281,9 @@ class Railway(Base):
     fields = ["gid", "rrowner1", "fromx", "fromy", "tox", "toy", "sf_id", "nox", "benz", "pm25",
               "dies_pm25", "ec", "oc", "co", "form", "ald2", "acro", "butal_3", "toluene", "so2", "geom"]
     namedtuple_class = namedtuple("Railway", fields)
+    endpoint_fields = ["fromx", "fromy", "tox", "toy"]
+    emission_fields = ["nox", "pm25", "co", "benz", "dies_pm25", "ec", "oc", "form", "ald2", "acro",
+                       "butal_3", "toluene", "so2"]
     gid = sa.Column("objectid", sa.Integer, primary_key=True)
     rrowner1 = sa.Column(sa.String)
     fromx = sa.Column(sa.Numeric(asdecimal=False))
@@ -154,6 +310,10 @@ class Railway(Base):
     def construct_namedtuple(cls, *args):
         return cls.namedtuple_class(*[null_data(a) for a in args])
 
+    @classmethod
+    def bulk_load(cls, session, *criteria):
+        return bulk_load_sources(cls, session, criteria)
+
     def as_namedtuple(self):
         return self.namedtuple_class(self.gid, self.rrowner1, self.fromx, self.fromy, self.tox, self.toy,
                                      self.sf_id, null_data(self.nox), null_data(self.benz), null_data(self.pm25),
@@ -170,45 +330,12 @@ class Railway(Base):
 
     @staticmethod
     def split_source(source):
-        src_list = []
-        src_dict = source._asdict()
-        if len(source.geom) == 2:
-            (from_lng, from_lat) = source.geom[0]
-            (to_lng, to_lat) = source.geom[1]
-            (from_x, from_y) = geo.mercator_to_lcc(from_lng, from_lat)
-            (to_x, to_y) = geo.mercator_to_lcc(to_lng, to_lat)
-            src_dict["fromx"] = from_x
-            src_dict["fromy"] = from_y
-            src_dict["tox"] = to_x
-            src_dict["toy"] = to_y
-            src_list.append(Railway.namedtuple_class(**src_dict))
-        else:
-            total_length_m = 0
-            for segment in zip(source.geom[:-1], source.geom[1:]):
-                (lon1, lat1) = segment[0]
-                (lon2, lat2) = segment[1]
-                total_length_m += geo.distance_on_unit_sphere(lat1, lon1, lat2, lon2) * 6373
-
-            for segment in zip(source.geom[:-1], source.geom[1:]):
-                (lon1, lat1) = segment[0]
-                (lon2, lat2) = segment[1]
-                segment_length_m = geo.distance_on_unit_sphere(lat1, lon1, lat2, lon2) * 6373
-                emis_fraction = segment_length_m / total_length_m
-
-                (from_x, from_y) = geo.mercator_to_lcc(lon1, lat1)
-                (to_x, to_y) = geo.mercator_to_lcc(lon2, lat2)
-                src_dict["fromx"] = from_x
-                src_dict["fromy"] = from_y
-                src_dict["tox"] = to_x
-                src_dict["toy"] = to_y
-                src_dict["geom"] = segment
-
-                for attr in ["nox", "pm25", "co", "benz", "dies_pm25", "ec", "oc",
-                             "form", "ald2", "acro", "butal_3", "toluene", "so2"]:
-                    src_dict[attr] = getattr(source, attr) * emis_fraction
-
-                src_list.append(Railway.namedtuple_class(**src_dict))
-        return src_list
+        return Railway.split_sources([source])
+
+    @staticmethod
+    def split_sources(sources):
+        return segmentation.split_sources(Railway.namedtuple_class, sources, Railway.endpoint_fields,
+                                          Railway.emission_fields)
 
 
 class AreaSource(Base):
@@ -216,6 +343,8 @@ class AreaSource(Base):
     fields = ["facility", "gid", "sf_id", "nox", "benz", "pm2_5", "dies_pm25", "ec", "oc",
               "co", "form", "ald2", "acro", "butal_3", "toluene", "so2", "geom"]
     namedtuple_class = namedtuple("AreaSource", fields)
+    emission_fields = ["nox", "benz", "pm2_5", "dies_pm25", "ec", "oc", "co", "form", "ald2", "acro",
+                       "butal_3", "toluene", "so2"]
     facility = sa.Column(sa.Text)
     gid = sa.Column("object_id", sa.Integer, primary_key=True)
     sf_id = sa.Column(sa.Integer)
@@ -238,6 +367,10 @@ class AreaSource(Base):
     def construct_namedtuple(cls, *args):
         return cls.namedtuple_class(*[null_data(a) for a in args])
 
+    @classmethod
+    def bulk_load(cls, session, *criteria):
+        return bulk_load_sources(cls, session, criteria)
+
     def as_namedtuple(self):
         geom = geo.multipolygon_to_point_list(self.geom)
         return self.namedtuple_class(self.facility, self.gid, self.sf_id, null_data(self.nox), null_data(self.benz),
@@ -248,17 +381,15 @@ class AreaSource(Base):
 
     @staticmethod
     def to_vertices(source):
-        results = []
-        for (lng, lat) in source.geom:
-            (x, y) = geo.mercator_to_lcc(lng, lat)
-            results.append(
-                [source.gid, source.sf_id, x, y, null_data(source.nox), null_data(source.benz),
-                 null_data(source.pm2_5),
-                 null_data(source.dies_pm25), null_data(source.ec),
-                 null_data(source.oc), null_data(source.co), null_data(source.form),
-                 null_data(source.ald2), null_data(source.acro), null_data(source.butal_3),
-                 null_data(source.toluene), null_data(source.so2)])
-        return results
+        return AreaSource.table_vertices(source_table.SourceTable.from_namedtuples(AreaSource, [source]))
+
+    @staticmethod
+    def table_vertices(table):
+        (x, y) = table.projected()
+        vertex_sources = table.vertex_sources()
+        columns = [table["gid"][vertex_sources], table["sf_id"][vertex_sources], x, y]
+        columns += [numpy.nan_to_num(table[f])[vertex_sources] for f in AreaSource.emission_fields]
+        return [list(row) for row in zip(*[column.tolist() for column in columns])]
 
 
 class ShipInTransit(Base):
@@ -267,6 +398,10 @@ class ShipInTransit(Base):
               "dies_pm25", "ec", "oc", "co", "form", "ald2", "acro", "butal_3", "toluene", "so2", "stack_height",
               "stack_diameter", "stack_velocity", "stack_temperature", "geom"]
     namedtuple_class = namedtuple("ShipInTransit", fields)
+    endpoint_fields = ["startx", "starty", "endx", "endy"]
+    stack_fields = ["stack_height", "stack_diameter", "stack_velocity", "stack_temperature"]
+    emission_fields = ["nox", "pm2_5", "co", "benz", "dies_pm25", "ec", "oc", "form", "ald2", "acro",
+                       "butal_3", "toluene", "so2"]
     gid = sa.Column("object_id", sa.Integer, primary_key=True)
     facility = sa.Column(sa.Text)
     startx = sa.Column(sa.Numeric(asdecimal=False))
@@ -297,6 +432,10 @@ class ShipInTransit(Base):
     def construct_namedtuple(cls, *args):
         return cls.namedtuple_class(*[null_data(a) for a in args])
 
+    @classmethod
+    def bulk_load(cls, session, *criteria):
+        return bulk_load_sources(cls, session, criteria)
+
     def as_namedtuple(self):
         return self.namedtuple_class(self.facility, self.gid, self.startx, self.starty, self.endx,
                                      self.endy, self.sf_id, null_data(self.nox), null_data(self.benz),
@@ -309,45 +448,12 @@ class ShipInTransit(Base):
 
     @staticmethod
     def split_source(source):
-        src_list = []
-        src_dict = source._asdict()
-        if len(source.geom) == 2:
-            (from_lng, from_lat) = source.geom[0]
-            (to_lng, to_lat) = source.geom[1]
-            (from_x, from_y) = geo.mercator_to_lcc(from_lng, from_lat)
-            (to_x, to_y) = geo.mercator_to_lcc(to_lng, to_lat)
-            src_dict["startx"] = from_x
-            src_dict["starty"] = from_y
-            src_dict["endx"] = to_x
-            src_dict["endy"] = to_y
-            src_list.append(ShipInTransit.namedtuple_class(**src_dict))
-        else:
-            total_length_m = 0
-            for segment in zip(source.geom[:-1], source.geom[1:]):
-                (lon1, lat1) = segment[0]
-                (lon2, lat2) = segment[1]
-                total_length_m += geo.distance_on_unit_sphere(lat1, lon1, lat2, lon2) * 6373
-
-            for segment in zip(source.geom[:-1], source.geom[1:]):
-                (lon1, lat1) = segment[0]
-                (lon2, lat2) = segment[1]
-                segment_length_m = geo.distance_on_unit_sphere(lat1, lon1, lat2, lon2) * 6373
-                emis_fraction = segment_length_m / total_length_m
-
-                (from_x, from_y) = geo.mercator_to_lcc(lon1, lat1)
-                (to_x, to_y) = geo.mercator_to_lcc(lon2, lat2)
-                src_dict["startx"] = from_x
-                src_dict["starty"] = from_y
-                src_dict["endx"] = to_x
-                src_dict["endy"] = to_y
-                src_dict["geom"] = segment
-
-                for attr in ["nox", "pm2_5", "co", "benz", "dies_pm25", "ec", "oc",
-                             "form", "ald2", "acro", "butal_3", "toluene", "so2"]:
-                    src_dict[attr] = getattr(source, attr) * emis_fraction
-
-                src_list.append(ShipInTransit.namedtuple_class(**src_dict))
-        return src_list
+        return ShipInTransit.split_sources([source])
+
+    @staticmethod
+    def split_sources(sources):
+        return segmentation.split_sources(ShipInTransit.namedtuple_class, sources, ShipInTransit.endpoint_fields,
+                                          ShipInTransit.emission_fields)
 
 
 class PointSource(Base):
@@ -356,6 +462,10 @@ class PointSource(Base):
               "pm25", "dies_pm25", "ec", "oc", "co", "form", "ald2", "acro", "butal_3", "toluene", "so2", "geom",
               "in_port"]
     namedtuple_class = namedtuple("PointSource", fields)
+    single_point = True
+    stack_fields = ["stkht", "stkdm", "stktmp", "stkvel"]
+    emission_fields = ["nox", "benz", "pm25", "dies_pm25", "ec", "oc", "co", "form", "ald2", "acro",
+                       "butal_3", "toluene", "so2"]
     pltname = sa.Column(sa.Text)
     gid = sa.Column(sa.Integer, primary_key=True)
     y = sa.Column(sa.Numeric(asdecimal=False))
@@ -385,6 +495,10 @@ class PointSource(Base):
     def construct_namedtuple(cls, *args):
         return cls.namedtuple_class(*[null_data(a) for a in args])
 
+    @classmethod
+    def bulk_load(cls, session, *criteria):
+        return bulk_load_sources(cls, session, criteria)
+
     def as_namedtuple(self):
         shape = geo.to_shape(self.geom)
         return self.namedtuple_class(self.pltname, self.gid, self.x, self.y, self.sf_id, self.stkht,
@@ -407,11 +521,18 @@ class Scenario(Base):
     wind = sa.Column(sa.Text)
     day = sa.Column(sa.Integer)
     met_conditions = sa.Column(sa.Integer)
-    area_sources = sa.Column(JSON)
-    point_sources = sa.Column(JSON)
-    railways = sa.Column(JSON)
-    roads = sa.Column(JSON)
-    ships_in_transit = sa.Column(JSON)
+    # Source payloads live either in the JSON columns or, when binary_source_payloads is set, in the
+    # encoded columns. Both are deferred, per source list, so loading a scenario does not pull them in.
+    area_sources_json = orm.deferred(sa.Column("area_sources", JSON), group="area_sources")
+    point_sources_json = orm.deferred(sa.Column("point_sources", JSON), group="point_sources")
+    railways_json = orm.deferred(sa.Column("railways", JSON), group="railways")
+    roads_json = orm.deferred(sa.Column("roads", JSON), group="roads")
+    ships_in_transit_json = orm.deferred(sa.Column("ships_in_transit", JSON), group="ships_in_transit")
+    area_sources_data = orm.deferred(sa.Column(sa.LargeBinary), group="area_sources")
+    point_sources_data = orm.deferred(sa.Column(sa.LargeBinary), group="point_sources")
+    railways_data = orm.deferred(sa.Column(sa.LargeBinary), group="railways")
+    roads_data = orm.deferred(sa.Column(sa.LargeBinary), group="roads")
+    ships_in_transit_data = orm.deferred(sa.Column(sa.LargeBinary), group="ships_in_transit")
     center = sa.Column(Geometry("POINT"))
     zoom = sa.Column(sa.Integer)
     area_source_fields = sa.Column(JSON)
@@ -424,8 +545,100 @@ class Scenario(Base):
     include_railways = sa.Column(sa.Boolean)
     include_roads = sa.Column(sa.Boolean)
     include_ships_in_transit = sa.Column(sa.Boolean)
+    source_bounds = sa.Column(JSON)
     last_update = sa.Column(sa.DateTime)
 
+    source_lists = [("area_sources", "include_area_sources", AreaSource),
+                    ("point_sources", "include_point_sources", PointSource),
+                    ("railways", "include_railways", Railway),
+                    ("roads", "include_roads", Road),
+                    ("ships_in_transit", "include_ships_in_transit", ShipInTransit)]
+
+    def _source_class(self, source_list):
+        return [c for (l, _, c) in self.source_lists if l == source_list][0]
+
+    def _decoded(self, source_list):
+        # Decoded tables are kept against the exact bytes they came from, so a reload or a new
+        # payload is picked up without explicit invalidation.
+        data = getattr(self, source_list + "_data")
+        if data is None:
+            return None
+        decoded = self.__dict__.setdefault("_decoded_sources", {})
+        if source_list not in decoded or decoded[source_list][0] is not data:
+            decoded[source_list] = (data, source_codec.decode(self._source_class(source_list), data), None)
+        return decoded[source_list]
+
+    def source_table(self, source_list):
+        decoded = self._decoded(source_list)
+        if decoded is not None:
+            return decoded[1]
+        return source_table.SourceTable.from_json(self._source_class(source_list), getattr(self, source_list))
+
+    def source_rows(self, source_list):
+        decoded = self._decoded(source_list)
+        if decoded is None:
+            return getattr(self, source_list + "_json")
+        if decoded[2] is None:
+            decoded = (decoded[0], decoded[1], decoded[1].to_json())
+            self.__dict__["_decoded_sources"][source_list] = decoded
+        return decoded[2]
+
+    def set_source_table(self, source_list, table, binary=None):
+        if binary is None:
+            binary = source_codec.enabled
+        if binary and table is not None:
+            data = source_codec.encode(table)
+            setattr(self, source_list + "_data", data)
+            setattr(self, source_list + "_json", None)
+            # Decoding the payload would only give this table back.
+            self.__dict__.setdefault("_decoded_sources", {})[source_list] = (data, table, None)
+        else:
+            setattr(self, source_list + "_json", table.to_json() if table is not None else None)
+            setattr(self, source_list + "_data", None)
+
+    def set_source_rows(self, source_list, rows, binary=None):
+        if binary is None:
+            binary = source_codec.enabled
+        if binary and rows is not None:
+            self.set_source_table(source_list, source_table.SourceTable.from_json(self._source_class(source_list),
+                                                                                  rows), True)
+        else:
+            setattr(self, source_list + "_json", rows)
+            setattr(self, source_list + "_data", None)
+
+    def edit_sources(self, source_list, multiply=None, override=None, **criteria):
+        table = self.source_table(source_list)
+        (edited, summary) = source_edits.apply(table, source_edits.match(table, **criteria), multiply, override)
+        if summary["changed"]:
+            self.set_source_table(source_list, edited)
+        return summary
+
+    @classmethod
+    def encode_source_payloads(cls, session, batch_size=100):
+        # Rows stored before the binary columns existed keep reading from JSON; this moves them over.
+        scenario_ids = [scenario_id for (scenario_id,) in session.query(cls.scenario_id).order_by(cls.scenario_id)]
+        for start in range(0, len(scenario_ids), batch_size):
+            for scenario in session.query(cls).filter(cls.scenario_id.in_(scenario_ids[start:start + batch_size])):
+                for (source_list, _, _) in cls.source_lists:
+                    if getattr(scenario, source_list + "_data") is None and \
+                            getattr(scenario, source_list + "_json") is not None:
+                        scenario.set_source_table(source_list, scenario.source_table(source_list))
+            session.commit()
+            session.expunge_all()
+
+    def bounds_for(self, source_list):
+        cached_bounds = self.source_bounds or {}
+        if source_list not in cached_bounds:
+            cached_bounds = dict(cached_bounds)
+            cached_bounds[source_list] = self.source_table(source_list).bounds
+            self.source_bounds = cached_bounds
+        return cached_bounds[source_list]
+
+    @property
+    def bounds(self):
+        return geo_arrays.merge_bounds(*[self.bounds_for(source_list) for (source_list, include, _) in
+                                         self.source_lists if getattr(self, include)])
+
     @property
     def safe_name(self):
         return "".join([x if x.isalnum() else "_" for x in self.name])
@@ -462,69 +675,59 @@ class Scenario(Base):
         }
 
 
+def _source_bounds_invalidator(source_list):
+    def invalidate(target, value, oldvalue, initiator):
+        if target.source_bounds and source_list in target.source_bounds:
+            cached_bounds = dict(target.source_bounds)
+            del cached_bounds[source_list]
+            target.source_bounds = cached_bounds
+    return invalidate
+
+
+def _source_payload_property(source_list):
+    return property(lambda self: self.source_rows(source_list),
+                    lambda self, rows: self.set_source_rows(source_list, rows))
+
+
+for (_source_list, _, _) in Scenario.source_lists:
+    setattr(Scenario, _source_list, _source_payload_property(_source_list))
+    for _suffix in ("_json", "_data"):
+        sa.event.listen(getattr(Scenario, _source_list + _suffix), "set", _source_bounds_invalidator(_source_list))
+
+
 class AbstractScenarioRun(object):
+    result_types = ["area", "point", "rail", "road", "sit", "total"]
+    source_types = [("area", "include_area_sources", "AREA"),
+                    ("point", "include_point_sources", "POINT"),
+                    ("rail", "include_railways", "RAIL"),
+                    ("road", "include_roads", "ROAD"),
+                    ("sit", "include_ships_in_transit", "SIT")]
+
+    def _load_status(self):
+        select = sa.select([self.__table__.c.status]).where(type(self).scenario_run_id == self.scenario_run_id)
+        return select.execute().fetchone()[0]
 
     @property
     def current_status(self):
-        select = sa.select([self.__table__.c.status]).where(type(self).scenario_run_id == self.scenario_run_id)
-        return select.execute().fetchone()[0]
+        return status_channel.status((self.__tablename__, self.scenario_run_id), self._load_status)
+
+    def wait_for_status(self, known_status=None, timeout=notifications.wait_timeout):
+        return status_channel.wait((self.__tablename__, self.scenario_run_id), known_status, self._load_status,
+                                   timeout)
 
     def _get_bounds_helper(self, scenario):
-        if scenario.include_area_sources:
-            for source in scenario.area_sources:
-                for (lng, lat) in source[16]:
-                    if lat < self.min_lat or self.min_lat is None:
-                        self.min_lat = lat
-                    if lat > self.max_lat or self.max_lat is None:
-                        self.max_lat = lat
-                    if lng < self.min_lng or self.min_lng is None:
-                        self.min_lng = lng
-                    if lng > self.max_lng or self.max_lng is None:
-                        self.max_lng = lng
-        if scenario.include_point_sources:
-            for source in scenario.point_sources:
-                (lng, lat) = source[22]
-                if lat < self.min_lat or self.min_lat is None:
-                    self.min_lat = lat
-                if lat > self.max_lat or self.max_lat is None:
-                    self.max_lat = lat
-                if lng < self.min_lng or self.min_lng is None:
-                    self.min_lng = lng
-                if lng > self.max_lng or self.max_lng is None:
-                    self.max_lng = lng
-        if scenario.include_roads:
-            for source in scenario.roads:
-                for (lng, lat) in source[13]:
-                    if lat < self.min_lat or self.min_lat is None:
-                        self.min_lat = lat
-                    if lat > self.max_lat or self.max_lat is None:
-                        self.max_lat = lat
-                    if lng < self.min_lng or self.min_lng is None:
-                        self.min_lng = lng
-                    if lng > self.max_lng or self.max_lng is None:
-                        self.max_lng = lng
-        if scenario.include_railways:
-            for source in scenario.railways:
-                for (lng, lat) in source[20]:
-                    if lat < self.min_lat or self.min_lat is None:
-                        self.min_lat = lat
-                    if lat > self.max_lat or self.max_lat is None:
-                        self.max_lat = lat
-                    if lng < self.min_lng or self.min_lng is None:
-                        self.min_lng = lng
-                    if lng > self.max_lng or self.max_lng is None:
-                        self.max_lng = lng
-        if scenario.include_ships_in_transit:
-            for source in scenario.ships_in_transit:
-                for (lng, lat) in source[24]:
-                    if lat < self.min_lat or self.min_lat is None:
-                        self.min_lat = lat
-                    if lat > self.max_lat or self.max_lat is None:
-                        self.max_lat = lat
-                    if lng < self.min_lng or self.min_lng is None:
-                        self.min_lng = lng
-                    if lng > self.max_lng or self.max_lng is None:
-                        self.max_lng = lng
+        bounds = scenario.bounds
+        if bounds is None:
+            return
+        (min_lng, min_lat, max_lng, max_lat) = bounds
+        if self.min_lat is None or min_lat < self.min_lat:
+            self.min_lat = min_lat
+        if self.max_lat is None or max_lat > self.max_lat:
+            self.max_lat = max_lat
+        if self.min_lng is None or min_lng < self.min_lng:
+            self.min_lng = min_lng
+        if self.max_lng is None or max_lng > self.max_lng:
+            self.max_lng = max_lng
 
     def _get_bounds(self):
         if isinstance(self, ScenarioRun):
@@ -540,81 +743,145 @@ class AbstractScenarioRun(object):
         else:
             return "HOURLY"
 
-    @staticmethod
-    def _merge_concentration_dicts(*dicts):
-        result_dict = dict()
-        all_keys = set()
-        for d in dicts:
-            for k in d.keys():
-                all_keys.add(k)
-        for key in all_keys:
-            result_dict[key] = sum(d.get(key, 0) for d in dicts)
-        return result_dict
+    def _clear_results(self):
+        # A job requeued after its worker died may already have committed results for this run.
+        data_points = self.data_point_class.__table__
+        object_session(self).execute(data_points.delete().where(data_points.c.scenario_run_id == self.scenario_run_id))
+        result_store.remove(self.__tablename__, self.scenario_run_id)
+        tiles.cache.invalidate(self)
+        point_query.cache.invalidate(self)
+
+    def discard_outputs(self):
+        # Runs reusing another run's outputs share its directory and must leave it alone.
+        if getattr(self, "source_run_id", None) is not None:
+            return
+        for directory in self.output_directories:
+            if directory:
+                shutil.rmtree(directory, ignore_errors=True)
+        if self.results_file_name:
+            packaging.remove(self.results_file_name)
+
+    def _write_results(self, data_point_class, rows, total, progress=None, batch_size=bulk.batch_size):
+        session = object_session(self)
+        session.flush()
+        self._clear_results()
+        columns = ["scenario_run_id", "receptor_id", "receptor_location"] + data_point_class.value_columns
+        writer = bulk.BulkWriter(session.connection(), data_point_class.__table__, columns, batch_size, progress)
+        return writer.write(([self.scenario_run_id] + row for row in rows), total)
+
+    @property
+    def result_run_id(self):
+        return getattr(self, "source_run_id", None) or self.scenario_run_id
+
+    @property
+    def stored_results(self):
+        return result_store.ResultStore.open(self.__tablename__, self.result_run_id, self.result_types)
+
+    def _store_results(self, lng, lat, values):
+        display_values = {t: self._display_values(values[t]) for t in self.result_types}
+        result_store.stage(object_session(self), self.__tablename__, self.scenario_run_id, self.result_types, lng, lat,
+                           values, display_values)
+
+    def result_array(self, result_type):
+        return self.generate_concentration_array(getattr(self.data_point_class, result_type + "_value"))
+
+    def result_values(self):
+        store = self.stored_results
+        if store is not None:
+            return store.lng, store.lat, numpy.column_stack([store.values(t) for t in self.result_types])
+        data_point_class = self.data_point_class
+        columns = [getattr(data_point_class, t + "_value") for t in self.result_types]
+        rows = object_session(self).query(data_point_class.receptor_location, *columns)\
+            .filter(data_point_class.scenario_run_id == self.result_run_id).all()
+        locations = numpy.array([point_wkt_to_array(row[0]) for row in rows], dtype=numpy.float64).reshape(-1, 2)
+        values = numpy.array([[numpy.nan if v is None else v for v in row[1:]] for row in rows],
+                             dtype=numpy.float64).reshape(-1, len(columns))
+        return locations[:, 0], locations[:, 1], values
+
+    @property
+    def point_index(self):
+        return point_query.cache.get(self)
+
+    def block_group_statistics(self, result_types=None):
+        result_types = result_types or self.result_types
+        (lng, lat, values) = self.result_values()
+        session = object_session(self)
+        assignment = zonal.cache.get(lng, lat, lambda bounds: CensusBlockGroup.bulk_load(session, bounds))
+        columns = [self.result_types.index(t) for t in result_types]
+        return assignment.statistics(values[:, columns], result_types)
+
+    def concentration_grids(self, width, height, result_types=None):
+        result_types = result_types or self.result_types
+        bounds = (self.min_lng, self.min_lat, self.max_lng, self.max_lat)
+        store = self.stored_results
+        if store is not None:
+            # Every column shares the store's receptor layout, so they are all gridded in one product.
+            values = numpy.column_stack([store.concentration_array(t)[:, 2] for t in result_types])
+            grids = gridding.cache.get(store.lng, store.lat, bounds, width, height).grid(values)
+            return {t: grids[:, :, i] for (i, t) in enumerate(result_types)}
+        grids = {}
+        for t in result_types:
+            array = self.result_array(t)
+            grids[t] = gridding.cache.get(array[:, 0], array[:, 1], bounds, width, height).grid(array[:, 2])
+        return grids
+
+    def _result_type(self, source_type):
+        if source_type is None:
+            return "total"
+        key = getattr(source_type, "key", str(source_type))
+        if key.endswith("_value") and key[:-len("_value")] in self.result_types:
+            return key[:-len("_value")]
+        return None
 
     def _load_receptors_file(self, scenario):
-        ds = tablib.Dataset()
-        receptors = {}
-        with open(self.receptor_file(scenario)) as receptor_list:
-            ds.csv = receptor_list.read()
-            receptors = {int(r[0]): Receptor(x=r[1], y=r[2]) for r in ds}
-        return receptors
-
-    def _load_concentrations_files(self, scenario):
-        ds = tablib.Dataset()
-        result_dicts = []
+        return ReceptorSet.from_csv(self.receptor_file(scenario))
+
+    @property
+    def model_field(self):
         if self.model_type > 1:
-            model_field = self.model_type + 1
+            return self.model_type + 1
         else:
-            model_field = 3
-
-        area_concentrations = {}
-        if scenario.include_area_sources and os.path.isfile(self.area_file(scenario)):
-            with open(self.area_file(scenario)) as area_output:
-                ds.csv = area_output.read()
-                area_concentrations = {int(r[0]): float(r[model_field]) for
-                                       r in ds}
-                result_dicts.append(area_concentrations)
-        point_concentrations = {}
-        if scenario.include_point_sources and os.path.isfile(self.point_file(scenario)):
-            with open(self.point_file(scenario)) as point_output:
-                ds.csv = point_output.read()
-                point_concentrations = {int(r[0]): float(r[model_field]) for
-                                        r in ds}
-                result_dicts.append(point_concentrations)
-        rail_concentrations = {}
-        if scenario.include_railways and os.path.isfile(self.rail_file(scenario)):
-            with open(self.rail_file(scenario)) as rail_output:
-                ds.csv = rail_output.read()
-                rail_concentrations = {int(r[0]): float(r[model_field]) for
-                                       r in ds}
-                result_dicts.append(rail_concentrations)
-        road_concentrations = {}
-        if scenario.include_roads and os.path.isfile(self.road_file(scenario)):
-            with open(self.road_file(scenario)) as road_output:
-                ds.csv = road_output.read()
-                road_concentrations = {int(r[0]): float(r[model_field]) for
-                                       r in ds}
-                result_dicts.append(road_concentrations)
-        sit_concentrations = {}
-        if scenario.include_ships_in_transit and os.path.isfile(self.sit_file(scenario)):
-            with open(self.sit_file(scenario)) as sit_output:
-                ds.csv = sit_output.read()
-                sit_concentrations = {int(r[0]): float(r[model_field]) for
-                                      r in ds}
-                result_dicts.append(sit_concentrations)
-        concentrations = self._merge_concentration_dicts(*result_dicts)
-        return {
-            "area": area_concentrations,
-            "point": point_concentrations,
-            "rail": rail_concentrations,
-            "road": road_concentrations,
-            "sit": sit_concentrations,
-            "total": concentrations
-        }
+            return 3
+
+    def reused_source_types(self, scenario=None):
+        return []
+
+    def carried_receptors_match(self, scenario, receptors):
+        return True
+
+    def source_outputs(self, scenario):
+        return [(source_type, model_source_type, self.output_file(scenario, model_source_type))
+                for (source_type, include, model_source_type) in self.source_types if getattr(scenario, include)]
+
+    def _load_concentrations_files(self, scenario, receptors):
+        concentrations = ingest.ConcentrationSet(receptors, [t for (t, _, _) in self.source_types])
+        for (source_type, _, path) in self.source_outputs(scenario):
+            if os.path.isfile(path):
+                concentrations.add_file(source_type, path, self.model_field)
+        return concentrations.as_dict()
+
+    def create_package(self, level=packaging.compression_level, lazy=packaging.lazy):
+        self.package_manifest = [list(member) for member in self.package_members]
+        if not lazy:
+            packaging.write_package(packaging.archive_path(self.results_file_name), self.package_manifest, level)
+        self.status = "completed"
+        self.last_update = datetime.datetime.now()
+
+    def stream_package(self, level=packaging.compression_level, chunk_size=packaging.chunk_size):
+        members = self.package_manifest or self.package_members
+        return packaging.stream(self.results_file_name, members, level, chunk_size)
+
+    def _load_scenario_results(self, index, results=None):
+        if results is not None:
+            return results[index]
+        (scenario, _) = self.scenario_outputs[index]
+        receptors = self._load_receptors_file(scenario)
+        return receptors, self._load_concentrations_files(scenario, receptors)
 
 
 class ScenarioRun(Base, AbstractScenarioRun):
     __tablename__ = "scenario_run"
+    min_non_zero = 10 ** -6
     scenario_run_id = sa.Column(sa.Integer, primary_key=True)
     scenario_id = sa.Column(sa.Integer, sa.ForeignKey("scenario.scenario_id"))
     user_id = sa.Column(sa.Text)
@@ -622,10 +889,15 @@ class ScenarioRun(Base, AbstractScenarioRun):
     status = sa.Column(sa.Text)
     output_directory = sa.Column(sa.Text)
     results_file_name = sa.Column(sa.Text)
+    package_manifest = sa.Column(JSON)
     model_type = sa.Column(sa.Integer)
     pollutant = sa.Column(sa.Text)
     model_min_value = sa.Column(sa.Float)
     model_max_value = sa.Column(sa.Float)
+    fingerprint = sa.Column(sa.Text, index=True)
+    source_fingerprints = sa.Column(JSON)
+    source_run_id = sa.Column(sa.Integer, sa.ForeignKey("scenario_run.scenario_run_id"))
+    base_run_id = sa.Column(sa.Integer, sa.ForeignKey("scenario_run.scenario_run_id"))
     scenario = orm.relationship(Scenario)
     min_lat = sa.Column(sa.Numeric(asdecimal=False))
     max_lat = sa.Column(sa.Numeric(asdecimal=False))
@@ -636,16 +908,166 @@ class ScenarioRun(Base, AbstractScenarioRun):
     def __init__(self, *args, **kwargs):
         super(ScenarioRun, self).__init__(*args, **kwargs)
 
+    fingerprint_version = 1
+    fingerprint_fields = ["hour", "season", "day", "wind", "met_conditions"]
+
+    @staticmethod
+    def _digest(inputs):
+        encoded = json.dumps(inputs, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+    def compute_source_fingerprints(self):
+        common = {
+            "version": self.fingerprint_version,
+            "model_type": self.model_type,
+            "pollutant": self.pollutant
+        }
+        for field in self.fingerprint_fields:
+            common[field] = getattr(self.scenario, field)
+        source_lists = dict((include, source_list) for (source_list, include, _) in self.scenario.source_lists)
+        fingerprints = {}
+        for (source_type, include, _) in self.source_types:
+            inputs = dict(common)
+            if getattr(self.scenario, include):
+                inputs["sources"] = self.scenario.source_table(source_lists[include]).to_json()
+            fingerprints[source_type] = self._digest(inputs)
+        return fingerprints
+
+    def compute_fingerprint(self):
+        return self._digest(self.compute_source_fingerprints())
+
+    def _find_base_run(self):
+        candidates = object_session(self).query(ScenarioRun).filter(
+            ScenarioRun.scenario_id == self.scenario_id,
+            ScenarioRun.status == "completed",
+            ScenarioRun.source_fingerprints.isnot(None),
+            ScenarioRun.scenario_run_id != self.scenario_run_id).order_by(ScenarioRun.scenario_run_id.desc())
+        for run in candidates:
+            # Receptors are laid out from the bounds, so values only carry over onto an identical grid.
+            same_grid = all(getattr(run, f) == getattr(self, f) for f in ["min_lat", "max_lat", "min_lng", "max_lng"])
+            if same_grid and run.model_type == self.model_type and os.path.isfile(run.receptor_file()):
+                return run
+        return None
+
+    def reused_source_types(self, scenario=None):
+        if self.base_run_id is None:
+            return []
+        base_run = object_session(self).query(ScenarioRun).get(self.base_run_id)
+        if base_run is None:
+            return []
+        return [source_type for (source_type, _, _, _) in self._carried_outputs(base_run)]
+
+    def carried_receptors_match(self, scenario, receptors):
+        # The model lays out the receptors, so whether the base run's values still line up with them is only
+        # known once this run's receptors are written; anything carried is dropped when they do not.
+        base_run = object_session(self).query(ScenarioRun).get(self.base_run_id) if self.base_run_id else None
+        if base_run is None:
+            return True
+        if os.path.isfile(base_run.receptor_file()):
+            base_receptors = ReceptorSet.from_csv(base_run.receptor_file())
+            if len(base_receptors) == len(receptors) and (base_receptors.id == receptors.id).all() and \
+                    numpy.allclose(base_receptors.x, receptors.x, rtol=0, atol=matching.tolerance) and \
+                    numpy.allclose(base_receptors.y, receptors.y, rtol=0, atol=matching.tolerance):
+                return True
+        logger.warning("Receptors of scenario run %s differ from those of base run %s; modeling every source type",
+                       self.scenario_run_id, base_run.scenario_run_id)
+        self.base_run_id = None
+        return False
+
+    def _carried_outputs(self, base_run):
+        carried = []
+        for (source_type, model_source_type, path) in self.source_outputs(self.scenario):
+            base_path = base_run.output_file(base_run.scenario, model_source_type)
+            if base_run.source_fingerprints.get(source_type) == self.source_fingerprints.get(source_type) and \
+                    os.path.isfile(base_path):
+                carried.append((source_type, base_path, model_source_type, path))
+        return carried
+
+    def _carry_forward(self, base_run):
+        carried = self._carried_outputs(base_run)
+        if not carried:
+            return
+        self.base_run_id = base_run.scenario_run_id
+        for (_, base_path, _, path) in carried:
+            try:
+                os.link(base_path, path)
+            except OSError:
+                shutil.copy(base_path, path)
+        # The model rewrites these when it runs, so they are copied rather than linked.
+        for name in ["receptors.csv", "CTOOLS_Inputs.txt"]:
+            base_path = os.path.join(base_run.output_directory, name)
+            if os.path.isfile(base_path):
+                shutil.copy(base_path, os.path.join(self.output_directory, name))
+
+    def _find_reusable_run(self):
+        candidates = object_session(self).query(ScenarioRun).filter(
+            ScenarioRun.fingerprint == self.fingerprint,
+            ScenarioRun.status == "completed",
+            ScenarioRun.source_run_id.is_(None),
+            ScenarioRun.scenario_run_id != self.scenario_run_id).order_by(ScenarioRun.scenario_run_id.desc())
+        for run in candidates:
+            if os.path.isdir(run.output_directory):
+                return run
+        return None
+
+    def _reuse(self, source_run):
+        self.source_run_id = source_run.scenario_run_id
+        for field in ["output_directory", "results_file_name", "package_manifest", "model_min_value",
+                      "model_max_value", "min_lat", "max_lat", "min_lng", "max_lng"]:
+            setattr(self, field, getattr(source_run, field))
+        self.status = "completed"
+        self.last_update = datetime.datetime.now()
+
+    @property
+    def reference_count(self):
+        return object_session(self).query(ScenarioRun).filter(
+            ScenarioRun.output_directory == self.output_directory).count()
+
+    def release(self):
+        session = object_session(self)
+        data_points = ScenarioRunResultDataPoint.__table__
+        status_channel.forget((self.__tablename__, self.scenario_run_id))
+        if self.source_run_id is None:
+            tiles.cache.invalidate(self)
+            point_query.cache.invalidate(self)
+            dependents = session.query(ScenarioRun).filter(ScenarioRun.source_run_id == self.scenario_run_id)\
+                .order_by(ScenarioRun.scenario_run_id).all()
+            if dependents:
+                # Hand the shared outputs to the oldest dependent instead of deleting them.
+                heir = dependents[0]
+                session.execute(data_points.update().where(data_points.c.scenario_run_id == self.scenario_run_id)
+                                .values(scenario_run_id=heir.scenario_run_id))
+                result_store.rename(self.__tablename__, self.scenario_run_id, heir.scenario_run_id)
+                heir.source_run_id = None
+                for dependent in dependents[1:]:
+                    dependent.source_run_id = heir.scenario_run_id
+            else:
+                session.execute(data_points.delete().where(data_points.c.scenario_run_id == self.scenario_run_id))
+                result_store.remove(self.__tablename__, self.scenario_run_id)
+                if self.results_file_name:
+                    packaging.remove(self.results_file_name)
+                if self.output_directory:
+                    shutil.rmtree(self.output_directory, ignore_errors=True)
+        session.delete(self)
+
     def prepare_run(self):
+        self.source_fingerprints = self.compute_source_fingerprints()
+        self.fingerprint = self._digest(self.source_fingerprints)
+        source_run = self._find_reusable_run()
+        if source_run is not None:
+            self._reuse(source_run)
+            return
         dir_name = str(uuid.uuid4())
         self.output_directory = os.path.join(ctools_backend.settings.scenario_run_directory, dir_name)
         self.results_file_name = "%s_%s.tar.gz" % (self.scenario.safe_name, str(time.time()).replace(".", ""))
-        self.temp_dir = tempfile.mkdtemp()
         try:
             os.mkdir(self.output_directory)
         except OSError:
             pass
         self._get_bounds()
+        base_run = self._find_base_run()
+        if base_run is not None:
+            self._carry_forward(base_run)
         self.status = "running"
         self.last_update = datetime.datetime.now()
 
@@ -668,6 +1090,18 @@ class ScenarioRun(Base, AbstractScenarioRun):
             "last_update": self.last_update.isoformat()
         }
 
+    @property
+    def output_directories(self):
+        return [self.output_directory]
+
+    @property
+    def scenario_outputs(self):
+        return [(self.scenario, self.output_directory)]
+
+    @property
+    def data_point_class(self):
+        return ScenarioRunResultDataPoint
+
     @property
     def image_file(self):
         return os.path.join(self.output_directory, "concentrations.png")
@@ -676,40 +1110,28 @@ class ScenarioRun(Base, AbstractScenarioRun):
     def legend_file(self):
         return os.path.join(self.output_directory, "concentrations_legend.png")
 
-    def finalize_run(self):
+    def finalize_run(self, progress=None, batch_size=bulk.batch_size, results=None):
         self.status = "processing"
         self.last_update = datetime.datetime.now()
-        receptors = self._load_receptors_file(self.scenario)
-        concentrations = self._load_concentrations_files(self.scenario)
-        for receptor in concentrations["total"]:
-            point = (receptors[receptor].lng, receptors[receptor].lat)
-            self.results.append(ScenarioRunResultDataPoint(
-                receptor_id=receptor,
-                area_value=concentrations["area"].get(receptor, None),
-                point_value=concentrations["point"].get(receptor, None),
-                rail_value=concentrations["rail"].get(receptor, None),
-                road_value=concentrations["road"].get(receptor, None),
-                sit_value=concentrations["sit"].get(receptor, None),
-                total_value=concentrations["total"].get(receptor, None),
-                scenario_run=self,
-                receptor_location=geo.point_to_point(point)
-            ))
-
-    def create_package(self):
-        output_directory = os.path.join(self.temp_dir, self.scenario.safe_name)
-        os.mkdir(output_directory)
-        shutil.copy(os.path.join(self.output_directory, "concentrations.png"), self.temp_dir)
-        shutil.copy(os.path.join(self.output_directory, "concentrations_legend.png"), self.temp_dir)
-        shutil.copy(os.path.join(ctools_backend.settings.template_directory, "ctools.prj"), self.temp_dir)
-        shutil.copy(os.path.join(self.output_directory, "CTOOLS_Inputs.txt"), output_directory)
-        for filename in glob.glob(os.path.join(self.output_directory, "*.csv")):
-            shutil.copy(filename, output_directory)
-        starting_dir = os.getcwd()
-        os.chdir(ctools_backend.settings.output_tar_directory)
-        subprocess.call(["tar", "-C", self.temp_dir, "-czf", self.results_file_name, "."])
-        os.chdir(starting_dir)
-        self.status = "completed"
-        self.last_update = datetime.datetime.now()
+        (receptors, concentrations) = self._load_scenario_results(0, results)
+        indices = numpy.flatnonzero(~numpy.isnan(concentrations["total"]))
+        values = numpy.column_stack([concentrations[t][indices] for t in self.result_types])
+        srid = bulk.geometry_srid(ScenarioRunResultDataPoint.__table__.c.receptor_location)
+        rows = ([str(receptor_id), bulk.point_ewkt(lng, lat, srid)] + [nan_to_none(v) for v in row_values]
+                for (receptor_id, lng, lat, row_values) in zip(receptors.id[indices].tolist(),
+                                                               receptors.lng[indices].tolist(),
+                                                               receptors.lat[indices].tolist(),
+                                                               values.tolist()))
+        self._write_results(ScenarioRunResultDataPoint, rows, len(indices), progress, batch_size)
+        self._store_results(receptors.lng[indices], receptors.lat[indices],
+                            {t: values[:, i] for (i, t) in enumerate(self.result_types)})
+
+    @property
+    def package_members(self):
+        return ([(self.image_file, "concentrations.png"),
+                 (self.legend_file, "concentrations_legend.png"),
+                 (os.path.join(ctools_backend.settings.template_directory, "ctools.prj"), "ctools.prj")] +
+                packaging.directory_members(self.output_directory, self.scenario.safe_name))
 
     def failed(self):
         self.status = "failed"
@@ -718,6 +1140,10 @@ class ScenarioRun(Base, AbstractScenarioRun):
     def receptor_file(self, scenario=None):
         return os.path.join(self.output_directory, "receptors.csv")
 
+    def output_file(self, scenario, model_source_type):
+        return os.path.join(self.output_directory,
+                            "results_CTOOLS_%s_%s_Output.csv" % (self.mode_name, model_source_type))
+
     def area_file(self, scenario=None):
         return os.path.join(self.output_directory, "results_CTOOLS_%s_AREA_Output.csv" % self.mode_name)
 
@@ -733,18 +1159,25 @@ class ScenarioRun(Base, AbstractScenarioRun):
     def sit_file(self, scenario=None):
         return os.path.join(self.output_directory, "results_CTOOLS_%s_SIT_Output.csv" % self.mode_name)
 
+    def _display_values(self, values):
+        return numpy.fmax(values, self.min_non_zero)
+
     def generate_concentration_array(self, source_type=None):
-        min_non_zero = 10 ** -6
+        result_type = self._result_type(source_type)
+        store = self.stored_results
+        if store is not None and result_type in store:
+            # A read-only view of the mapped store; callers that need to change values must copy it first.
+            return store.concentration_array(result_type)
 
         def transform_concentration(c):
             (x, y) = point_wkt_to_array(c[0])
-            return x, y, max(c[1], min_non_zero)
+            return x, y, max(c[1], self.min_non_zero)
 
         session = object_session(self)
         if not source_type:
             source_type = ScenarioRunResultDataPoint.total_value
         concentrations = session.query(ScenarioRunResultDataPoint.receptor_location, source_type)\
-            .filter(ScenarioRunResultDataPoint.scenario_run_id == self.scenario_run_id).all()
+            .filter(ScenarioRunResultDataPoint.scenario_run_id == self.result_run_id).all()
         return numpy.array([transform_concentration(c) for c in concentrations])
 
 
@@ -757,6 +1190,7 @@ class ComparisonScenarioRun(Base, AbstractScenarioRun):
     output_directory_1 = sa.Column(sa.Text)
     output_directory_2 = sa.Column(sa.Text)
     results_file_name = sa.Column(sa.Text)
+    package_manifest = sa.Column(JSON)
     model_type = sa.Column(sa.Integer)
     pollutant = sa.Column(sa.Text)
     model_min_value = sa.Column(sa.Float)
@@ -781,7 +1215,6 @@ class ComparisonScenarioRun(Base, AbstractScenarioRun):
         self.output_directory_1 = os.path.join(ctools_backend.settings.scenario_run_directory, dir_name_1)
         self.output_directory_2 = os.path.join(ctools_backend.settings.scenario_run_directory, dir_name_2)
         self.results_file_name = "%s_vs_%s_%s.tar.gz" % (self.scenario_1.safe_name, self.scenario_2.safe_name, str(time.time()).replace(".", ""))
-        self.temp_dir = tempfile.mkdtemp()
         try:
             os.mkdir(self.output_directory_1)
             os.mkdir(self.output_directory_2)
@@ -813,6 +1246,18 @@ class ComparisonScenarioRun(Base, AbstractScenarioRun):
             "last_update": self.last_update.isoformat()
         }
 
+    @property
+    def output_directories(self):
+        return [self.output_directory_1, self.output_directory_2]
+
+    @property
+    def scenario_outputs(self):
+        return [(self.scenario_1, self.output_directory_1), (self.scenario_2, self.output_directory_2)]
+
+    @property
+    def data_point_class(self):
+        return ComparisonScenarioRunResultDataPoint
+
     @property
     def image_file(self):
         return os.path.join(self.output_directory_1, "concentrations.png")
@@ -823,125 +1268,61 @@ class ComparisonScenarioRun(Base, AbstractScenarioRun):
 
     @staticmethod
     def _relative(v1, v2):
-        return (v1 or 0) - (v2 or 0)
+        return numpy.nan_to_num(v1) - numpy.nan_to_num(v2)
 
     @staticmethod
     def _relative_percent(v1, v2):
-        return 100 * ((v1 or 0) - (v2 or 0))/(v2 or v1 or 1)
+        (v1, v2) = (numpy.nan_to_num(v1), numpy.nan_to_num(v2))
+        return 100 * (v1 - v2) / numpy.where(v2 != 0, v2, numpy.where(v1 != 0, v1, 1))
 
-    def finalize_run(self):
+    def finalize_run(self, progress=None, batch_size=bulk.batch_size, tolerance=matching.tolerance, results=None):
         self.status = "processing"
         self.last_update = datetime.datetime.now()
-        receptors_1 = self._load_receptors_file(self.scenario_1)
-        concentrations_1 = self._load_concentrations_files(self.scenario_1)
-        receptors_2 = self._load_receptors_file(self.scenario_2)
-        concentrations_2 = self._load_concentrations_files(self.scenario_2)
+        (receptors_1, concentrations_1) = self._load_scenario_results(0, results)
+        (receptors_2, concentrations_2) = self._load_scenario_results(1, results)
         if self.comparison_mode == 1:
             comp_f = self._relative
         else:
             comp_f = self._relative_percent
-        data_points = {}
-        for receptor_id in concentrations_1["total"]:
-            receptor = receptors_1[receptor_id]
-            area_val = concentrations_1["area"].get(receptor_id, None)
-            point_val = concentrations_1["point"].get(receptor_id, None)
-            rail_val = concentrations_1["rail"].get(receptor_id, None)
-            road_val = concentrations_1["road"].get(receptor_id, None)
-            sit_val = concentrations_1["sit"].get(receptor_id, None)
-            total_val = concentrations_1["total"].get(receptor_id, None)
-            data_points[receptor.x, receptor.y] = ComparisonScenarioRunResultDataPoint(
-                receptor_id=receptor_id,
-                scenario_1_area_value=area_val,
-                scenario_1_point_value=point_val,
-                scenario_1_rail_value=rail_val,
-                scenario_1_road_value=road_val,
-                scenario_1_sit_value=sit_val,
-                scenario_1_total_value=total_val,
-                scenario_2_area_value=None,
-                scenario_2_point_value=None,
-                scenario_2_rail_value=None,
-                scenario_2_road_value=None,
-                scenario_2_sit_value=None,
-                scenario_2_total_value=None,
-                area_value=comp_f(area_val, None),
-                point_value=comp_f(point_val, None),
-                rail_value=comp_f(rail_val, None),
-                road_value=comp_f(road_val, None),
-                sit_value=comp_f(sit_val, None),
-                total_value=comp_f(total_val, None),
-                scenario_run=self,
-                receptor_location=geo.point_to_point((receptor.lng, receptor.lat))
-            )
-        for receptor_id in concentrations_2["total"]:
-            receptor = receptors_2[receptor_id]
-            area_val = concentrations_2["area"].get(receptor_id, None)
-            point_val = concentrations_2["point"].get(receptor_id, None)
-            rail_val = concentrations_2["rail"].get(receptor_id, None)
-            road_val = concentrations_2["road"].get(receptor_id, None)
-            sit_val = concentrations_2["sit"].get(receptor_id, None)
-            total_val = concentrations_2["total"].get(receptor_id, None)
-            if not (receptor.x, receptor.y) in data_points:
-                data_points[receptor.x, receptor.y] = ComparisonScenarioRunResultDataPoint(
-                    receptor_id=receptor_id,
-                    scenario_1_area_value=None,
-                    scenario_1_point_value=None,
-                    scenario_1_rail_value=None,
-                    scenario_1_road_value=None,
-                    scenario_1_sit_value=None,
-                    scenario_1_total_value=None,
-                    scenario_2_area_value=area_val,
-                    scenario_2_point_value=point_val,
-                    scenario_2_rail_value=rail_val,
-                    scenario_2_road_value=road_val,
-                    scenario_2_sit_value=sit_val,
-                    scenario_2_total_value=total_val,
-                    area_value=comp_f(None, area_val),
-                    point_value=comp_f(None, point_val),
-                    rail_value=comp_f(None, rail_val),
-                    road_value=comp_f(None, road_val),
-                    sit_value=comp_f(None, sit_val),
-                    total_value=comp_f(None, total_val),
-                    scenario_run=self,
-                    receptor_location=geo.point_to_point((receptor.lng, receptor.lat))
-                )
+        present_1 = numpy.flatnonzero(~numpy.isnan(concentrations_1["total"]))
+        present_2 = numpy.flatnonzero(~numpy.isnan(concentrations_2["total"]))
+        (matched_1, matched_2) = matching.match_points(receptors_1.x[present_1], receptors_1.y[present_1],
+                                                       receptors_2.x[present_2], receptors_2.y[present_2],
+                                                       tolerance)
+        (rows_1, rows_2) = matching.align(len(present_1), len(present_2), matched_1, matched_2)
+        rows_1 = matching.take(present_1, rows_1, -1)
+        rows_2 = matching.take(present_2, rows_2, -1)
+
+        values_1 = numpy.column_stack([matching.take(concentrations_1[t], rows_1) for t in self.result_types])
+        values_2 = numpy.column_stack([matching.take(concentrations_2[t], rows_2) for t in self.result_types])
+        differences = comp_f(values_1, values_2)
+        lng = numpy.where(rows_1 >= 0, matching.take(receptors_1.lng, rows_1), matching.take(receptors_2.lng, rows_2))
+        lat = numpy.where(rows_1 >= 0, matching.take(receptors_1.lat, rows_1), matching.take(receptors_2.lat, rows_2))
+        receptor_ids = []
+        for (id_1, id_2) in zip(matching.take(receptors_1.id, rows_1, -1).tolist(),
+                                matching.take(receptors_2.id, rows_2, -1).tolist()):
+            if id_1 < 0:
+                receptor_ids.append(str(id_2))
+            elif id_2 < 0 or id_1 == id_2:
+                receptor_ids.append(str(id_1))
             else:
-                data_point = data_points[receptor.x, receptor.y]
-                if receptor_id != data_point.receptor_id:
-                    data_point.receptor_id = str(data_point.receptor_id) + "_" + str(receptor_id)
-                data_point.scenario_2_area_value = area_val
-                data_point.scenario_2_point_value = point_val
-                data_point.scenario_2_rail_value = rail_val
-                data_point.scenario_2_road_value = road_val
-                data_point.scenario_2_sit_value = sit_val
-                data_point.scenario_2_total_value = total_val
-                data_point.area_value=comp_f(data_point.scenario_1_area_value, area_val),
-                data_point.point_value=comp_f(data_point.scenario_1_point_value, point_val),
-                data_point.rail_value=comp_f(data_point.scenario_1_rail_value, rail_val),
-                data_point.road_value=comp_f(data_point.scenario_1_road_value, road_val),
-                data_point.sit_value=comp_f(data_point.scenario_1_sit_value, sit_val),
-                data_point.total_value=comp_f(data_point.scenario_1_total_value, total_val)
-        self.results = data_points.values()
-
-    def create_package(self):
-        output_directory_1 = os.path.join(self.temp_dir, self.scenario_1.safe_name)
-        output_directory_2 = os.path.join(self.temp_dir, self.scenario_2.safe_name)
-        os.mkdir(output_directory_1)
-        os.mkdir(output_directory_2)
-        shutil.copy(os.path.join(self.output_directory_1, "concentrations.png"), self.temp_dir)
-        shutil.copy(os.path.join(self.output_directory_1, "concentrations_legend.png"), self.temp_dir)
-        shutil.copy(os.path.join(ctools_backend.settings.template_directory, "ctools.prj"), self.temp_dir)
-        shutil.copy(os.path.join(self.output_directory_1, "CTOOLS_Inputs.txt"), output_directory_1)
-        for filename in glob.glob(os.path.join(self.output_directory_1, "*.csv")):
-            shutil.copy(filename, output_directory_1)
-        shutil.copy(os.path.join(self.output_directory_2, "CTOOLS_Inputs.txt"), output_directory_2)
-        for filename in glob.glob(os.path.join(self.output_directory_2, "*.csv")):
-            shutil.copy(filename, output_directory_2)
-        starting_dir = os.getcwd()
-        os.chdir(ctools_backend.settings.output_tar_directory)
-        subprocess.call(["tar", "-C", self.temp_dir, "-czf", self.results_file_name, "."])
-        os.chdir(starting_dir)
-        self.status = "completed"
-        self.last_update = datetime.datetime.now()
+                receptor_ids.append("%d_%d" % (id_1, id_2))
+
+        srid = bulk.geometry_srid(ComparisonScenarioRunResultDataPoint.__table__.c.receptor_location)
+        rows = ([receptor_id, bulk.point_ewkt(row_lng, row_lat, srid)] + [nan_to_none(v) for v in row_values]
+                for (receptor_id, row_lng, row_lat, row_values) in zip(
+                    receptor_ids, lng.tolist(), lat.tolist(),
+                    numpy.hstack([values_1, values_2, differences]).tolist()))
+        self._write_results(ComparisonScenarioRunResultDataPoint, rows, len(receptor_ids), progress, batch_size)
+        self._store_results(lng, lat, {t: differences[:, i] for (i, t) in enumerate(self.result_types)})
+
+    @property
+    def package_members(self):
+        return ([(self.image_file, "concentrations.png"),
+                 (self.legend_file, "concentrations_legend.png"),
+                 (os.path.join(ctools_backend.settings.template_directory, "ctools.prj"), "ctools.prj")] +
+                packaging.directory_members(self.output_directory_1, self.scenario_1.safe_name) +
+                packaging.directory_members(self.output_directory_2, self.scenario_2.safe_name))
 
     def failed(self):
         self.status = "failed"
@@ -954,6 +1335,13 @@ class ComparisonScenarioRun(Base, AbstractScenarioRun):
             output_directory = self.output_directory_2
         return os.path.join(output_directory, "receptors.csv")
 
+    def output_file(self, scenario, model_source_type):
+        if scenario == self.scenario_1:
+            output_directory = self.output_directory_1
+        else:
+            output_directory = self.output_directory_2
+        return os.path.join(output_directory, "results_CTOOLS_%s_%s_Output.csv" % (self.mode_name, model_source_type))
+
     def area_file(self, scenario):
         if scenario == self.scenario_1:
             output_directory = self.output_directory_1
@@ -989,7 +1377,20 @@ class ComparisonScenarioRun(Base, AbstractScenarioRun):
             output_directory = self.output_directory_2
         return os.path.join(output_directory, "results_CTOOLS_%s_SIT_Output.csv" % self.mode_name)
 
+    def _display_values(self, values):
+        values = numpy.nan_to_num(values)
+        if self.comparison_mode == 1:
+            abs_values = numpy.abs(values)
+            return numpy.where(abs_values <= 1, 0, numpy.sign(values) * numpy.log10(numpy.maximum(abs_values, 1)))
+        return values
+
     def generate_concentration_array(self, source_type=None):
+        result_type = self._result_type(source_type)
+        store = self.stored_results
+        if store is not None and result_type in store:
+            # A read-only view of the mapped store; callers that need to change values must copy it first.
+            return store.concentration_array(result_type)
+
         def transform_concentration(c):
             (x, y) = point_wkt_to_array(c[0])
             if self.comparison_mode == 1:
@@ -1008,8 +1409,13 @@ class ComparisonScenarioRun(Base, AbstractScenarioRun):
         return numpy.array([transform_concentration(c) for c in concentrations])
 
 
+status_channel.register(Session, [ScenarioRun, ComparisonScenarioRun])
+result_store.register(Session)
+
+
 class ScenarioRunResultDataPoint(Base):
     __tablename__ = "scenario_run_result_data_point"
+    value_columns = ["area_value", "point_value", "rail_value", "road_value", "sit_value", "total_value"]
     scenario_run_result_id = sa.Column(sa.Integer, primary_key=True)
     scenario_run_id = sa.Column(sa.Integer, sa.ForeignKey("scenario_run.scenario_run_id"))
     receptor_location = sa.Column(Geometry("POINT"))
@@ -1039,6 +1445,11 @@ class ScenarioRunResultDataPoint(Base):
 
 class ComparisonScenarioRunResultDataPoint(Base):
     __tablename__ = "comparison_scenario_run_result_data_point"
+    value_columns = ["scenario_1_area_value", "scenario_1_point_value", "scenario_1_rail_value",
+                     "scenario_1_road_value", "scenario_1_sit_value", "scenario_1_total_value",
+                     "scenario_2_area_value", "scenario_2_point_value", "scenario_2_rail_value",
+                     "scenario_2_road_value", "scenario_2_sit_value", "scenario_2_total_value",
+                     "area_value", "point_value", "rail_value", "road_value", "sit_value", "total_value"]
     scenario_run_result_id = sa.Column(sa.Integer, primary_key=True)
     scenario_run_id = sa.Column(sa.Integer, sa.ForeignKey("comparison_scenario_run.scenario_run_id"))
     receptor_location = sa.Column(Geometry("POINT"))
@@ -1094,24 +1505,194 @@ class CensusBlockGroup(Base):
     __tablename__ = "census_block_groups"
     gid = sa.Column(sa.Integer, primary_key=True)
     geom = sa.Column(Geometry('MULTIPOLYGON'))
+    population = sa.Column(sa.Numeric(asdecimal=False))
+
+    @classmethod
+    def _geometry_rows(cls, session, bounds):
+        criteria = []
+        if bounds is not None:
+            srid = bulk.geometry_srid(cls.__table__.c.geom)
+            envelope = sa.func.ST_MakeEnvelope(*(list(bounds) + ([srid] if srid is not None and srid > 0 else [])))
+            criteria.append(cls.geom.ST_Intersects(envelope))
+        rows = session.query(cls.gid, cls.population, sa.func.ST_AsBinary(cls.geom)).filter(*criteria)\
+            .order_by(cls.gid).all()
+        (gids, population, geometries) = list(zip(*rows)) if rows else ((), (), ())
+        population = numpy.array([numpy.nan if p is None else p for p in population], dtype=numpy.float64)
+        return numpy.array(gids, dtype=numpy.int64), population, geometries
+
+    @classmethod
+    def backfill_population(cls, session, path, batch_size=bulk.batch_size):
+        # path is a CSV with a header and gid, population columns, e.g. ACS table B01003 joined onto gid.
+        update = cls.__table__.update().where(cls.__table__.c.gid == sa.bindparam("b_gid"))\
+            .values(population=sa.bindparam("b_population"))
+        with open(path) as population_file:
+            reader = csv.reader(population_file)
+            next(reader)
+            batch = []
+            for (gid, population) in reader:
+                batch.append({"b_gid": int(gid), "b_population": float(population) if population.strip() else None})
+                if len(batch) >= batch_size:
+                    session.execute(update, batch)
+                    batch = []
+            if batch:
+                session.execute(update, batch)
+
+    @classmethod
+    def bulk_load(cls, session, bounds=None):
+        (gids, population, geometries) = cls._geometry_rows(session, bounds)
+        (coordinates, geometry_offsets, part_offsets) = wkb.decode(geometries, exterior_only=False)
+        return gids, population, coordinates, geometry_offsets, part_offsets
+
+    @classmethod
+    def bulk_load_polygons(cls, session, bounds=None):
+        (gids, _, geometries) = cls._geometry_rows(session, bounds)
+        return (gids,) + wkb.decode_polygons(geometries)
 
     @property
     def to_dict(self):
         try:
-            return {
-                "gid": self.gid,
-                "geom": geo.multipolygon_to_point_list(self.geom)
-            }
-        except:
-            print "bad census block group:", self.gid
-            return {
-                "gid": self.gid,
-                "geom": None
-            }
+            geom = geo.multipolygon_to_point_list(self.geom)
+        except Exception:
+            logger.exception("Bad census block group geometry: %s", self.gid)
+            geom = None
+        return {
+            "gid": self.gid,
+            "geom": geom
+        }
+
+
+class CensusBlockGroupGeometry(Base):
+    __tablename__ = "census_block_group_geometries"
+    gid = sa.Column(sa.Integer, sa.ForeignKey("census_block_groups.gid"), primary_key=True)
+    zoom = sa.Column(sa.Integer, primary_key=True)
+    min_lng = sa.Column(sa.Numeric(asdecimal=False))
+    min_lat = sa.Column(sa.Numeric(asdecimal=False))
+    max_lng = sa.Column(sa.Numeric(asdecimal=False))
+    max_lat = sa.Column(sa.Numeric(asdecimal=False))
+    vertex_count = sa.Column(sa.Integer)
+    data = sa.Column(sa.LargeBinary)
+    __table_args__ = (sa.Index("census_block_group_geometries_bounds", "zoom", "min_lng", "max_lng", "min_lat",
+                               "max_lat"),)
+
+    @classmethod
+    def rebuild(cls, session, bounds=None, zooms=geometry_cache.zooms, batch_size=bulk.batch_size):
+        # Shared boundaries are only kept coincident between block groups simplified together, so regional
+        # rebuilds should cover whole areas of interest.
+        (gids, coordinates, geometry_offsets, polygon_offsets, ring_offsets) = \
+            CensusBlockGroup.bulk_load_polygons(session, bounds)
+        coordinate_offsets = ring_offsets[polygon_offsets[geometry_offsets]]
+        counts = numpy.diff(coordinate_offsets)
+        extents = numpy.full((len(gids), 4), numpy.nan)
+        filled = numpy.flatnonzero(counts)
+        if len(filled):
+            starts = coordinate_offsets[filled]
+            extents[filled, :2] = numpy.minimum.reduceat(coordinates, starts)[:, :2]
+            extents[filled, 2:] = numpy.maximum.reduceat(coordinates, starts)[:, :2]
+        table = cls.__table__
+        for start in range(0, len(gids), batch_size):
+            session.execute(table.delete().where(table.c.gid.in_(gids[start:start + batch_size].tolist())))
+        for zoom in zooms:
+            geometries = geometry_cache.simplify(coordinates, geometry_offsets, polygon_offsets, ring_offsets, zoom)
+            rows = [{"gid": gid, "zoom": zoom, "min_lng": nan_to_none(extent[0]), "min_lat": nan_to_none(extent[1]),
+                     "max_lng": nan_to_none(extent[2]), "max_lat": nan_to_none(extent[3]),
+                     "vertex_count": geometry_cache.vertex_count(polygons), "data": geometry_cache.encode(polygons)}
+                    for (gid, extent, polygons) in zip(gids.tolist(), extents, geometries)]
+            for start in range(0, len(rows), batch_size):
+                session.execute(table.insert(), rows[start:start + batch_size])
+        return len(gids)
+
+    @classmethod
+    def serve(cls, session, zoom, bounds=None):
+        zoom = geometry_cache.level_for_zoom(zoom)
+        query = session.query(cls.gid, cls.data).filter(cls.zoom == zoom)
+        if bounds is not None:
+            (min_lng, min_lat, max_lng, max_lat) = bounds
+            query = query.filter(cls.max_lng >= min_lng, cls.min_lng <= max_lng,
+                                 cls.max_lat >= min_lat, cls.min_lat <= max_lat)
+        return [{"gid": gid, "geom": geometry_cache.decode(bytes(data), zoom)}
+                for (gid, data) in query.order_by(cls.gid)]
+
+
+class RunJob(Base):
+    __tablename__ = "run_job"
+    run_classes = {"scenario_run": ScenarioRun, "comparison_scenario_run": ComparisonScenarioRun}
+    job_id = sa.Column(sa.Integer, primary_key=True)
+    run_type = sa.Column(sa.Text)
+    scenario_run_id = sa.Column(sa.Integer)
+    status = sa.Column(sa.Text)
+    attempts = sa.Column(sa.Integer, default=0)
+    worker_pid = sa.Column(sa.Integer)
+    error = sa.Column(sa.Text)
+    transitions = sa.Column(JSON)
+    created = sa.Column(sa.DateTime)
+    last_update = sa.Column(sa.DateTime)
+
+    def __init__(self, run=None, **kwargs):
+        if run is not None:
+            kwargs.setdefault("run_type", run.__tablename__)
+            kwargs.setdefault("scenario_run_id", run.scenario_run_id)
+        super(RunJob, self).__init__(**kwargs)
+        self.created = datetime.datetime.now()
+        self.transitions = []
+        self.transition("queued")
+
+    def transition(self, status, error=None):
+        self.status = status
+        self.error = error
+        self.last_update = datetime.datetime.now()
+        self.transitions = (self.transitions or []) + [[status, self.last_update.isoformat()]]
+
+    def load_run(self, session):
+        return session.query(self.run_classes[self.run_type]).get(self.scenario_run_id)
+
+    @property
+    def to_dict(self):
+        return {
+            "job_id": self.job_id,
+            "run_type": self.run_type,
+            "scenario_run_id": self.scenario_run_id,
+            "status": self.status,
+            "attempts": self.attempts,
+            "error": self.error,
+            "transitions": self.transitions,
+            "last_update": self.last_update.isoformat()
+        }
+
+
+# Columns added to tables that deployed databases already have, which create() leaves untouched.
+schema_upgrades = [
+    "ALTER TABLE scenario ADD COLUMN IF NOT EXISTS source_bounds json",
+    "ALTER TABLE scenario_run ADD COLUMN IF NOT EXISTS package_manifest json",
+    "ALTER TABLE comparison_scenario_run ADD COLUMN IF NOT EXISTS package_manifest json",
+    "ALTER TABLE scenario_run ADD COLUMN IF NOT EXISTS fingerprint text",
+    "ALTER TABLE scenario_run ADD COLUMN IF NOT EXISTS source_fingerprints json",
+    "ALTER TABLE scenario_run ADD COLUMN IF NOT EXISTS source_run_id integer "
+    "REFERENCES scenario_run (scenario_run_id)",
+    "CREATE INDEX IF NOT EXISTS ix_scenario_run_fingerprint ON scenario_run (fingerprint)",
+    "ALTER TABLE scenario_run ADD COLUMN IF NOT EXISTS base_run_id integer REFERENCES scenario_run (scenario_run_id)",
+    "ALTER TABLE census_block_groups ADD COLUMN IF NOT EXISTS population numeric"
+] + ["ALTER TABLE scenario ADD COLUMN IF NOT EXISTS %s_data bytea" % source_list
+     for (source_list, _, _) in Scenario.source_lists]
+
+
+def upgrade_schema():
+    with engine.begin() as connection:
+        for statement in schema_upgrades:
+            connection.execute(sa.text(statement))
 
 
 if __name__ == "__main__":
     session = Session()
-    CensusBlockGroup.__table__.create()
-    ScenarioRunResultDataPoint.__table__.create()
-    ComparisonScenarioRunResultDataPoint.__table__.create()
\ No newline at end of file
+    CensusBlockGroup.__table__.create(checkfirst=True)
+    CensusBlockGroupGeometry.__table__.create(checkfirst=True)
+    ScenarioRunResultDataPoint.__table__.create(checkfirst=True)
+    ComparisonScenarioRunResultDataPoint.__table__.create(checkfirst=True)
+    RunJob.__table__.create(checkfirst=True)
+    upgrade_schema()
+    if source_codec.enabled:
+        Scenario.encode_source_payloads(session)
+    if len(sys.argv) > 1:
+        CensusBlockGroup.backfill_population(session, sys.argv[1])
+        session.commit()
+        # Cached zone assignments carry the populations they were built with.
+        zonal.cache.disk.remove("")
@@ -0,0 +1,142 @@
+import json
+import select
+import threading
+import time
+
+import sqlalchemy as sa
+from sqlalchemy.orm import object_session
+
+import ctools_backend.settings
+from ctools.cache import LRUCache
+
+channel_name = getattr(ctools_backend.settings, "status_channel", "ctools_run_status")
+cache_size = getattr(ctools_backend.settings, "status_cache_size", 10000)
+wait_timeout = getattr(ctools_backend.settings, "status_wait_timeout", 30.0)
+poll_interval = getattr(ctools_backend.settings, "status_listen_poll_interval", 5.0)
+reconnect_delay = getattr(ctools_backend.settings, "status_listen_reconnect_delay", 1.0)
+local_ttl = getattr(ctools_backend.settings, "status_cache_local_ttl", 2.0)
+
+
+class StatusChannel(object):
+
+    def __init__(self, engine, channel=channel_name, cache_size=cache_size, local_ttl=local_ttl):
+        self.engine = engine
+        self.channel = channel
+        self.remote = engine.dialect.name == "postgresql"
+        # Without LISTEN/NOTIFY, changes committed by other processes (e.g. job workers) are never heard,
+        # so cached statuses are only trusted briefly.
+        self.ttl = None if self.remote else local_ttl
+        self.cache = LRUCache(cache_size)
+        self.condition = threading.Condition()
+        self.ready = threading.Event()
+        self.listener = None
+        self._lock = threading.Lock()
+
+    def register(self, session_factory, run_classes):
+        for run_class in run_classes:
+            sa.event.listen(run_class, "after_insert", self._status_written)
+            sa.event.listen(run_class, "after_update", self._status_written)
+        sa.event.listen(session_factory, "after_commit", self._committed)
+        sa.event.listen(session_factory, "after_soft_rollback", self._rolled_back)
+
+    def _status_written(self, mapper, connection, target):
+        if not sa.inspect(target).attrs.status.history.has_changes():
+            return
+        key = (target.__tablename__, target.scenario_run_id)
+        if self.remote:
+            # NOTIFY is transactional: listeners only hear about the change once it is committed.
+            connection.execute(sa.text("SELECT pg_notify(:channel, :payload)"),
+                               channel=self.channel, payload=json.dumps(list(key) + [target.status]))
+        object_session(target).info.setdefault("pending_statuses", {})[key] = target.status
+
+    def _committed(self, session):
+        for (key, status) in session.info.pop("pending_statuses", {}).items():
+            self.update(key, status)
+
+    def _rolled_back(self, session, previous_transaction):
+        session.info.pop("pending_statuses", None)
+
+    def _store(self, key, status):
+        self.cache.put(tuple(key), (status, None if self.ttl is None else time.time() + self.ttl))
+
+    def _cached(self, key):
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+        (status, expires) = entry
+        if expires is not None and expires <= time.time():
+            self.cache.pop(key)
+            return None
+        return status
+
+    def update(self, key, status):
+        with self.condition:
+            self._store(key, status)
+            self.condition.notify_all()
+
+    def forget(self, key):
+        self.cache.pop(tuple(key))
+
+    def _listen(self):
+        while True:
+            try:
+                connection = self.engine.raw_connection()
+                try:
+                    dbapi_connection = connection.connection
+                    dbapi_connection.set_isolation_level(0)
+                    dbapi_connection.cursor().execute('LISTEN "%s"' % self.channel)
+                    self.ready.set()
+                    while True:
+                        if select.select([dbapi_connection], [], [], poll_interval) == ([], [], []):
+                            continue
+                        dbapi_connection.poll()
+                        while dbapi_connection.notifies:
+                            (table, run_id, status) = json.loads(dbapi_connection.notifies.pop(0).payload)
+                            self.update((table, run_id), status)
+                finally:
+                    connection.invalidate()
+            except Exception:
+                # Changes made while disconnected were never heard, so nothing cached can be trusted.
+                self.ready.clear()
+                self.cache.clear()
+                time.sleep(reconnect_delay)
+
+    def _ensure_listener(self):
+        if not self.remote:
+            return True
+        with self._lock:
+            if self.listener is None or not self.listener.is_alive():
+                self.ready.clear()
+                self.cache.clear()
+                self.listener = threading.Thread(target=self._listen, name="ctools-status-listener")
+                self.listener.daemon = True
+                self.listener.start()
+        return self.ready.wait(reconnect_delay)
+
+    def status(self, key, load):
+        if not self._ensure_listener():
+            return load()
+        status = self._cached(key)
+        if status is None:
+            status = load()
+            with self.condition:
+                cached = self._cached(key)
+                if cached is not None:
+                    status = cached
+                else:
+                    self._store(key, status)
+        return status
+
+    def wait(self, key, known_status, load, timeout=wait_timeout):
+        deadline = time.time() + timeout
+        status = self.status(key, load)
+        while status == known_status:
+            remaining = deadline - time.time()
+            if remaining <= 0 or (self.remote and not self.ready.is_set()):
+                break
+            with self.condition:
+                # Checked under the lock so an update landing before the wait still wakes it.
+                if self._cached(key) == known_status:
+                    self.condition.wait(min(remaining, poll_interval if self.ttl is None else self.ttl))
+            status = self.status(key, load)
+        return status
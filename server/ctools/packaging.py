@@ -0,0 +1,246 @@
+import collections
+import glob
+import multiprocessing
+import os
+import stat
+import struct
+import tarfile
+import threading
+import zlib
+from multiprocessing.pool import ThreadPool
+
+import ctools_backend.settings
+from ctools.cache import evict_directory
+
+compression_level = getattr(ctools_backend.settings, "package_compression_level", 6)
+threads = getattr(ctools_backend.settings, "package_threads", None) or multiprocessing.cpu_count()
+block_size = getattr(ctools_backend.settings, "package_block_size", 1024 * 1024)
+chunk_size = getattr(ctools_backend.settings, "package_chunk_size", 256 * 1024)
+lazy = getattr(ctools_backend.settings, "lazy_packages", False)
+directory = ctools_backend.settings.output_tar_directory
+# Lazily built archives are evicted, so they are kept apart from the archives written when runs finish.
+cache_directory = getattr(ctools_backend.settings, "package_cache_directory", os.path.join(directory, "package_cache"))
+cache_max_size = getattr(ctools_backend.settings, "package_cache_max_bytes", 1024 * 1024 * 1024)
+
+_gzip_header = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+
+
+def _gzip_member(block, level):
+    # Each block becomes a complete gzip member; concatenated members are a valid gzip stream.
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = compressor.compress(block) + compressor.flush()
+    trailer = struct.pack("<II", zlib.crc32(block) & 0xffffffff, len(block) & 0xffffffff)
+    return _gzip_header + body + trailer
+
+
+class _Chunks(object):
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def drain(self):
+        (chunks, self.chunks) = (self.chunks, [])
+        return chunks
+
+
+class BlockCompressor(object):
+
+    def __init__(self, fileobj, level=compression_level, threads=threads, block_size=block_size):
+        self.fileobj = fileobj
+        self.level = level
+        self.threads = max(threads, 1)
+        self.block_size = block_size
+        self.pool = ThreadPool(self.threads)
+        self.pending = collections.deque()
+        self.buffer = []
+        self.buffered = 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.block_size:
+            self._submit()
+
+    def _submit(self):
+        block = b"".join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        self.pending.append(self.pool.apply_async(_gzip_member, (block, self.level)))
+        while len(self.pending) > 2 * self.threads or (self.pending and self.pending[0].ready()):
+            self.fileobj.write(self.pending.popleft().get())
+
+    def close(self):
+        try:
+            if self.buffered or not self.pending:
+                self._submit()
+            while self.pending:
+                self.fileobj.write(self.pending.popleft().get())
+        finally:
+            self.pool.close()
+            self.pool.join()
+
+
+def directory_members(directory, arcname):
+    members = [(directory, arcname), (os.path.join(directory, "CTOOLS_Inputs.txt"), arcname + "/CTOOLS_Inputs.txt")]
+    for path in sorted(glob.glob(os.path.join(directory, "*.csv"))):
+        members.append((path, "%s/%s" % (arcname, os.path.basename(path))))
+    return members
+
+
+def _tar_info(source_path, arcname):
+    st = os.stat(source_path)
+    info = tarfile.TarInfo(arcname)
+    info.mode = stat.S_IMODE(st.st_mode)
+    info.mtime = int(st.st_mtime)
+    if stat.S_ISDIR(st.st_mode):
+        info.type = tarfile.DIRTYPE
+    else:
+        info.size = st.st_size
+    return info
+
+
+def tar_chunks(members, chunk_size=chunk_size):
+    for (source_path, arcname) in members:
+        info = _tar_info(source_path, arcname)
+        yield info.tobuf(tarfile.PAX_FORMAT)
+        if not info.isreg():
+            continue
+        remaining = info.size
+        with open(source_path, "rb") as f:
+            while remaining > 0:
+                data = f.read(min(chunk_size, remaining))
+                if not data:
+                    raise IOError("%s changed size while it was being packaged" % source_path)
+                remaining -= len(data)
+                yield data
+        padding = -info.size % tarfile.BLOCKSIZE
+        if padding:
+            yield tarfile.NUL * padding
+    yield tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+
+
+def stream_package(members, level=compression_level, threads=threads, block_size=block_size, chunk_size=chunk_size):
+    output = _Chunks()
+    compressor = BlockCompressor(output, level, threads, block_size)
+    try:
+        for data in tar_chunks(members, chunk_size):
+            compressor.write(data)
+            for chunk in output.drain():
+                yield chunk
+    finally:
+        compressor.close()
+    for chunk in output.drain():
+        yield chunk
+
+
+def write_package(path, members, level=compression_level, threads=threads, block_size=block_size):
+    temp_path = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        with open(temp_path, "wb") as f:
+            for chunk in stream_package(members, level, threads, block_size):
+                f.write(chunk)
+        os.rename(temp_path, path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return path
+
+
+def read_chunks(path, chunk_size=chunk_size):
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            yield data
+
+
+class PackageCache(object):
+
+    def __init__(self, directory=cache_directory, max_size=cache_max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def path(self, name):
+        return os.path.join(self.directory, os.path.basename(name))
+
+    def _cached(self, path, chunk_size):
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return read_chunks(path, chunk_size)
+
+    def _generate(self, path, members, level, chunk_size):
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                pass
+        temp_path = "%s.%d.%d.tmp" % (path, os.getpid(), threading.current_thread().ident)
+        complete = False
+        try:
+            with open(temp_path, "wb") as f:
+                for chunk in stream_package(members, level, chunk_size=chunk_size):
+                    f.write(chunk)
+                    yield chunk
+            complete = True
+        finally:
+            # An abandoned download still leaves a partial file behind; only complete archives are cached.
+            if complete:
+                os.rename(temp_path, path)
+                self.evict()
+            elif os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def stream(self, name, members, level=compression_level, chunk_size=chunk_size):
+        path = self.path(name)
+        if os.path.isfile(path):
+            self.hits += 1
+            return self._cached(path, chunk_size)
+        self.misses += 1
+        return self._generate(path, members, level, chunk_size)
+
+    def evict(self):
+        with self._lock:
+            self.evictions += evict_directory(self.directory, self.max_size, ".tar.gz")
+
+    def remove(self, name):
+        try:
+            os.remove(self.path(name))
+        except OSError:
+            pass
+
+    @property
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+cache = PackageCache()
+
+
+def archive_path(name):
+    return os.path.join(directory, os.path.basename(name))
+
+
+def stream(name, members, level=compression_level, chunk_size=chunk_size):
+    path = archive_path(name)
+    if os.path.isfile(path):
+        return read_chunks(path, chunk_size)
+    return cache.stream(name, members, level, chunk_size)
+
+
+def remove(name):
+    try:
+        os.remove(archive_path(name))
+    except OSError:
+        pass
+    cache.remove(name)
@@ -0,0 +1,109 @@
+import numpy
+from scipy.spatial import cKDTree
+
+import ctools_backend.settings
+from ctools import geo_arrays
+from ctools.cache import LRUCache
+
+cache_size = getattr(ctools_backend.settings, "point_index_cache_max_bytes", 256 * 1024 * 1024)
+default_neighbours = getattr(ctools_backend.settings, "point_index_neighbours", 8)
+default_power = getattr(ctools_backend.settings, "point_index_power", 2.0)
+
+earth_radius = 6371008.8
+
+
+def _chord(distance):
+    if distance is None:
+        return numpy.inf
+    return 2 * numpy.sin(min(distance / earth_radius, numpy.pi) / 2)
+
+
+def _metres(chord):
+    return numpy.where(numpy.isinf(chord), numpy.inf, 2 * earth_radius * numpy.arcsin(numpy.clip(chord / 2, 0, 1)))
+
+
+class PointIndex(object):
+
+    def __init__(self, lng, lat, values, result_types):
+        self.lng = numpy.asarray(lng, dtype=numpy.float64)
+        self.lat = numpy.asarray(lat, dtype=numpy.float64)
+        self.values = numpy.asarray(values, dtype=numpy.float64).reshape(len(self.lng), -1)
+        self.result_types = list(result_types)
+        self.tree = cKDTree(geo_arrays.unit_vectors(self.lng, self.lat)) if len(self.lng) else None
+
+    def __len__(self):
+        return len(self.lng)
+
+    @property
+    def nbytes(self):
+        # The tree keeps its own copy of the points plus an index array.
+        return self.lng.nbytes + self.lat.nbytes + self.values.nbytes + len(self.lng) * 32
+
+    def _columns(self, result_types):
+        if isinstance(result_types, str):
+            return self.result_types.index(result_types)
+        return [self.result_types.index(t) for t in result_types]
+
+    def _query(self, lng, lat, k, max_distance):
+        points = geo_arrays.unit_vectors(numpy.atleast_1d(lng), numpy.atleast_1d(lat))
+        return self.tree.query(points, k=k, distance_upper_bound=_chord(max_distance))
+
+    def nearest(self, lng, lat, result_types="total", max_distance=None):
+        columns = self._columns(result_types)
+        count = len(numpy.atleast_1d(lng))
+        shape = (count,) if isinstance(columns, int) else (count, len(columns))
+        if self.tree is None:
+            return numpy.full(shape, numpy.nan), numpy.full(count, numpy.inf), numpy.full(count, -1)
+        (chords, indices) = self._query(lng, lat, 1, max_distance)
+        # Misses come back as index len(self) with an infinite distance.
+        found = indices < len(self)
+        values = numpy.full(shape, numpy.nan)
+        values[found] = self.values[indices[found]][:, columns]
+        return values, _metres(chords), numpy.where(found, indices, -1)
+
+    def interpolate(self, lng, lat, result_types="total", k=default_neighbours, power=default_power,
+                    max_distance=None):
+        columns = self._columns(result_types)
+        count = len(numpy.atleast_1d(lng))
+        k = min(k, len(self))
+        if not k:
+            return numpy.full((count,) if isinstance(columns, int) else (count, len(columns)), numpy.nan)
+        (chords, indices) = self._query(lng, lat, k, max_distance)
+        (chords, indices) = (chords.reshape(count, k), indices.reshape(count, k))
+        found = indices < len(self)
+        values = self.values[numpy.where(found, indices, 0)][:, :, numpy.atleast_1d(columns)]
+        with numpy.errstate(divide="ignore"):
+            weights = numpy.where(found, 1.0 / _metres(chords) ** power, 0.0)
+        # A query landing on a receptor takes that receptor's value outright.
+        exact = chords == 0
+        hits = exact.any(axis=1)
+        weights[hits] = exact[hits]
+        present = numpy.isfinite(values)
+        weights = weights[:, :, None] * present
+        with numpy.errstate(invalid="ignore"):
+            result = (weights * numpy.where(present, values, 0.0)).sum(axis=1) / weights.sum(axis=1)
+        return result[:, 0] if isinstance(columns, int) else result
+
+
+class PointIndexCache(object):
+
+    def __init__(self, max_size=cache_size):
+        self.indexes = LRUCache(max_size, lambda index: index.nbytes)
+
+    @staticmethod
+    def run_key(run):
+        return (run.__tablename__, run.result_run_id)
+
+    def get(self, run):
+        key = self.run_key(run)
+        index = self.indexes.get(key)
+        if index is None:
+            (lng, lat, values) = run.result_values()
+            index = self.indexes.put(key, PointIndex(lng, lat, values, run.result_types))
+        return index
+
+    def invalidate(self, run):
+        self.indexes.pop(self.run_key(run))
+
+
+cache = PointIndexCache()
@@ -0,0 +1,118 @@
+import os
+
+import numpy
+import sqlalchemy as sa
+from numpy.lib import format as npy_format
+
+import ctools_backend.settings
+
+directory = getattr(ctools_backend.settings, "result_store_directory",
+                    os.path.join(ctools_backend.settings.scenario_run_directory, "result_store"))
+
+# Each value column is stored as an (n, 4) block of lng, lat, display value and raw value, so the
+# first three fields of a block can be handed out as the concentration array without copying.
+LNG, LAT, DISPLAY, RAW = range(4)
+
+
+def path(table_name, scenario_run_id):
+    return os.path.join(directory, "%s_%s.npy" % (table_name, scenario_run_id))
+
+
+def _write(temp_path, result_types, lng, lat, raw_values, display_values):
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass
+    lng = numpy.asarray(lng, dtype=numpy.float64)
+    lat = numpy.asarray(lat, dtype=numpy.float64)
+    store = npy_format.open_memmap(temp_path, mode="w+", dtype=numpy.float64,
+                                   shape=(len(result_types), len(lng), 4))
+    for (i, result_type) in enumerate(result_types):
+        store[i, :, LNG] = lng
+        store[i, :, LAT] = lat
+        store[i, :, DISPLAY] = display_values[result_type]
+        store[i, :, RAW] = raw_values[result_type]
+    store.flush()
+    del store
+    return temp_path
+
+
+def stage(session, table_name, scenario_run_id, result_types, lng, lat, raw_values, display_values):
+    # The store only replaces the live one once the session commits the data points it mirrors, and is
+    # thrown away if they roll back.
+    final_path = path(table_name, scenario_run_id)
+    temp_path = _write("%s.%d.%d.tmp" % (final_path, os.getpid(), id(session)), result_types, lng, lat,
+                       raw_values, display_values)
+    session.info.setdefault("staged_result_stores", []).append((temp_path, final_path))
+    return temp_path
+
+
+def _committed(session):
+    for (temp_path, final_path) in session.info.pop("staged_result_stores", []):
+        os.rename(temp_path, final_path)
+
+
+def _ended(session, transaction):
+    # Anything still staged when the outermost transaction ends without committing was rolled back or closed.
+    if transaction.parent is not None:
+        return
+    for (temp_path, _) in session.info.pop("staged_result_stores", []):
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+
+
+def register(session_factory):
+    sa.event.listen(session_factory, "after_commit", _committed)
+    sa.event.listen(session_factory, "after_transaction_end", _ended)
+
+
+def remove(table_name, scenario_run_id):
+    try:
+        os.remove(path(table_name, scenario_run_id))
+    except OSError:
+        pass
+
+
+def rename(table_name, old_scenario_run_id, new_scenario_run_id):
+    try:
+        os.rename(path(table_name, old_scenario_run_id), path(table_name, new_scenario_run_id))
+    except OSError:
+        pass
+
+
+class ResultStore(object):
+
+    def __init__(self, data, result_types):
+        self.data = data
+        self.result_types = list(result_types)
+
+    @classmethod
+    def open(cls, table_name, scenario_run_id, result_types):
+        store_path = path(table_name, scenario_run_id)
+        if not os.path.isfile(store_path):
+            return None
+        return cls(numpy.load(store_path, mmap_mode="r"), result_types)
+
+    def __len__(self):
+        return self.data.shape[1]
+
+    def __contains__(self, result_type):
+        return result_type in self.result_types
+
+    # Everything handed out is a read-only view of the mapped file.
+    @property
+    def lng(self):
+        return self.data[0, :, LNG]
+
+    @property
+    def lat(self):
+        return self.data[0, :, LAT]
+
+    def values(self, result_type):
+        return self.data[self.result_types.index(result_type), :, RAW]
+
+    def concentration_array(self, result_type):
+        return self.data[self.result_types.index(result_type), :, :RAW]
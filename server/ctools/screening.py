@@ -0,0 +1,354 @@
+import math
+
+import numpy
+
+# Control point spacing (in standard deviations) and heights (relative to the peak) of the cubic Bezier fitted
+# to one side of a normal distribution by gaussian2bezier.py.
+p0d = 0.858789829499
+p1d = 1.25486806631
+p1z = 0.004827763527348391
+p2d = 3
+p2z = 0.0111089965382
+
+_tail_offsets = numpy.array([-p2d, -p1d, -p0d, 0.0])
+_head_offsets = numpy.array([0.0, p0d, p1d, p2d])
+_lateral_offsets = numpy.array([-p2d, -p1d, -p0d, 0.0, p0d, p1d, p2d])
+_longitudinal_heights = numpy.array([p2z, p1z, 1, 1, 1, 1, p1z, p2z])
+_lateral_heights = numpy.array([p2z, p1z, 1, 1, 1, p1z, p2z])
+
+# Rows of the (8, 7) control grid run along the segment, columns across it.  The grid is cut into an upstream
+# tail, the segment body and a downstream tail, each split at the centre line.
+_surface_slices = [(slice(0, 4), slice(0, 4)), (slice(0, 4), slice(3, 7)),
+                   (slice(3, 5), slice(0, 4)), (slice(3, 5), slice(3, 7)),
+                   (slice(4, 8), slice(0, 4)), (slice(4, 8), slice(3, 7))]
+
+degree = 3
+chunk_size = 4096
+newton_iterations = 8
+profile_samples = 4097
+
+
+def _binomial(n, k):
+    return math.factorial(n) // math.factorial(k) // math.factorial(n - k)
+
+
+def bernstein_matrix(n):
+    # Row i holds the power basis coefficients of the Bernstein polynomial B(i, n).
+    matrix = numpy.zeros((n + 1, n + 1))
+    for i in range(n + 1):
+        for k in range(i, n + 1):
+            matrix[i, k] = _binomial(n, i) * _binomial(n - i, k - i) * (-1) ** (k - i)
+    return matrix
+
+
+def _powers(t, n=degree):
+    return numpy.asarray(t, dtype=numpy.float64)[..., None] ** numpy.arange(n + 1)
+
+
+def _derivative_powers(t, n=degree):
+    t = numpy.asarray(t, dtype=numpy.float64)
+    powers = numpy.zeros(t.shape + (n + 1,))
+    for k in range(1, n + 1):
+        powers[..., k] = k * t ** (k - 1)
+    return powers
+
+
+def _profile_table():
+    # Each side of every surface follows the same cubic Bezier, so it is sampled once and inverted by
+    # interpolation instead of solving for the surface parameter per receptor.
+    basis = _powers(numpy.linspace(0, 1, profile_samples)).dot(bernstein_matrix(degree).T)
+    distance = -basis.dot(_tail_offsets)
+    height = basis.dot(_longitudinal_heights[:4])
+    return distance[::-1], height[::-1]
+
+
+(_profile_distance, _profile_height) = _profile_table()
+
+
+def profile(distance):
+    distance = numpy.abs(distance)
+    return numpy.where(distance <= p2d, numpy.interp(distance, _profile_distance, _profile_height), 0.0)
+
+
+def control_points(x0, y0, x1, y1, z, standard_deviation, transform=None):
+    (x0, y0, x1, y1, z) = [numpy.atleast_1d(numpy.asarray(a, dtype=numpy.float64)) for a in (x0, y0, x1, y1, z)]
+    standard_deviation = numpy.broadcast_to(numpy.asarray(standard_deviation, dtype=numpy.float64), x0.shape)
+    (length, ux, uy) = _directions(x0, y0, x1, y1)
+    along = numpy.hstack([_tail_offsets * standard_deviation[:, None],
+                          length[:, None] + _head_offsets * standard_deviation[:, None]])
+    across = _lateral_offsets * standard_deviation[:, None]
+    points = numpy.empty((len(x0), len(_longitudinal_heights), len(_lateral_heights), 3))
+    points[..., 0] = x0[:, None, None] + along[:, :, None] * ux[:, None, None] - across[:, None, :] * uy[:, None, None]
+    points[..., 1] = y0[:, None, None] + along[:, :, None] * uy[:, None, None] + across[:, None, :] * ux[:, None, None]
+    points[..., 2] = z[:, None, None] * _longitudinal_heights[None, :, None] * _lateral_heights[None, None, :]
+    if transform is not None:
+        (points[..., 0], points[..., 1]) = _apply(transform, points[..., 0], points[..., 1])
+        points[..., 2] /= numpy.linalg.det(transform)
+    return points
+
+
+def _directions(x0, y0, x1, y1):
+    (dx, dy) = (x1 - x0, y1 - y0)
+    length = numpy.hypot(dx, dy)
+    degenerate = length == 0
+    safe_length = numpy.where(degenerate, 1, length)
+    return length, numpy.where(degenerate, 1, dx / safe_length), numpy.where(degenerate, 0, dy / safe_length)
+
+
+def _apply(transform, x, y):
+    transform = numpy.asarray(transform, dtype=numpy.float64)
+    return (x * transform[0, 0] + y * transform[1, 0] + transform[2, 0],
+            x * transform[0, 1] + y * transform[1, 1] + transform[2, 1])
+
+
+class BezierSurface(object):
+
+    def __init__(self, control_points):
+        self.control_points = numpy.asarray(control_points, dtype=numpy.float64)
+        (rows, columns) = self.control_points.shape[:2]
+        # Power basis form of x, y and z, so that value = [1, u, ...] . coefficients . [1, v, ...].
+        self.coefficients = numpy.einsum("ik,ijc,jl->ckl", bernstein_matrix(rows - 1), self.control_points,
+                                         bernstein_matrix(columns - 1))
+        (x, y) = (self.control_points[..., 0], self.control_points[..., 1])
+        self.bounds = [x.min(), y.min(), x.max(), y.max()]
+
+    def _polynomial(self, c, u_powers, v_powers):
+        return numpy.einsum("...k,kl,...l->...", u_powers, self.coefficients[c], v_powers)
+
+    def project_to_unit_square(self, x, y, iterations=newton_iterations):
+        (x, y) = (numpy.asarray(x, dtype=numpy.float64), numpy.asarray(y, dtype=numpy.float64))
+        (rows, columns) = self.control_points.shape[:2]
+        origin = self.control_points[0, 0, :2]
+        (e1, e2) = (self.control_points[-1, 0, :2] - origin, self.control_points[0, -1, :2] - origin)
+        determinant = e1[0] * e2[1] - e1[1] * e2[0]
+        (qx, qy) = (x - origin[0], y - origin[1])
+        u = (qx * e2[1] - qy * e2[0]) / determinant
+        v = (qy * e1[0] - qx * e1[1]) / determinant
+        # The control points are not evenly spaced, so the affine guess is refined with Newton steps.
+        for _ in range(iterations):
+            (u_powers, v_powers) = (_powers(u, rows - 1), _powers(v, columns - 1))
+            (du_powers, dv_powers) = (_derivative_powers(u, rows - 1), _derivative_powers(v, columns - 1))
+            (fx, fy) = (self._polynomial(0, u_powers, v_powers) - x, self._polynomial(1, u_powers, v_powers) - y)
+            (xu, yu) = (self._polynomial(0, du_powers, v_powers), self._polynomial(1, du_powers, v_powers))
+            (xv, yv) = (self._polynomial(0, u_powers, dv_powers), self._polynomial(1, u_powers, dv_powers))
+            jacobian = xu * yv - xv * yu
+            jacobian = numpy.where(jacobian == 0, numpy.inf, jacobian)
+            u = numpy.clip(u - (fx * yv - fy * xv) / jacobian, -0.5, 1.5)
+            v = numpy.clip(v - (fy * xu - fx * yu) / jacobian, -0.5, 1.5)
+        return u, v
+
+    def evaluate(self, u, v):
+        (rows, columns) = self.control_points.shape[:2]
+        (u, v) = (numpy.asarray(u, dtype=numpy.float64), numpy.asarray(v, dtype=numpy.float64))
+        inside = (u >= 0) & (u <= 1) & (v >= 0) & (v <= 1)
+        values = self._polynomial(2, _powers(numpy.clip(u, 0, 1), rows - 1), _powers(numpy.clip(v, 0, 1), columns - 1))
+        return numpy.where(inside, values, 0.0)
+
+    def evaluate_points(self, x, y):
+        return self.evaluate(*self.project_to_unit_square(x, y))
+
+
+class BicubicBezierSurface(BezierSurface):
+
+    def __init__(self, control_points):
+        super(BicubicBezierSurface, self).__init__(control_points)
+        if self.control_points.shape[:2] != (4, 4):
+            raise ValueError("A bicubic surface needs a 4 x 4 grid of control points")
+
+
+class SourceSet(object):
+
+    def __init__(self, x0, y0, x1, y1, z, standard_deviation, transform=None, sources=None):
+        (self.x0, self.y0, self.x1, self.y1, self.z) = [numpy.atleast_1d(numpy.asarray(a, dtype=numpy.float64))
+                                                        for a in (x0, y0, x1, y1, z)]
+        self.standard_deviation = numpy.array(numpy.broadcast_to(
+            numpy.asarray(standard_deviation, dtype=numpy.float64), self.x0.shape))
+        self.sources = numpy.arange(len(self.x0)) if sources is None else numpy.asarray(sources)
+        (self.length, self.ux, self.uy) = _directions(self.x0, self.y0, self.x1, self.y1)
+        self.transform = None if transform is None else numpy.asarray(transform, dtype=numpy.float64)
+        self.bounds = self._bounds()
+
+    def __len__(self):
+        return len(self.x0)
+
+    def _bounds(self):
+        reach = p2d * self.standard_deviation
+        along = numpy.column_stack([-reach, -reach, self.length + reach, self.length + reach])
+        across = numpy.column_stack([-reach, reach, -reach, reach])
+        x = self.x0[:, None] + along * self.ux[:, None] - across * self.uy[:, None]
+        y = self.y0[:, None] + along * self.uy[:, None] + across * self.ux[:, None]
+        if self.transform is not None:
+            (x, y) = _apply(self.transform, x, y)
+        return numpy.column_stack([x.min(axis=1), y.min(axis=1), x.max(axis=1), y.max(axis=1)])
+
+    def evaluate(self, indices, x, y):
+        z = self.z[indices]
+        if self.transform is not None:
+            (x, y) = _apply(numpy.linalg.inv(self.transform), x, y)
+            z = z / numpy.linalg.det(self.transform)
+        (qx, qy) = (x - self.x0[indices], y - self.y0[indices])
+        (ux, uy) = (self.ux[indices], self.uy[indices])
+        along = qx * ux + qy * uy
+        across = qy * ux - qx * uy
+        beyond = numpy.where(along < 0, along, numpy.maximum(along - self.length[indices], 0))
+        sd = self.standard_deviation[indices]
+        return z * profile(beyond / sd) * profile(across / sd)
+
+    def take(self, indices):
+        return SourceSet(self.x0[indices], self.y0[indices], self.x1[indices], self.y1[indices], self.z[indices],
+                         self.standard_deviation[indices], self.transform, self.sources[indices])
+
+    @classmethod
+    def concatenate(cls, source_sets):
+        source_sets = list(source_sets)
+        transforms = [s.transform for s in source_sets if s.transform is not None]
+        if transforms and (len(transforms) != len(source_sets) or
+                           any(not numpy.array_equal(t, transforms[0]) for t in transforms)):
+            raise ValueError("Only source sets sharing a transform can be combined")
+        return cls(*[numpy.concatenate([getattr(s, f) for s in source_sets])
+                     for f in ("x0", "y0", "x1", "y1", "z", "standard_deviation")],
+                   transform=transforms[0] if transforms else None,
+                   sources=numpy.concatenate([s.sources for s in source_sets]))
+
+
+class ModelSource(object):
+
+    def __init__(self, p0, p1, standard_deviation, transform=None):
+        (x0, y0, z) = p0
+        (x1, y1) = p1[:2]
+        self.source_set = SourceSet(x0, y0, x1, y1, z, standard_deviation, transform)
+        self.points = control_points(x0, y0, x1, y1, z, standard_deviation, transform)[0]
+        self.surfaces = [(BicubicBezierSurface if rows.stop - rows.start == 4 else BezierSurface)(
+            self.points[rows, columns]) for (rows, columns) in _surface_slices]
+
+    @property
+    def bounds(self):
+        return self.source_set.bounds[0].tolist()
+
+    def evaluate_points(self, x, y):
+        (x, y) = (numpy.asarray(x, dtype=numpy.float64), numpy.asarray(y, dtype=numpy.float64))
+        return self.source_set.evaluate(numpy.zeros(x.shape, dtype=numpy.intp), x, y)
+
+
+class ReceptorGrid(object):
+
+    def __init__(self, x, y, cell_size=None):
+        self.x = numpy.asarray(x, dtype=numpy.float64)
+        self.y = numpy.asarray(y, dtype=numpy.float64)
+        if not len(self.x):
+            (self.min_x, self.min_y, self.nx, self.ny, self.cell_size) = (0.0, 0.0, 1, 1, 1.0)
+            self.order = numpy.empty(0, dtype=numpy.intp)
+            self.starts = numpy.zeros(2, dtype=numpy.intp)
+            return
+        (self.min_x, self.min_y) = (self.x.min(), self.y.min())
+        if cell_size is None:
+            extent = max(numpy.ptp(self.x), numpy.ptp(self.y))
+            cell_size = extent / max(math.sqrt(len(self.x)), 1) or 1.0
+        self.cell_size = float(cell_size)
+        ix = numpy.floor((self.x - self.min_x) / self.cell_size).astype(numpy.intp)
+        iy = numpy.floor((self.y - self.min_y) / self.cell_size).astype(numpy.intp)
+        (self.nx, self.ny) = (int(ix.max()) + 1, int(iy.max()) + 1)
+        cells = iy * self.nx + ix
+        self.order = numpy.argsort(cells, kind="mergesort")
+        self.starts = numpy.searchsorted(cells[self.order], numpy.arange(self.nx * self.ny + 1))
+
+    def __len__(self):
+        return len(self.x)
+
+    def _cell_range(self, low, high, origin, count):
+        first = numpy.floor((low - origin) / self.cell_size)
+        last = numpy.floor((high - origin) / self.cell_size)
+        overlaps = (last >= 0) & (first < count)
+        return (numpy.clip(first, 0, count - 1).astype(numpy.intp), numpy.clip(last, 0, count - 1).astype(numpy.intp),
+                overlaps)
+
+    def candidates(self, bounds):
+        bounds = numpy.asarray(bounds, dtype=numpy.float64).reshape(-1, 4)
+        (x_first, x_last, x_overlaps) = self._cell_range(bounds[:, 0], bounds[:, 2], self.min_x, self.nx)
+        (y_first, y_last, y_overlaps) = self._cell_range(bounds[:, 1], bounds[:, 3], self.min_y, self.ny)
+        boxes = numpy.flatnonzero(x_overlaps & y_overlaps)
+        width = x_last[boxes] - x_first[boxes] + 1
+        cell_counts = width * (y_last[boxes] - y_first[boxes] + 1)
+        box_of_cell = numpy.repeat(numpy.arange(len(boxes)), cell_counts)
+        rank = numpy.arange(len(box_of_cell)) - numpy.repeat(numpy.cumsum(cell_counts) - cell_counts, cell_counts)
+        cells = ((y_first[boxes][box_of_cell] + rank // width[box_of_cell]) * self.nx +
+                 x_first[boxes][box_of_cell] + rank % width[box_of_cell])
+        counts = self.starts[cells + 1] - self.starts[cells]
+        box_of_point = numpy.repeat(box_of_cell, counts)
+        rank = numpy.arange(len(box_of_point)) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        points = self.order[numpy.repeat(self.starts[cells], counts) + rank]
+        box_bounds = bounds[boxes][box_of_point]
+        inside = ((self.x[points] >= box_bounds[:, 0]) & (self.x[points] <= box_bounds[:, 2]) &
+                  (self.y[points] >= box_bounds[:, 1]) & (self.y[points] <= box_bounds[:, 3]))
+        return boxes[box_of_point[inside]], points[inside]
+
+
+def screen(sources, grid, chunk_size=chunk_size):
+    concentrations = numpy.zeros(len(grid))
+    for start in range(0, len(sources), chunk_size):
+        chunk = numpy.arange(start, min(start + chunk_size, len(sources)))
+        (source_indices, receptor_indices) = grid.candidates(sources.bounds[chunk])
+        if not len(receptor_indices):
+            continue
+        values = sources.evaluate(chunk[source_indices], grid.x[receptor_indices], grid.y[receptor_indices])
+        concentrations += numpy.bincount(receptor_indices, weights=values, minlength=len(grid))
+    return concentrations
+
+
+def table_sources(table, emission_field, standard_deviation, projected=False):
+    if projected:
+        (x, y) = table.projected()
+    else:
+        (x, y) = (table.coordinates[:, 0], table.coordinates[:, 1])
+    emissions = numpy.nan_to_num(numpy.asarray(table.records[emission_field], dtype=numpy.float64))
+    vertex_sources = table.vertex_sources()
+    single = numpy.flatnonzero(numpy.diff(table.offsets) == 1)
+    first = table.offsets[single]
+    pairs = numpy.flatnonzero(vertex_sources[:-1] == vertex_sources[1:])
+    pair_sources = vertex_sources[pairs]
+    # A line's emissions are shared between its segments in proportion to their length.
+    lengths = numpy.hypot(x[pairs + 1] - x[pairs], y[pairs + 1] - y[pairs])
+    totals = numpy.bincount(pair_sources, weights=lengths, minlength=len(table))[pair_sources]
+    segment_counts = numpy.bincount(pair_sources, minlength=len(table))[pair_sources]
+    shares = numpy.where(totals > 0, lengths / numpy.where(totals > 0, totals, 1),
+                         1.0 / numpy.maximum(segment_counts, 1))
+    sources = numpy.concatenate([single, pair_sources])
+    z = numpy.concatenate([emissions[single], emissions[pair_sources] * shares])
+    keep = z > 0
+    return SourceSet(numpy.concatenate([x[first], x[pairs]])[keep], numpy.concatenate([y[first], y[pairs]])[keep],
+                     numpy.concatenate([x[first], x[pairs + 1]])[keep],
+                     numpy.concatenate([y[first], y[pairs + 1]])[keep],
+                     z[keep], standard_deviation, sources=sources[keep])
+
+
+class Viewport(object):
+
+    def __init__(self, min_lat, min_lon, max_lat, max_lon, x_pixels, y_pixels, pixel_ratio=1):
+        (self.min_lat, self.min_lon, self.max_lat, self.max_lon) = (min_lat, min_lon, max_lat, max_lon)
+        self.x_pixels = int(round(x_pixels * pixel_ratio))
+        self.y_pixels = int(round(y_pixels * pixel_ratio))
+        dx = (max_lon - min_lon) / float(self.x_pixels)
+        dy = (max_lat - min_lat) / float(self.y_pixels)
+        (lon, lat) = numpy.meshgrid(min_lon + (numpy.arange(self.x_pixels) + 0.5) * dx,
+                                    min_lat + (numpy.arange(self.y_pixels) + 0.5) * dy)
+        self.grid = ReceptorGrid(lon.ravel(), lat.ravel(), cell_size=8 * max(dx, dy))
+        self.values = numpy.zeros(self.y_pixels * self.x_pixels)
+
+    def load_sources(self, sources):
+        if not isinstance(sources, SourceSet):
+            sources = SourceSet.concatenate([source.source_set for source in sources])
+        self.values += screen(sources, self.grid)
+        return self
+
+    @property
+    def concentrations(self):
+        # Row 0 is the northern edge, matching image row order.
+        return self.values.reshape(self.y_pixels, self.x_pixels)[::-1]
+
+    @property
+    def max_value(self):
+        return float(self.values.max()) if len(self.values) else 0.0
+
+    def rasterize(self, color_map):
+        return numpy.asarray(color_map(self.concentrations), dtype=numpy.uint8).reshape(self.y_pixels,
+                                                                                         self.x_pixels, 4)
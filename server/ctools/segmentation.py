@@ -0,0 +1,77 @@
+import numpy
+
+from ctools import geo_arrays
+
+earth_radius = 6373
+
+segment_dtype = numpy.dtype([("source", numpy.int64),
+                             ("from_lng", numpy.float64), ("from_lat", numpy.float64),
+                             ("to_lng", numpy.float64), ("to_lat", numpy.float64),
+                             ("from_x", numpy.float64), ("from_y", numpy.float64),
+                             ("to_x", numpy.float64), ("to_y", numpy.float64),
+                             ("length", numpy.float64), ("fraction", numpy.float64)])
+
+
+def flatten(geoms):
+    counts = numpy.array([len(geom) for geom in geoms], dtype=numpy.int64)
+    offsets = numpy.zeros(len(counts) + 1, dtype=numpy.int64)
+    numpy.cumsum(counts, out=offsets[1:])
+    coordinates = numpy.array([point for geom in geoms for point in geom], dtype=numpy.float64).reshape((-1, 2))
+    return coordinates[:, 0], coordinates[:, 1], offsets
+
+
+def segment(lng, lat, offsets):
+    lng = numpy.asarray(lng, dtype=numpy.float64)
+    lat = numpy.asarray(lat, dtype=numpy.float64)
+    offsets = numpy.asarray(offsets, dtype=numpy.int64)
+    counts = numpy.diff(offsets)
+    segment_counts = numpy.maximum(counts - 1, 0)
+    sources = numpy.repeat(numpy.arange(len(counts)), segment_counts)
+    # Every vertex except the last one of each line starts a segment.
+    starts = numpy.arange(len(lng))
+    is_last = numpy.zeros(len(lng), dtype=bool)
+    is_last[offsets[1:][counts > 0] - 1] = True
+    starts = starts[~is_last]
+    ends = starts + 1
+
+    (x, y) = geo_arrays.mercator_to_lcc(lng, lat)
+    segments = numpy.empty(len(starts), dtype=segment_dtype)
+    segments["source"] = sources
+    segments["from_lng"] = lng[starts]
+    segments["from_lat"] = lat[starts]
+    segments["to_lng"] = lng[ends]
+    segments["to_lat"] = lat[ends]
+    segments["from_x"] = x[starts]
+    segments["from_y"] = y[starts]
+    segments["to_x"] = x[ends]
+    segments["to_y"] = y[ends]
+    segments["length"] = geo_arrays.distance_on_unit_sphere(lat[starts], lng[starts],
+                                                            lat[ends], lng[ends]) * earth_radius
+    total_lengths = numpy.bincount(sources, weights=segments["length"], minlength=len(counts))
+    totals = total_lengths[sources]
+    equal_split = 1.0 / numpy.maximum(segment_counts, 1)[sources]
+    segments["fraction"] = numpy.where(totals > 0, segments["length"] / numpy.where(totals > 0, totals, 1),
+                                       equal_split)
+    return segments
+
+
+def segment_sources(sources, emission_fields):
+    (lng, lat, offsets) = flatten([source.geom for source in sources])
+    segments = segment(lng, lat, offsets)
+    emissions = numpy.array([[getattr(source, field) or 0 for field in emission_fields] for source in sources],
+                            dtype=numpy.float64).reshape((len(sources), len(emission_fields)))
+    return segments, emissions[segments["source"]] * segments["fraction"][:, numpy.newaxis]
+
+
+def split_sources(namedtuple_class, sources, endpoint_fields, emission_fields):
+    (segments, emissions) = segment_sources(sources, emission_fields)
+    results = []
+    for (s, segment_emissions) in zip(segments.tolist(), emissions.tolist()):
+        src_dict = sources[s[0]]._asdict()
+        for (field, value) in zip(endpoint_fields, s[5:9]):
+            src_dict[field] = value
+        src_dict["geom"] = [[s[1], s[2]], [s[3], s[4]]]
+        for (field, value) in zip(emission_fields, segment_emissions):
+            src_dict[field] = value
+        results.append(namedtuple_class(**src_dict))
+    return results
@@ -0,0 +1,82 @@
+import json
+import struct
+import zlib
+
+import numpy
+
+import ctools_backend.settings
+from ctools import source_table
+
+enabled = getattr(ctools_backend.settings, "binary_source_payloads", False)
+compression_level = getattr(ctools_backend.settings, "source_payload_compression_level", 6)
+
+magic = b"CTSRC2"
+
+
+def _shuffle(array, dtype):
+    # Grouping the n-th byte of every value together leaves long runs that deflate compresses well.
+    array = numpy.ascontiguousarray(array, dtype=dtype)
+    return array.view(numpy.uint8).reshape(-1, dtype.itemsize).T.tobytes()
+
+
+def _unshuffle(data, dtype, count):
+    planes = numpy.frombuffer(data, dtype=numpy.uint8).reshape(dtype.itemsize, count)
+    return numpy.ascontiguousarray(planes.T).view(dtype).ravel()
+
+
+def is_encoded(data):
+    return data is not None and bytes(data[:len(magic)]) == magic
+
+
+def encode(table, level=compression_level):
+    count = len(table)
+    # Coordinates keep full float64 precision so bounds and fingerprints match the JSON form exactly.
+    coordinates = numpy.asarray(table.coordinates, dtype=numpy.float64).reshape(-1, 2)
+    header = {"count": count, "vertices": len(coordinates), "fields": []}
+    parts = []
+    for field in table.fields:
+        column = table.records[field]
+        if column.dtype == object:
+            kind = "json"
+            data = json.dumps([source_table._value(v) for v in column.tolist()]).encode("utf-8")
+        else:
+            dtype = column.dtype.newbyteorder("<")
+            kind = dtype.str
+            data = _shuffle(column, dtype)
+        header["fields"].append([field, kind, len(data), field in table.integer_fields])
+        parts.append(data)
+    parts.append(_shuffle(numpy.diff(table.offsets), numpy.dtype("<u4")))
+    parts.append(_shuffle(coordinates.T.ravel(), numpy.dtype("<f8")))
+    header = json.dumps(header).encode("utf-8")
+    return magic + zlib.compress(struct.pack("<I", len(header)) + header + b"".join(parts), level)
+
+
+def decode(source_class, data):
+    if not is_encoded(data):
+        raise ValueError("Not an encoded %s payload" % source_class.__name__)
+    raw = zlib.decompress(bytes(data[len(magic):]))
+    (length,) = struct.unpack_from("<I", raw)
+    header = json.loads(raw[4:4 + length].decode("utf-8"))
+    offset = 4 + length
+    (count, vertices) = (header["count"], header["vertices"])
+    columns = {}
+    integer_fields = []
+    for (field, kind, size, integer) in header["fields"]:
+        chunk = raw[offset:offset + size]
+        offset += size
+        if kind == "json":
+            columns[field] = json.loads(chunk.decode("utf-8"))
+        else:
+            columns[field] = _unshuffle(chunk, numpy.dtype(kind), count)
+        if integer:
+            integer_fields.append(field)
+    for field in source_class.fields:
+        if field != "geom" and field not in columns:
+            columns[field] = [None] * count
+    counts = _unshuffle(raw[offset:offset + 4 * count], numpy.dtype("<u4"), count)
+    offset += 4 * count
+    coordinates = _unshuffle(raw[offset:offset + 16 * vertices], numpy.dtype("<f8"), 2 * vertices)
+    coordinates = numpy.ascontiguousarray(coordinates.reshape(2, vertices).T)
+    offsets = numpy.zeros(count + 1, dtype=numpy.int64)
+    numpy.cumsum(counts, out=offsets[1:])
+    return source_table.SourceTable.from_columns(source_class, columns, coordinates, offsets, integer_fields)
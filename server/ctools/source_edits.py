@@ -0,0 +1,97 @@
+import numbers
+
+import numpy
+
+from ctools import source_table, zonal
+
+
+def editable_fields(source_class):
+    return list(getattr(source_class, "emission_fields", [])) + list(getattr(source_class, "multiplier_fields", []))
+
+
+def _polygon_mask(table, polygon):
+    # A source is inside when the mean of its vertices is; polygon is a ring of [lng, lat] or a list of rings,
+    # the first being the exterior and the rest holes.
+    rings = [polygon] if isinstance(polygon[0][0], numbers.Number) else polygon
+    coordinates = numpy.concatenate([numpy.asarray(ring, dtype=numpy.float64).reshape(-1, 2) for ring in rings])
+    ring_offsets = numpy.zeros(len(rings) + 1, dtype=numpy.int64)
+    numpy.cumsum([len(ring) for ring in rings], out=ring_offsets[1:])
+    counts = numpy.diff(table.offsets)
+    present = numpy.flatnonzero(counts)
+    centers = numpy.full((len(table), 2), numpy.nan)
+    if len(present):
+        centers[present] = numpy.add.reduceat(table.coordinates, table.offsets[present], axis=0) / counts[present, None]
+    inside = numpy.zeros(len(table), dtype=bool)
+    inside[present] = zonal.assign(centers[present, 0], centers[present, 1], coordinates,
+                                   numpy.array([0, len(rings)]), ring_offsets) >= 0
+    return inside
+
+
+def match(table, polygon=None, gids=None, **criteria):
+    # Each criterion is a field name with a value to equal, a list or set of accepted values, or a
+    # (low, high) tuple of inclusive bounds where either end may be None.
+    mask = numpy.ones(len(table), dtype=bool)
+    for (field, condition) in criteria.items():
+        if field not in table.records.dtype.names:
+            raise ValueError("%s has no field %s" % (table.source_class.__name__, field))
+        column = table.records[field]
+        if isinstance(condition, tuple):
+            (low, high) = condition
+            with numpy.errstate(invalid="ignore"):
+                if low is not None:
+                    mask &= column >= low
+                if high is not None:
+                    mask &= column <= high
+        elif isinstance(condition, (list, set, frozenset, numpy.ndarray)):
+            mask &= numpy.isin(column, list(condition))
+        else:
+            mask &= column == condition
+    if gids is not None:
+        mask &= numpy.isin(table.records["gid"], list(gids))
+    if polygon is not None:
+        mask &= _polygon_mask(table, polygon)
+    return mask
+
+
+def apply(table, mask, multiply=None, override=None):
+    # multiply is one factor for every editable field or a {field: factor} dict; override is a
+    # {field: value} dict applied after it. Returns an edited copy and a summary of the change.
+    fields = editable_fields(table.source_class)
+    if multiply is None:
+        multiply = {}
+    elif isinstance(multiply, numbers.Number):
+        multiply = dict((f, multiply) for f in fields)
+    override = override or {}
+    for field in list(multiply) + list(override):
+        if field not in fields:
+            raise ValueError("%s is not an editable field of %s" % (field, table.source_class.__name__))
+    mask = numpy.asarray(mask)
+    indices = numpy.flatnonzero(mask) if mask.dtype == bool else mask
+    defaults = getattr(table.source_class, "bulk_defaults", {})
+    records = table.records.copy()
+    changed = numpy.zeros(len(indices), dtype=bool)
+    summary_fields = {}
+    for field in sorted(set(multiply) | set(override)):
+        before = records[field][indices].astype(numpy.float64)
+        after = before
+        if field in multiply:
+            # An unset multiplier means its default, so scaling it starts from there.
+            base = numpy.where(numpy.isnan(before), defaults.get(field, numpy.nan), before)
+            after = base * multiply[field]
+        if field in override:
+            after = numpy.full(len(indices), numpy.nan if override[field] is None else float(override[field]))
+        differs = ~((after == before) | (numpy.isnan(after) & numpy.isnan(before)))
+        changed |= differs
+        records[field][indices] = after
+        summary_fields[field] = {"before": float(numpy.nansum(before)), "after": float(numpy.nansum(after)),
+                                 "changed": int(differs.sum())}
+    summary = {
+        "matched": len(indices),
+        "changed": int(changed.sum()),
+        "gids": [source_table._value(v) for v in table.records["gid"][indices[changed]].tolist()],
+        "fields": summary_fields
+    }
+    # Edited fields hold computed values now, whatever form they were given in.
+    integer_fields = table.integer_fields - set(multiply) - set(override)
+    return source_table.SourceTable(table.source_class, records, table.coordinates, table.offsets,
+                                    integer_fields), summary
@@ -0,0 +1,160 @@
+import numbers
+
+import numpy
+import sqlalchemy as sa
+
+from ctools import geo_arrays, segmentation
+
+
+def _field_dtype(source_class, field):
+    column_attributes = sa.inspect(source_class).column_attrs
+    if field not in column_attributes.keys():
+        return numpy.dtype(numpy.float64)
+    column_type = column_attributes[field].columns[0].type
+    if isinstance(column_type, sa.Integer):
+        return numpy.dtype(numpy.int64)
+    if isinstance(column_type, (sa.Numeric, sa.Float)):
+        return numpy.dtype(numpy.float64)
+    return numpy.dtype(object)
+
+
+def _column(values, dtype):
+    if dtype == numpy.dtype(numpy.int64):
+        try:
+            return numpy.array(values, dtype=dtype)
+        except (TypeError, ValueError):
+            return numpy.array(values, dtype=object)
+    return numpy.array(values, dtype=dtype)
+
+
+def _value(value):
+    if isinstance(value, float) and value != value:
+        return None
+    return value
+
+
+def _integral(values):
+    if isinstance(values, numpy.ndarray):
+        return values.dtype.kind in "iu"
+    present = [v for v in values if v is not None]
+    return bool(present) and all(isinstance(v, numbers.Integral) and not isinstance(v, bool) for v in present)
+
+
+def _json_column(column, integer=False):
+    if integer:
+        return [None if v != v else int(v) for v in column.tolist()]
+    return [_value(v) for v in column.tolist()]
+
+
+class SourceTable(object):
+
+    def __init__(self, source_class, records, coordinates, offsets, integer_fields=()):
+        self.source_class = source_class
+        self.records = records
+        self.coordinates = coordinates
+        self.offsets = offsets
+        # Numeric fields are held as floats; these ones were given as integers and are written back out as such.
+        self.integer_fields = frozenset(integer_fields)
+
+    @property
+    def fields(self):
+        return [f for f in self.source_class.fields if f != "geom"]
+
+    @property
+    def emission_fields(self):
+        return getattr(self.source_class, "emission_fields", [])
+
+    @property
+    def stack_fields(self):
+        return getattr(self.source_class, "stack_fields", [])
+
+    @property
+    def single_point(self):
+        return getattr(self.source_class, "single_point", False)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, field):
+        return self.records[field]
+
+    @classmethod
+    def from_columns(cls, source_class, columns, coordinates, offsets, integer_fields=None):
+        fields = [f for f in source_class.fields if f != "geom"]
+        arrays = [_column(columns[f], _field_dtype(source_class, f)) for f in fields]
+        records = numpy.empty(len(offsets) - 1, dtype=[(f, a.dtype) for (f, a) in zip(fields, arrays)])
+        for (f, a) in zip(fields, arrays):
+            records[f] = a
+        if integer_fields is None:
+            integer_fields = [f for (f, a) in zip(fields, arrays) if a.dtype.kind == "f" and _integral(columns[f])]
+        return cls(source_class, records, coordinates, offsets, integer_fields)
+
+    @classmethod
+    def from_json(cls, source_class, rows):
+        rows = rows or []
+        columns = dict((f, [row[i] for row in rows]) for (i, f) in enumerate(source_class.fields))
+        geoms = columns.pop("geom")
+        if getattr(source_class, "single_point", False):
+            geoms = [[geom] if geom is not None else [] for geom in geoms]
+        (lng, lat, offsets) = segmentation.flatten(geoms)
+        return cls.from_columns(source_class, columns, numpy.column_stack([lng, lat]), offsets)
+
+    @classmethod
+    def from_namedtuples(cls, source_class, sources):
+        return cls.from_json(source_class, [list(source) for source in sources])
+
+    @classmethod
+    def from_batch(cls, batch):
+        defaults = getattr(batch.source_class, "bulk_defaults", {})
+        columns = dict((f, batch.columns.get(f, [defaults.get(f)] * len(batch))) for f in batch.source_class.fields
+                       if f != "geom")
+        table = cls.from_columns(batch.source_class, columns, batch.coordinates.copy(), batch.vertex_offsets.copy())
+        for f in table.emission_fields:
+            table.records[f] = numpy.nan_to_num(table.records[f])
+        return table
+
+    def geometry(self, i):
+        return self.coordinates[self.offsets[i]:self.offsets[i + 1]]
+
+    def to_json(self):
+        columns = [_json_column(self.records[f], f in self.integer_fields) for f in self.fields]
+        coordinates = self.coordinates.tolist()
+        offsets = self.offsets.tolist()
+        geom_index = self.source_class.fields.index("geom")
+        rows = []
+        for i in range(len(self)):
+            row = [column[i] for column in columns]
+            geom = coordinates[offsets[i]:offsets[i + 1]]
+            if self.single_point:
+                geom = geom[0] if geom else None
+            row.insert(geom_index, geom)
+            rows.append(row)
+        return rows
+
+    def to_namedtuples(self):
+        return [self.source_class.namedtuple_class(*row) for row in self.to_json()]
+
+    def emission_matrix(self):
+        return numpy.column_stack([self.records[f] for f in self.emission_fields]).astype(numpy.float64)
+
+    def vertex_sources(self):
+        return numpy.repeat(numpy.arange(len(self)), numpy.diff(self.offsets))
+
+    def projected(self):
+        return geo_arrays.mercator_to_lcc(self.coordinates[:, 0], self.coordinates[:, 1])
+
+    @property
+    def bounds(self):
+        return geo_arrays.bounds(self.coordinates[:, 0], self.coordinates[:, 1])
+
+    def take(self, indices):
+        indices = numpy.asarray(indices)
+        if indices.dtype == bool:
+            indices = numpy.flatnonzero(indices)
+        counts = numpy.diff(self.offsets)[indices]
+        offsets = numpy.zeros(len(indices) + 1, dtype=numpy.int64)
+        numpy.cumsum(counts, out=offsets[1:])
+        starts = numpy.repeat(self.offsets[indices], counts)
+        vertex_rank = numpy.arange(offsets[-1]) - numpy.repeat(offsets[:-1], counts)
+        return SourceTable(self.source_class, self.records[indices], self.coordinates[starts + vertex_rank], offsets,
+                           self.integer_fields)
@@ -0,0 +1,109 @@
+import numpy
+
+from ctools import matching
+
+
+def greedy(x1, y1, x2, y2, tolerance):
+    pairs = sorted((numpy.hypot(x1[i] - x2[j], y1[i] - y2[j]), i, j) for i in range(len(x1)) for j in range(len(x2)))
+    (used_1, used_2, matches) = (set(), set(), {})
+    for (distance, i, j) in pairs:
+        if distance <= tolerance and i not in used_1 and j not in used_2:
+            used_1.add(i)
+            used_2.add(j)
+            matches[i] = j
+    return matches
+
+
+def as_dict(matched):
+    return dict(zip(matched[0].tolist(), matched[1].tolist()))
+
+
+def check_one_to_one(matched):
+    (matched_1, matched_2) = matched
+    assert len(set(matched_1.tolist())) == len(matched_1)
+    assert len(set(matched_2.tolist())) == len(matched_2)
+    assert (numpy.diff(matched_1) > 0).all()
+
+
+def test_empty():
+    for matched in (matching.match_points([], [], [1.0], [1.0]), matching.match_points([1.0], [1.0], [], [])):
+        assert len(matched[0]) == 0 and len(matched[1]) == 0
+
+
+def test_permuted_points_match_exactly():
+    rng = numpy.random.RandomState(0)
+    (x, y) = (rng.uniform(-100, -90, 500), rng.uniform(30, 40, 500))
+    order = rng.permutation(500)
+    matched = matching.match_points(x, y, x[order], y[order], 1e-6)
+    assert as_dict(matched) == dict((int(i), int(j)) for (j, i) in enumerate(order))
+
+
+def test_unequal_sizes():
+    x1 = numpy.array([0.0, 1.0, 2.0])
+    x2 = numpy.array([5.0, 2.001, 9.0, 0.002, 7.0, 1.003])
+    matched = matching.match_points(x1, numpy.zeros(3), x2, numpy.zeros(6), 0.01)
+    assert as_dict(matched) == {0: 3, 1: 5, 2: 1}
+    matched = matching.match_points(x2, numpy.zeros(6), x1, numpy.zeros(3), 0.01)
+    assert as_dict(matched) == {1: 2, 3: 0, 5: 1}
+
+
+def test_beyond_tolerance():
+    matched = matching.match_points([0.0], [0.0], [0.02], [0.0], 0.01)
+    assert len(matched[0]) == 0
+
+
+def test_loser_falls_back_to_next_candidate():
+    # Point 0 of the first set takes its closest partner, which point 1 also wanted; point 1 then takes its next one.
+    x1 = numpy.array([0.0, 0.003])
+    x2 = numpy.array([0.001, 0.0095])
+    matched = matching.match_points(x1, numpy.zeros(2), x2, numpy.zeros(2), 0.01)
+    assert as_dict(matched) == {0: 0, 1: 1}
+
+
+def test_chain_of_contested_points():
+    # Each first-set point is closest to the second-set point its left neighbour takes.
+    x1 = numpy.arange(6) * 0.004
+    x2 = x1 - 0.001
+    matched = matching.match_points(x1, numpy.zeros(6), x2, numpy.zeros(6), 0.0045)
+    assert as_dict(matched) == greedy(x1, numpy.zeros(6), x2, numpy.zeros(6), 0.0045)
+    assert len(matched[0]) == 6
+
+
+def test_ties():
+    # Equal distances may pair either way, but every point still matches exactly once.
+    x1 = numpy.array([0.0, 0.0, 0.004])
+    y1 = numpy.array([0.001, -0.001, 0.0])
+    x2 = numpy.array([0.0, 0.004, 0.004])
+    y2 = numpy.array([0.0, 0.001, -0.001])
+    matched = matching.match_points(x1, y1, x2, y2, 0.01)
+    check_one_to_one(matched)
+    assert len(matched[0]) == 3
+
+
+def test_duplicate_points():
+    # Copies of one location compete for the same candidates; each candidate is still used once.
+    x1 = numpy.array([1.0, 1.0, 1.0, 3.0])
+    x2 = numpy.array([1.0, 1.001, 3.0, 3.0])
+    matched = matching.match_points(x1, numpy.zeros(4), x2, numpy.zeros(4), 0.01)
+    check_one_to_one(matched)
+    assert len(matched[0]) == 3
+    assert set(matched[1].tolist()) == {0, 1, 2} or set(matched[1].tolist()) == {0, 1, 3}
+
+
+def test_matches_sequential_greedy():
+    rng = numpy.random.RandomState(1)
+    for _ in range(200):
+        (n1, n2) = rng.randint(0, 40, 2)
+        (x1, y1) = (rng.uniform(0, 0.05, n1), rng.uniform(0, 0.05, n1))
+        (x2, y2) = (rng.uniform(0, 0.05, n2), rng.uniform(0, 0.05, n2))
+        matched = matching.match_points(x1, y1, x2, y2, 0.01)
+        check_one_to_one(matched)
+        assert as_dict(matched) == greedy(x1, y1, x2, y2, 0.01)
+
+
+def test_align_and_take():
+    (rows_1, rows_2) = matching.align(3, 2, numpy.array([2]), numpy.array([0]))
+    assert rows_1.tolist() == [2, 0, 1, -1]
+    assert rows_2.tolist() == [0, -1, -1, 1]
+    taken = matching.take(numpy.array([10.0, 20.0]), rows_2)
+    assert taken[0] == 10.0 and numpy.isnan(taken[1]) and taken[3] == 20.0
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+import numpy
+import pytest
+import sqlalchemy as sa
+from sqlalchemy.ext.declarative import declarative_base
+
+from ctools import source_codec, source_table
+
+Base = declarative_base()
+
+
+class Link(Base):
+    __tablename__ = "link"
+    fields = ["gid", "name", "geom", "lanes", "aadt", "nox"]
+    gid = sa.Column(sa.Integer, primary_key=True)
+    name = sa.Column(sa.Text)
+    geom = sa.Column(sa.Text)
+    lanes = sa.Column(sa.Integer)
+    aadt = sa.Column(sa.Numeric(asdecimal=False))
+    nox = sa.Column(sa.Float)
+
+
+class Stack(Base):
+    __tablename__ = "stack"
+    fields = ["gid", "geom", "height"]
+    single_point = True
+    gid = sa.Column(sa.Integer, primary_key=True)
+    geom = sa.Column(sa.Text)
+    height = sa.Column(sa.Numeric(asdecimal=False))
+
+
+def round_trip(table):
+    data = source_codec.encode(table)
+    assert source_codec.is_encoded(data)
+    return source_codec.decode(table.source_class, data)
+
+
+def check_same(table, decoded):
+    assert len(decoded) == len(table)
+    assert decoded.records.dtype == table.records.dtype
+    for field in table.fields:
+        (a, b) = (table.records[field], decoded.records[field])
+        if a.dtype == object:
+            assert a.tolist() == b.tolist()
+        else:
+            numpy.testing.assert_array_equal(a, b)
+    assert decoded.coordinates.dtype == numpy.float64
+    numpy.testing.assert_array_equal(decoded.coordinates, table.coordinates)
+    numpy.testing.assert_array_equal(decoded.offsets, table.offsets)
+    assert decoded.integer_fields == table.integer_fields
+    assert decoded.to_json() == table.to_json()
+
+
+def test_mixed_columns():
+    rows = [
+        [1, u"Main St", [[-97.123456789012345, 35.98765432109876], [-97.1, 36.0]], 2, 86293, 0.1],
+        [2, None, [[-96.5, 35.5], [-96.4, 35.6], [-96.3, 35.7]], None, None, None],
+        [3, u"Café Ωmega", [], 4, 12.5, float("nan")],
+    ]
+    table = source_table.SourceTable.from_json(Link, rows)
+    check_same(table, round_trip(table))
+
+
+def test_float64_exactness():
+    rng = numpy.random.RandomState(0)
+    n = 1000
+    points = rng.uniform(-125, -65, (n, 2)) + rng.uniform(0, 1e-9, (n, 2))
+    rows = [[i, "road %d" % i, [p.tolist(), (p + 1e-7).tolist()], i % 5, float(rng.uniform(0, 1e6)),
+             float(rng.standard_normal())] for (i, p) in enumerate(points)]
+    table = source_table.SourceTable.from_json(Link, rows)
+    decoded = round_trip(table)
+    check_same(table, decoded)
+    assert decoded.coordinates.tobytes() == table.coordinates.tobytes()
+
+
+def test_nan_values():
+    table = source_table.SourceTable.from_json(Link, [[1, "a", [[0.0, 0.0], [1.0, 1.0]], 1, None, None]] * 3)
+    decoded = round_trip(table)
+    assert numpy.isnan(decoded.records["aadt"]).all()
+    assert numpy.isnan(decoded.records["nox"]).all()
+    assert [row[4] for row in decoded.to_json()] == [None] * 3
+
+
+def test_empty_table():
+    table = source_table.SourceTable.from_json(Link, [])
+    decoded = round_trip(table)
+    assert len(decoded) == 0
+    assert decoded.to_json() == []
+
+
+def test_single_point_sources():
+    table = source_table.SourceTable.from_json(Stack, [[1, [-97.5, 35.25], 30.0], [2, None, None]])
+    decoded = round_trip(table)
+    check_same(table, decoded)
+    assert decoded.to_json() == [[1, [-97.5, 35.25], 30.0], [2, None, None]]
+
+
+def test_numeric_values_keep_their_json_type():
+    rows = [[1, "a", [[0.0, 0.0]], 2, 86293, 1.0], [2, "b", [[1.0, 1.0]], 3, None, 2.0]]
+    table = source_table.SourceTable.from_json(Link, rows)
+    assert table.integer_fields == frozenset(["aadt"])
+    for decoded in (table, round_trip(table), round_trip(table).take([1, 0])):
+        json_rows = sorted(decoded.to_json())
+        assert [type(row[4]) for row in json_rows] == [int, type(None)]
+        assert [type(row[5]) for row in json_rows] == [float, float]
+    assert sorted(round_trip(table).to_json()) == rows
+
+
+def test_rejects_other_payloads():
+    assert not source_codec.is_encoded(None)
+    assert not source_codec.is_encoded(b"[[1, 2]]")
+    with pytest.raises(ValueError):
+        source_codec.decode(Link, b"[[1, 2]]")
@@ -0,0 +1,224 @@
+import math
+import os
+import struct
+import zlib
+
+import numpy
+
+import ctools_backend.settings
+from ctools import screening
+from ctools.cache import DiskCache, LRUCache
+
+tile_size = 256
+directory = getattr(ctools_backend.settings, "tile_cache_directory",
+                    os.path.join(ctools_backend.settings.scenario_run_directory, "tiles"))
+max_size = getattr(ctools_backend.settings, "tile_cache_max_bytes", 512 * 1024 * 1024)
+source_cache_size = getattr(ctools_backend.settings, "tile_source_cache_max_bytes", 256 * 1024 * 1024)
+prerender_max_zoom = getattr(ctools_backend.settings, "tile_prerender_max_zoom", 8)
+opacity = getattr(ctools_backend.settings, "tile_opacity", 0.75)
+compression_level = getattr(ctools_backend.settings, "tile_compression_level", 6)
+default_colormap = "viridis"
+
+earth_radius = 6378137.0
+max_latitude = 85.0511287798
+
+# Anchor colours, evenly spaced from the lowest to the highest value.
+colormaps = {
+    "viridis": [(68, 1, 84), (59, 82, 139), (33, 145, 140), (94, 201, 98), (253, 231, 37)],
+    "inferno": [(0, 0, 4), (87, 16, 110), (188, 55, 84), (249, 142, 9), (252, 255, 164)],
+    "heat": [(255, 255, 178), (254, 204, 92), (253, 141, 60), (240, 59, 32), (189, 0, 38)],
+    "greys": [(255, 255, 255), (0, 0, 0)],
+    "diverging": [(5, 48, 97), (103, 169, 207), (247, 247, 247), (239, 138, 98), (103, 0, 31)]
+}
+
+_colormap_tables = {}
+
+
+def colormap_table(name):
+    if name not in colormaps:
+        raise ValueError("Unknown colormap: %s" % name)
+    if name not in _colormap_tables:
+        anchors = numpy.array(colormaps[name], dtype=numpy.float64)
+        positions = numpy.linspace(0, 1, len(anchors))
+        steps = numpy.linspace(0, 1, 256)
+        table = numpy.empty((256, 4), dtype=numpy.uint8)
+        for channel in range(3):
+            table[:, channel] = numpy.round(numpy.interp(steps, positions, anchors[:, channel]))
+        table[:, 3] = int(round(255 * opacity))
+        _colormap_tables[name] = table
+    return _colormap_tables[name]
+
+
+def mercator(lng, lat):
+    lat = numpy.clip(numpy.asarray(lat, dtype=numpy.float64), -max_latitude, max_latitude)
+    x = earth_radius * numpy.radians(numpy.asarray(lng, dtype=numpy.float64))
+    y = earth_radius * numpy.log(numpy.tan(numpy.pi / 4 + numpy.radians(lat) / 2))
+    return x, y
+
+
+def tile_bounds(z, x, y):
+    size = 2 * math.pi * earth_radius / 2 ** z
+    origin = math.pi * earth_radius
+    return -origin + x * size, origin - (y + 1) * size, -origin + (x + 1) * size, origin - y * size
+
+
+def tile_range(bounds, z):
+    (min_lng, min_lat, max_lng, max_lat) = bounds
+    ((min_x, max_x), (min_y, max_y)) = mercator([min_lng, max_lng], [min_lat, max_lat])
+    size = 2 * math.pi * earth_radius / 2 ** z
+    origin = math.pi * earth_radius
+    last = 2 ** z - 1
+    x_range = (max(int((min_x + origin) // size), 0), min(int((max_x + origin) // size), last))
+    y_range = (max(int((origin - max_y) // size), 0), min(int((origin - min_y) // size), last))
+    return x_range, y_range
+
+
+def encode_png(rgba, level=compression_level):
+    (height, width) = rgba.shape[:2]
+    rows = numpy.zeros((height, width * 4 + 1), dtype=numpy.uint8)
+    rows[:, 1:] = rgba.reshape(height, width * 4)
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+    return (b"\x89PNG\r\n\x1a\n" +
+            chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)) +
+            chunk(b"IDAT", zlib.compress(rows.tobytes(), level)) +
+            chunk(b"IEND", b""))
+
+
+empty_tile = encode_png(numpy.zeros((tile_size, tile_size, 4), dtype=numpy.uint8))
+
+
+class TileSource(object):
+
+    def __init__(self, lng, lat, values):
+        (self.x, self.y) = mercator(lng, lat)
+        self.grid = screening.ReceptorGrid(self.x, self.y)
+        # A pixel only takes a receptor's value within about one receptor spacing, so sparse areas are not smeared.
+        self.radius = 1.5 * self.grid.cell_size
+        self.values = {}
+        self.ranges = {}
+        for (result_type, column) in values.items():
+            column = numpy.asarray(column, dtype=numpy.float64)
+            finite = column[numpy.isfinite(column)]
+            log_scale = len(finite) and (finite > 0).all()
+            if log_scale:
+                column = numpy.log10(numpy.where(column > 0, column, numpy.nan))
+                finite = numpy.log10(finite)
+            self.values[result_type] = column
+            self.ranges[result_type] = (finite.min(), finite.max()) if len(finite) else (0.0, 0.0)
+        self.bounds = None
+        if len(self.x):
+            self.bounds = (numpy.degrees(self.x.min() / earth_radius), float(numpy.min(lat)),
+                           numpy.degrees(self.x.max() / earth_radius), float(numpy.max(lat)))
+
+    @property
+    def nbytes(self):
+        return (self.x.nbytes + self.y.nbytes + self.grid.order.nbytes + self.grid.starts.nbytes +
+                sum(v.nbytes for v in self.values.values()))
+
+    def _binned(self, min_x, max_y, pixel):
+        # Zoomed out, a pixel covers several receptors: show the highest of them.
+        column = ((self.x - min_x) // pixel).astype(numpy.int64)
+        row = ((max_y - self.y) // pixel).astype(numpy.int64)
+        inside = numpy.flatnonzero((column >= 0) & (column < tile_size) & (row >= 0) & (row < tile_size))
+        return row[inside] * tile_size + column[inside], inside
+
+    def _nearest(self, min_x, max_y, pixel):
+        centers = (numpy.arange(tile_size) + 0.5) * pixel
+        (pixel_x, pixel_y) = numpy.meshgrid(min_x + centers, max_y - centers)
+        (pixel_x, pixel_y) = (pixel_x.ravel(), pixel_y.ravel())
+        boxes = numpy.column_stack([pixel_x - self.radius, pixel_y - self.radius,
+                                    pixel_x + self.radius, pixel_y + self.radius])
+        (pixels, receptors) = self.grid.candidates(boxes)
+        if not len(pixels):
+            return pixels, receptors
+        # Candidates come grouped by pixel; keep those at the smallest distance within their group.
+        distance = (self.x[receptors] - pixel_x[pixels]) ** 2 + (self.y[receptors] - pixel_y[pixels]) ** 2
+        starts = numpy.flatnonzero(numpy.r_[True, pixels[1:] != pixels[:-1]])
+        counts = numpy.diff(numpy.r_[starts, len(pixels)])
+        closest = distance == numpy.repeat(numpy.minimum.reduceat(distance, starts), counts)
+        return pixels[closest], receptors[closest]
+
+    def render(self, z, x, y, result_type="total", colormap=default_colormap):
+        table = colormap_table(colormap)
+        (min_x, min_y, max_x, max_y) = tile_bounds(z, x, y)
+        pixel = (max_x - min_x) / tile_size
+        if pixel > self.grid.cell_size:
+            (pixels, receptors) = self._binned(min_x, max_y, pixel)
+            values = self.values[result_type][receptors]
+            order = numpy.lexsort((numpy.where(numpy.isnan(values), -numpy.inf, values), pixels))
+            (pixels, values) = (pixels[order], values[order])
+        else:
+            (pixels, receptors) = self._nearest(min_x, max_y, pixel)
+            values = self.values[result_type][receptors]
+        if not len(pixels):
+            return None
+        # Candidates are ordered so the one to show comes last for each pixel.
+        last = numpy.ones(len(pixels), dtype=bool)
+        last[:-1] = pixels[1:] != pixels[:-1]
+        (pixels, values) = (pixels[last], values[last])
+        present = numpy.isfinite(values)
+        (low, high) = self.ranges[result_type]
+        scale = 255.0 / (high - low) if high > low else 0.0
+        indices = numpy.clip(numpy.round((values[present] - low) * scale), 0, 255).astype(numpy.intp)
+        rgba = numpy.zeros((tile_size * tile_size, 4), dtype=numpy.uint8)
+        rgba[pixels[present]] = table[indices]
+        return rgba.reshape(tile_size, tile_size, 4)
+
+
+class TileCache(object):
+
+    def __init__(self, directory=directory, max_size=max_size, source_cache_size=source_cache_size):
+        self.disk = DiskCache(directory, max_size, ".png")
+        self.sources = LRUCache(source_cache_size, lambda source: source.nbytes)
+
+    @staticmethod
+    def run_key(run):
+        return "%s_%s" % (run.__tablename__, run.result_run_id)
+
+    def source(self, run):
+        key = self.run_key(run)
+        source = self.sources.get(key)
+        if source is None:
+            arrays = dict((t, numpy.asarray(run.result_array(t), dtype=numpy.float64)) for t in run.result_types)
+            total = arrays["total"]
+            values = dict((t, array[:, 2]) for (t, array) in arrays.items())
+            source = self.sources.put(key, TileSource(total[:, 0], total[:, 1], values))
+        return source
+
+    def tile(self, run, z, x, y, result_type="total", colormap=default_colormap):
+        if result_type not in run.result_types:
+            raise ValueError("Unknown result type: %s" % result_type)
+        colormap_table(colormap)
+        if not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+            return empty_tile
+        key = "%s_%s_%s_%d_%d_%d" % (self.run_key(run), result_type, colormap, z, x, y)
+        data = self.disk.get(key)
+        if data is None:
+            rgba = self.source(run).render(z, x, y, result_type, colormap)
+            data = empty_tile if rgba is None else self.disk.put(key, encode_png(rgba))
+        return data
+
+    def prerender(self, run, max_zoom=prerender_max_zoom, result_types=None, colormap=default_colormap):
+        source = self.source(run)
+        if source.bounds is None:
+            return 0
+        rendered = 0
+        for z in range(max_zoom + 1):
+            ((first_x, last_x), (first_y, last_y)) = tile_range(source.bounds, z)
+            for x in range(first_x, last_x + 1):
+                for y in range(first_y, last_y + 1):
+                    for result_type in result_types or run.result_types:
+                        self.tile(run, z, x, y, result_type, colormap)
+                        rendered += 1
+        return rendered
+
+    def invalidate(self, run):
+        key = self.run_key(run)
+        self.sources.pop(key)
+        self.disk.remove(key + "_")
+
+
+cache = TileCache()
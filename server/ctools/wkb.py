@@ -0,0 +1,113 @@
+import struct
+
+import numpy
+
+POINT, LINESTRING, POLYGON, MULTIPOINT, MULTILINESTRING, MULTIPOLYGON = range(1, 7)
+
+_EWKB_Z = 0x80000000
+_EWKB_M = 0x40000000
+_EWKB_SRID = 0x20000000
+
+
+def _read_header(blob, offset):
+    byte_order = "<" if struct.unpack_from("B", blob, offset)[0] == 1 else ">"
+    (type_code,) = struct.unpack_from(byte_order + "I", blob, offset + 1)
+    offset += 5
+    dims = 2
+    if type_code & _EWKB_Z:
+        dims += 1
+    if type_code & _EWKB_M:
+        dims += 1
+    if type_code & _EWKB_SRID:
+        offset += 4
+    type_code &= 0x0fffffff
+    if type_code >= 1000:
+        dims += {1: 1, 2: 1, 3: 2}[type_code // 1000]
+        type_code %= 1000
+    return byte_order, type_code, dims, offset
+
+
+def _read_points(blob, offset, count, dims, byte_order, parts):
+    points = numpy.frombuffer(blob, dtype=byte_order + "f8", count=count * dims, offset=offset)
+    parts.append(points.reshape((count, dims))[:, :2])
+    return offset + 8 * dims * count
+
+
+def _read_geometry(blob, offset, parts, exterior_only):
+    (byte_order, type_code, dims, offset) = _read_header(blob, offset)
+    if type_code == POINT:
+        return _read_points(blob, offset, 1, dims, byte_order, parts)
+    (count,) = struct.unpack_from(byte_order + "I", blob, offset)
+    offset += 4
+    if type_code == LINESTRING:
+        return _read_points(blob, offset, count, dims, byte_order, parts)
+    if type_code == POLYGON:
+        for ring in range(count):
+            (points,) = struct.unpack_from(byte_order + "I", blob, offset)
+            offset += 4
+            if ring == 0 or not exterior_only:
+                offset = _read_points(blob, offset, points, dims, byte_order, parts)
+            else:
+                offset += 8 * dims * points
+        return offset
+    for _ in range(count):
+        offset = _read_geometry(blob, offset, parts, exterior_only)
+    return offset
+
+
+def decode(blobs, exterior_only=True):
+    parts = []
+    geometry_offsets = [0]
+    for blob in blobs:
+        if blob is not None:
+            blob = bytes(blob)
+            if blob:
+                _read_geometry(blob, 0, parts, exterior_only)
+        geometry_offsets.append(len(parts))
+    part_offsets = numpy.zeros(len(parts) + 1, dtype=numpy.int64)
+    numpy.cumsum([len(part) for part in parts], out=part_offsets[1:])
+    if parts:
+        coordinates = numpy.concatenate(parts).astype(numpy.float64)
+    else:
+        coordinates = numpy.empty((0, 2))
+    return coordinates, numpy.array(geometry_offsets, dtype=numpy.int64), part_offsets
+
+
+def _read_polygons(blob, offset, polygons):
+    (byte_order, type_code, dims, offset) = _read_header(blob, offset)
+    (count,) = struct.unpack_from(byte_order + "I", blob, offset)
+    offset += 4
+    if type_code == POLYGON:
+        rings = []
+        for _ in range(count):
+            (points,) = struct.unpack_from(byte_order + "I", blob, offset)
+            offset = _read_points(blob, offset + 4, points, dims, byte_order, rings)
+        polygons.append(rings)
+        return offset
+    if type_code not in (MULTIPOLYGON, 7):
+        raise ValueError("Expected a polygon or multipolygon, got geometry type %d" % type_code)
+    for _ in range(count):
+        offset = _read_polygons(blob, offset, polygons)
+    return offset
+
+
+def decode_polygons(blobs):
+    # Like decode, but keeps holes and which rings belong to which polygon.
+    polygons = []
+    geometry_offsets = [0]
+    for blob in blobs:
+        if blob is not None:
+            blob = bytes(blob)
+            if blob:
+                _read_polygons(blob, 0, polygons)
+        geometry_offsets.append(len(polygons))
+    rings = [ring for polygon in polygons for ring in polygon]
+    polygon_offsets = numpy.zeros(len(polygons) + 1, dtype=numpy.int64)
+    numpy.cumsum([len(polygon) for polygon in polygons], out=polygon_offsets[1:])
+    ring_offsets = numpy.zeros(len(rings) + 1, dtype=numpy.int64)
+    numpy.cumsum([len(ring) for ring in rings], out=ring_offsets[1:])
+    if rings:
+        coordinates = numpy.concatenate(rings).astype(numpy.float64)
+    else:
+        coordinates = numpy.empty((0, 2))
+    return coordinates, numpy.array(geometry_offsets, dtype=numpy.int64), polygon_offsets, ring_offsets
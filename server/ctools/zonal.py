@@ -0,0 +1,173 @@
+import hashlib
+import io
+import os
+
+import numpy
+
+import ctools_backend.settings
+from ctools import geo_arrays, screening
+from ctools.cache import DiskCache, LRUCache
+
+directory = getattr(ctools_backend.settings, "zonal_cache_directory",
+                    os.path.join(ctools_backend.settings.scenario_run_directory, "zonal"))
+max_size = getattr(ctools_backend.settings, "zonal_cache_max_bytes", 128 * 1024 * 1024)
+memory_max_size = getattr(ctools_backend.settings, "zonal_memory_cache_max_bytes", 64 * 1024 * 1024)
+edge_chunk_size = getattr(ctools_backend.settings, "zonal_edge_chunk_size", 100000)
+
+
+def ring_edges(coordinates, geometry_offsets, part_offsets):
+    # Every ring of every geometry, holes included, as (x1, y1, x2, y2) edges tagged with their geometry.
+    part_count = len(part_offsets) - 1
+    part_of_point = numpy.repeat(numpy.arange(part_count), numpy.diff(part_offsets))
+    follows = numpy.ones(len(coordinates), dtype=bool)
+    follows[part_offsets[:-1][numpy.diff(part_offsets) > 0]] = False
+    following = numpy.flatnonzero(follows)
+    edges = numpy.column_stack([coordinates[following - 1], coordinates[following]])
+    geometry_of_part = numpy.repeat(numpy.arange(len(geometry_offsets) - 1), numpy.diff(geometry_offsets))
+    return edges, geometry_of_part[part_of_point[following]]
+
+
+def assign(lng, lat, coordinates, geometry_offsets, part_offsets, chunk_size=edge_chunk_size):
+    lng = numpy.asarray(lng, dtype=numpy.float64)
+    lat = numpy.asarray(lat, dtype=numpy.float64)
+    zones = numpy.full(len(lng), -1, dtype=numpy.int64)
+    if not len(lng) or not len(coordinates):
+        return zones
+    (edges, geometries) = ring_edges(coordinates, geometry_offsets, part_offsets)
+    geometry_count = len(geometry_offsets) - 1
+    max_x = numpy.full(geometry_count, -numpy.inf)
+    numpy.maximum.at(max_x, geometries, numpy.maximum(edges[:, 0], edges[:, 2]))
+    grid = screening.ReceptorGrid(lng, lat)
+    crossings = []
+    for start in range(0, len(edges), chunk_size):
+        (x1, y1, x2, y2) = edges[start:start + chunk_size].T
+        edge_geometries = geometries[start:start + chunk_size]
+        # A ray cast west from a point crosses an edge only if the point lies in the edge's band of latitude,
+        # east of the edge's western end and west of the geometry's eastern extent.
+        bands = numpy.column_stack([numpy.minimum(x1, x2), numpy.minimum(y1, y2), max_x[edge_geometries],
+                                    numpy.maximum(y1, y2)])
+        (candidate_edges, points) = grid.candidates(bands)
+        (x1, y1, x2, y2) = (x1[candidate_edges], y1[candidate_edges], x2[candidate_edges], y2[candidate_edges])
+        (px, py) = (lng[points], lat[points])
+        straddles = (y1 > py) != (y2 > py)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            crossing_x = x1 + (py - y1) * (x2 - x1) / (y2 - y1)
+        crossed = straddles & (crossing_x < px)
+        crossings.append(edge_geometries[candidate_edges[crossed]] * len(lng) + points[crossed])
+    # An odd number of crossings means the point is inside; holes cancel out their polygon.
+    (keys, counts) = numpy.unique(numpy.concatenate(crossings), return_counts=True)
+    keys = keys[counts % 2 == 1]
+    (inside_geometries, inside_points) = (keys // len(lng), keys % len(lng))
+    # Keys are sorted by geometry, so reversing makes the lowest geometry win on shared boundaries.
+    zones[inside_points[::-1]] = inside_geometries[::-1]
+    return zones
+
+
+def layout_key(lng, lat):
+    digest = hashlib.sha1()
+    digest.update(numpy.ascontiguousarray(lng, dtype=numpy.float64).tobytes())
+    digest.update(numpy.ascontiguousarray(lat, dtype=numpy.float64).tobytes())
+    return digest.hexdigest()
+
+
+class ZoneAssignment(object):
+
+    def __init__(self, gids, population, zones):
+        self.gids = numpy.asarray(gids, dtype=numpy.int64)
+        self.population = numpy.asarray(population, dtype=numpy.float64)
+        self.zones = numpy.asarray(zones, dtype=numpy.int64)
+        assigned = numpy.flatnonzero(self.zones >= 0)
+        self.order = assigned[numpy.argsort(self.zones[assigned], kind="mergesort")]
+        (self.present, self.starts) = numpy.unique(self.zones[self.order], return_index=True)
+
+    def __len__(self):
+        return len(self.gids)
+
+    @property
+    def nbytes(self):
+        return self.gids.nbytes + self.population.nbytes + self.zones.nbytes + self.order.nbytes + self.starts.nbytes
+
+    def aggregate(self, values):
+        values = numpy.asarray(values, dtype=numpy.float64)
+        columns = values.reshape(len(self.zones), -1)[self.order]
+        shape = (len(self.gids), columns.shape[1])
+        (count, mean, maximum) = (numpy.zeros(shape), numpy.full(shape, numpy.nan), numpy.full(shape, numpy.nan))
+        if len(self.present):
+            finite = numpy.isfinite(columns)
+            count[self.present] = numpy.add.reduceat(finite, self.starts, axis=0)
+            total = numpy.add.reduceat(numpy.where(finite, columns, 0.0), self.starts, axis=0)
+            highest = numpy.maximum.reduceat(numpy.where(finite, columns, -numpy.inf), self.starts, axis=0)
+            with numpy.errstate(invalid="ignore", divide="ignore"):
+                mean[self.present] = total / count[self.present]
+            maximum[self.present] = numpy.where(numpy.isfinite(highest), highest, numpy.nan)
+        if values.ndim == 1:
+            return count[:, 0], mean[:, 0], maximum[:, 0]
+        return count, mean, maximum
+
+    def population_weighted(self, means):
+        means = numpy.asarray(means, dtype=numpy.float64).reshape(len(self.gids), -1)
+        weights = numpy.where(numpy.isfinite(means) & numpy.isfinite(self.population)[:, None],
+                              numpy.nan_to_num(self.population)[:, None], 0.0)
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            return (weights * numpy.nan_to_num(means)).sum(axis=0) / weights.sum(axis=0)
+
+    def statistics(self, values, result_types):
+        (count, mean, maximum) = self.aggregate(numpy.asarray(values).reshape(len(self.zones), len(result_types)))
+        weighted = self.population_weighted(mean)
+        statistics = {
+            "gid": self.gids.tolist(),
+            "population": [None if p != p else p for p in self.population.tolist()],
+            "receptors": count[:, 0].astype(int).tolist() if len(result_types) else []
+        }
+        for (i, result_type) in enumerate(result_types):
+            statistics[result_type] = {
+                "mean": [None if v != v else v for v in mean[:, i].tolist()],
+                "max": [None if v != v else v for v in maximum[:, i].tolist()],
+                "population_weighted_mean": None if weighted[i] != weighted[i] else float(weighted[i])
+            }
+        return statistics
+
+    def dumps(self):
+        output = io.BytesIO()
+        numpy.savez(output, gids=self.gids, population=self.population, zones=self.zones)
+        return output.getvalue()
+
+    @classmethod
+    def loads(cls, data):
+        arrays = numpy.load(io.BytesIO(data))
+        return cls(arrays["gids"], arrays["population"], arrays["zones"])
+
+
+class ZoneCache(object):
+
+    def __init__(self, directory=directory, max_size=max_size, memory_max_size=memory_max_size):
+        self.disk = DiskCache(directory, max_size, ".npz")
+        self.memory = LRUCache(memory_max_size, lambda assignment: assignment.nbytes)
+
+    def get(self, lng, lat, load_zones):
+        key = layout_key(lng, lat)
+        assignment = self.memory.get(key)
+        if assignment is None:
+            data = self.disk.get(key)
+            if data is not None:
+                assignment = ZoneAssignment.loads(data)
+            else:
+                bounds = geo_arrays.bounds(lng, lat)
+                (gids, population, coordinates, geometry_offsets, part_offsets) = load_zones(bounds)
+                zones = assign(lng, lat, coordinates, geometry_offsets, part_offsets)
+                # Only zones that received a receptor are worth reporting on.
+                used = numpy.unique(zones[zones >= 0])
+                # The extra trailing slot maps unassigned receptors (-1) to themselves.
+                remap = numpy.full(len(gids) + 1, -1, dtype=numpy.int64)
+                remap[used] = numpy.arange(len(used))
+                assignment = ZoneAssignment(numpy.asarray(gids)[used], numpy.asarray(population)[used], remap[zones])
+                self.disk.put(key, assignment.dumps())
+            self.memory.put(key, assignment)
+        return assignment
+
+    @property
+    def stats(self):
+        return {"memory": self.memory.stats, "disk": self.disk.stats}
+
+
+cache = ZoneCache()